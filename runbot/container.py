@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 """Containerize builds
 
-The docker image used for the build is always tagged like this:
-    odoo:runbot_tests
+The docker images used for the builds are tagged with a hash of their Dockerfile:
+    odoo:runbot_<hash>
 This file contains helpers to containerize builds with Docker.
 When testing this file:
     the first parameter should be a directory containing Odoo.
@@ -10,13 +10,22 @@ When testing this file:
 """
 import argparse
 import datetime
+import fcntl
+import hashlib
 import json
 import logging
 import os
-import shutil
 import subprocess
+import tempfile
+import threading
 import time
 
+try:
+    from .docker_api import get_docker_client, DOCKER_API_ERRORS
+except ImportError:
+    # run as a script, see the __main__ section
+    from docker_api import get_docker_client, DOCKER_API_ERRORS
+
 
 _logger = logging.getLogger(__name__)
 DOCKERUSER = """
@@ -30,30 +39,92 @@ USER odoo
 ENV COVERAGE_FILE /data/build/.coverage
 """ % {'group_id': os.getgid(), 'user_id': os.getuid()}
 
+# container name: {'running': bool, 'started_at': time, 'exit_code': int, 'finished_at': time}
+# filled by one `docker ps` per scheduler tick and by the `docker events` followed by the listener
+_container_states = {}
+_container_states_lock = threading.Lock()
+# time of the last successful listing, the states are not used once older than STATES_TTL
+_container_states_time = 0
+STATES_TTL = 60
+# a container started less than START_GRACE seconds ago may not be listed yet
+START_GRACE = 30
+# forget the exited containers after this many seconds
+EXITED_TTL = 3600
+
+
+class DockerBuildError(Exception):
+    pass
+
+def docker_image_tag():
+    """Return the Dockerfile used for the builds and its image tag"""
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'Dockerfile')) as df:
+        # synchronise the current user with the odoo user inside the Dockerfile
+        dockerfile = df.read() + DOCKERUSER
+    return dockerfile, 'odoo:runbot_%s' % hashlib.sha256(dockerfile.encode()).hexdigest()[:16]
+
+def docker_image_exists(tag):
+    """Return True if the image tag exists"""
+    client = get_docker_client()
+    if client:
+        try:
+            return client.image_exists(tag)
+        except DOCKER_API_ERRORS as e:
+            _logger.warning('Docker API image inspect failed, using the CLI: %s', e)
+    dinspect = subprocess.run(['docker', 'image', 'inspect', tag], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    return dinspect.returncode == 0
+
 def docker_build(log_path, build_dir):
-    """Build the docker image
+    """Build the docker image unless it already exists and return its tag,
+    raise DockerBuildError if the build fails
     :param log_path: path to the logfile that will contain odoo stdout and stderr
     :param build_dir: the build directory that contains the Odoo sources to build.
     """
-    # Prepare docker image
-    docker_dir = os.path.join(build_dir, 'docker')
-    os.makedirs(docker_dir, exist_ok=True)
-    shutil.copy(os.path.join(os.path.dirname(__file__), 'data', 'Dockerfile'), docker_dir)
-    # synchronise the current user with the odoo user inside the Dockerfile
-    with open(os.path.join(docker_dir, 'Dockerfile'), 'a') as df:
-        df.write(DOCKERUSER)
-    logs = open(log_path, 'w')
-    dbuild = subprocess.Popen(['docker', 'build', '--tag', 'odoo:runbot_tests', '.'], stdout=logs, stderr=logs, cwd=docker_dir)
-    dbuild.wait()
+    dockerfile, tag = docker_image_tag()
+    with open(log_path, 'w') as logs:
+        if docker_image_exists(tag):
+            logs.write('Using existing image %s\n' % tag)
+            return tag
+        # only one build of the same image at a time on the host, the others wait for it
+        lock_path = os.path.join(tempfile.gettempdir(), 'runbot-docker-%s.lock' % tag.split(':')[1])
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if docker_image_exists(tag):
+                logs.write('Using image %s built concurrently\n' % tag)
+                return tag
+            # Prepare docker image
+            docker_dir = os.path.join(build_dir, 'docker')
+            os.makedirs(docker_dir, exist_ok=True)
+            with open(os.path.join(docker_dir, 'Dockerfile'), 'w') as df:
+                df.write(dockerfile)
+            logs.flush()
+            client = get_docker_client()
+            if client:
+                try:
+                    success = client.image_build(docker_dir, tag, logs)
+                except DOCKER_API_ERRORS as e:
+                    _logger.warning('Docker API build failed, using the CLI: %s', e)
+                else:
+                    if not success:
+                        raise DockerBuildError('Docker image %s build failed, see %s' % (tag, log_path))
+                    return tag
+            dbuild = subprocess.Popen(['docker', 'build', '--tag', tag, '.'], stdout=logs, stderr=logs, cwd=docker_dir)
+            if dbuild.wait():
+                raise DockerBuildError('Docker image %s build failed with exit code %s, see %s' % (tag, dbuild.returncode, log_path))
+    return tag
 
-def docker_run(odoo_cmd, log_path, build_dir, container_name, exposed_ports=None, cpu_limit=None, preexec_fn=None):
+def docker_run(odoo_cmd, log_path, build_dir, container_name, exposed_ports=None, cpu_limit=None, preexec_fn=None, image=None):
     """Run tests in a docker container
+
+    Unlike the other helpers this one always uses the docker CLI: the `docker run`
+    process writes the container output to the log file and its pid is the one
+    tracked by the build.
     :param odoo_cmd: command that starts odoo
     :param log_path: path to the logfile that will contain odoo stdout and stderr
     :param build_dir: the build directory that contains the Odoo sources to build.
                       This directory is shared as a volume with the container
     :param container_name: used to give a name to the container for later reference
     :param exposed_ports: if not None, starting at 8069, ports will be exposed as exposed_ports numbers
+    :param image: tag of the image to run, by default the one of the current Dockerfile
     """
     # build cmd
     cmd_chain = []
@@ -83,23 +154,106 @@ def docker_run(odoo_cmd, log_path, build_dir, container_name, exposed_ports=None
             docker_command.extend(['-p', '127.0.0.1:%s:%s' % (hp, dp)])
     if cpu_limit:
         docker_command.extend(['--ulimit', 'cpu=%s' % int(cpu_limit)])
-    docker_command.extend(['odoo:runbot_tests', '/bin/bash', '-c', "%s" % run_cmd])
+    docker_command.extend([image or docker_image_tag()[1], '/bin/bash', '-c', "%s" % run_cmd])
     docker_run = subprocess.Popen(docker_command, stdout=logs, stderr=logs, preexec_fn=preexec_fn, close_fds=False, cwd=build_dir)
+    with _container_states_lock:
+        _container_states[container_name] = {'running': True, 'started_at': time.time(), 'exit_code': None, 'finished_at': None}
     _logger.info('Started Docker container %s', container_name)
     return docker_run.pid
 
-def docker_stop(container_name):
-    """Stops the container named container_name"""
+def docker_stop(container_name, wait=True, timeout=10):
+    """Stops the container named container_name
+    :param wait: wait for the container to be stopped, otherwise return as soon as the stop is requested
+    :param timeout: seconds before the container is killed
+    """
     _logger.info('Stopping container %s', container_name)
-    dstop = subprocess.run(['docker', 'stop', container_name])
+    client = get_docker_client()
+    if client:
+        try:
+            client.container_stop(container_name, timeout=timeout, wait=wait)
+            if wait:
+                docker_record_exit(container_name)
+            return
+        except DOCKER_API_ERRORS as e:
+            _logger.warning('Docker API stop failed, using the CLI: %s', e)
+    if wait:
+        dstop = subprocess.run(['docker', 'stop', '--time', str(timeout), container_name])
+        docker_record_exit(container_name)
+    else:
+        subprocess.Popen(['docker', 'stop', '--time', str(timeout), container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def docker_refresh_states():
+    """List the running containers once, docker_is_running then answers from memory"""
+    global _container_states_time
+    running = None
+    client = get_docker_client()
+    if client:
+        try:
+            running = client.container_names()
+        except DOCKER_API_ERRORS as e:
+            _logger.warning('Docker API listing failed, using the CLI: %s', e)
+    if running is None:
+        try:
+            dps = subprocess.run(['docker', 'ps', '--no-trunc', '--format', '{{.Names}}'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            dps = None
+        if not dps or dps.returncode != 0:
+            _logger.warning('Cannot list docker containers, inspecting them one by one')
+            _container_states_time = 0
+            return
+        running = set(dps.stdout.decode().split())
+    now = time.time()
+    with _container_states_lock:
+        for name, state in list(_container_states.items()):
+            if name in running:
+                running.discard(name)
+                state['running'] = True
+            elif state['running'] and now - state['started_at'] > START_GRACE:
+                # exited without die event (listener not following the events)
+                state.update(running=False, finished_at=state['finished_at'] or now)
+            elif not state['running'] and now - state['finished_at'] > EXITED_TTL:
+                del _container_states[name]
+        for name in running:
+            # started by a previous process
+            _container_states[name] = {'running': True, 'started_at': now, 'exit_code': None, 'finished_at': None}
+        _container_states_time = now
+
+def docker_record_exit(container_name, exit_code=None, finished_at=None):
+    """Record that container_name exited, e.g. on a docker die event"""
+    with _container_states_lock:
+        state = _container_states.setdefault(container_name, {'started_at': None})
+        state.update(running=False, exit_code=exit_code, finished_at=finished_at or time.time())
+
+def docker_state(container_name):
+    """Return the known state of container_name (see _container_states) or None"""
+    with _container_states_lock:
+        state = _container_states.get(container_name)
+        return dict(state) if state else None
 
 def docker_is_running(container_name):
     """Return True if container is still running"""
+    if time.time() - _container_states_time < STATES_TTL:
+        state = docker_state(container_name)
+        return bool(state and state['running'])
+    client = get_docker_client()
+    if client:
+        try:
+            return client.container_inspect(container_name) is not None
+        except DOCKER_API_ERRORS as e:
+            _logger.warning('Docker API inspect failed, using the CLI: %s', e)
     dinspect = subprocess.run(['docker', 'container', 'inspect', container_name], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
     return True if dinspect.returncode == 0 else False
 
 def docker_get_gateway_ip():
     """Return the host ip of the docker default bridge gateway"""
+    client = get_docker_client()
+    if client:
+        try:
+            return client.network_inspect('bridge')['IPAM']['Config'][0]['Gateway']
+        except KeyError:
+            return None
+        except DOCKER_API_ERRORS as e:
+            _logger.warning('Docker API network inspect failed, using the CLI: %s', e)
     docker_net_inspect = subprocess.run(['docker', 'network', 'inspect', 'bridge'], stdout=subprocess.PIPE)
     if docker_net_inspect.returncode != 0:
         return None
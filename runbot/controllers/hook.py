@@ -6,14 +6,17 @@ import json
 from odoo import http, tools
 from odoo.http import request
 
+from ..listener import CHANNEL_HOOK
+
 
 class RunbotHook(http.Controller):
 
     @http.route(['/runbot/hook/<int:repo_id>', '/runbot/hook/org'], type='http', auth="public", website=True, csrf=False)
     def hook(self, repo_id=None, **post):
+        event = request.httprequest.headers.get("X-Github-Event")
+        payload = json.loads(request.params.get('payload') or '{}')
         if repo_id is None:
-            event = request.httprequest.headers.get("X-Github-Event")
-            repo_data = json.loads(request.params['payload']).get('repository')
+            repo_data = payload.get('repository')
             if repo_data and event in ['push', 'pull_request']:
                 repo_domain = [
                     '|', '|', ('name', '=', repo_data['ssh_url']),
@@ -26,4 +29,8 @@ class RunbotHook(http.Controller):
 
         repo = request.env['runbot.repo'].sudo().browse([repo_id])
         repo.hook_time = datetime.datetime.now().strftime(tools.DEFAULT_SERVER_DATETIME_FORMAT)
+        if repo.exists() and event in ['push', 'pull_request']:
+            request.env['runbot.hook.ref'].sudo()._create_from_payload(repo, event, payload)
+            # wake up the scheduling loop once the transaction is committed
+            request.env.cr.execute("SELECT pg_notify(%s, %s)", [CHANNEL_HOOK, str(repo.id)])
         return ""
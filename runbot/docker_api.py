@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Docker Engine API client
+
+Talks HTTP to the docker daemon over its unix socket, keeping a few idle
+keep-alive connections, instead of spawning a docker CLI process for each
+operation. The helpers of container.py fall back to the CLI when the
+socket is not available.
+"""
+import http.client
+import io
+import json
+import logging
+import os
+import socket
+import tarfile
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+_logger = logging.getLogger(__name__)
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+# oldest API version with all the endpoints used here (docker 1.13)
+API_VERSION = 'v1.25'
+# timeout argument standing for the client timeout, None meaning no timeout
+DEFAULT_TIMEOUT = object()
+
+
+class DockerAPIError(Exception):
+
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__('%s %s' % (status, message))
+        self.status = status
+        self.message = message
+
+
+# errors after which the callers fall back to the docker CLI
+DOCKER_API_ERRORS = (OSError, http.client.HTTPException, ValueError, DockerAPIError)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=60, pool_size=4):
+        """
+        :param socket_path: unix socket of the docker daemon
+        :param timeout: socket timeout in seconds of the requests
+        :param pool_size: maximum number of idle connections kept open
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.pool = []
+
+    def _get_connection(self, timeout):
+        with self.lock:
+            conn = self.pool.pop() if self.pool else None
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _put_connection(self, conn, response):
+        """Keep conn for the next requests once response is fully read"""
+        if not response.will_close:
+            with self.lock:
+                if len(self.pool) < self.pool_size:
+                    self.pool.append(conn)
+                    return
+        conn.close()
+
+    def _url(self, path, params=None):
+        url = '/%s%s' % (API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+        return url
+
+    def _send(self, method, path, params=None, body=None, headers=None, timeout=DEFAULT_TIMEOUT):
+        """Send a request and return (connection, response), retrying once on a stale pooled connection"""
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        for attempt in range(2):
+            conn = self._get_connection(timeout)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, self._url(path, params), body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if not reused or attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def _check(self, response):
+        if response.status >= 400:
+            data = response.read()
+            try:
+                message = json.loads(data.decode()).get('message', '')
+            except ValueError:
+                message = data.decode(errors='replace')
+            raise DockerAPIError(response.status, message)
+
+    def request(self, method, path, params=None, body=None, headers=None, timeout=DEFAULT_TIMEOUT):
+        """Return the decoded JSON body of the response, None if empty. Raise DockerAPIError on error statuses."""
+        conn, response = self._send(method, path, params=params, body=body, headers=headers, timeout=timeout)
+        try:
+            self._check(response)
+            data = response.read()
+        except DockerAPIError:
+            self._put_connection(conn, response)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        self._put_connection(conn, response)
+        return json.loads(data.decode()) if data else None
+
+    def stream(self, method, path, params=None, body=None, headers=None, timeout=DEFAULT_TIMEOUT):
+        """Yield the chunks of the response body as they arrive"""
+        conn, response = self._send(method, path, params=params, body=body, headers=headers, timeout=timeout)
+        # streamed responses never go back to the pool, the generator may not be consumed
+        try:
+            self._check(response)
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
+
+    def ping(self):
+        try:
+            conn, response = self._send('GET', '/_ping', timeout=5)
+        except OSError:
+            return False
+        ok = response.status == 200
+        response.read()
+        self._put_connection(conn, response)
+        return ok
+
+    def container_inspect(self, name):
+        """Return the container description, None if it does not exist"""
+        try:
+            return self.request('GET', '/containers/%s/json' % quote(name))
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def container_names(self):
+        """Return the names of the running containers"""
+        return {name.lstrip('/') for container in self.request('GET', '/containers/json') for name in container['Names']}
+
+    def container_stop(self, name, timeout=10, wait=True):
+        """Stop the container, killing it after timeout seconds.
+
+        Unless wait is set, the request is sent from a thread and the call returns immediately.
+        """
+        def stop():
+            try:
+                # 304: already stopped
+                self.request('POST', '/containers/%s/stop' % quote(name), params={'t': timeout}, timeout=timeout + self.timeout)
+            except DockerAPIError as e:
+                if e.status != 404:
+                    _logger.warning('Cannot stop container %s: %s', name, e)
+            except OSError as e:
+                _logger.warning('Cannot stop container %s: %s', name, e)
+        if wait:
+            stop()
+        else:
+            threading.Thread(target=stop, name='docker stop %s' % name, daemon=True).start()
+
+    def network_inspect(self, name):
+        return self.request('GET', '/networks/%s' % quote(name))
+
+    def image_exists(self, tag):
+        try:
+            self.request('GET', '/images/%s/json' % quote(tag))
+        except DockerAPIError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def image_build(self, context_dir, tag, log):
+        """Build the image tagged tag from context_dir, writing the build output to the file object log.
+        Return True if the build succeeded."""
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            tar.add(context_dir, arcname='.')
+        success = True
+        buffer = b''
+        for chunk in self.stream('POST', '/build', params={'t': tag, 'rm': 1}, body=context.getvalue(),
+                                 headers={'Content-Type': 'application/x-tar'}, timeout=None):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if not line.strip():
+                    continue
+                message = json.loads(line.decode())
+                if 'error' in message:
+                    success = False
+                    log.write(message['error'] + '\n')
+                elif 'stream' in message:
+                    log.write(message['stream'])
+        log.flush()
+        return success
+
+
+_client = None
+_client_lock = threading.Lock()
+# do not probe an unusable socket again before this time
+_client_retry = 0
+CLIENT_RETRY = 60
+
+
+def get_docker_client():
+    """Return the shared DockerClient, None if the docker socket is not usable"""
+    global _client, _client_retry
+    with _client_lock:
+        if _client is None and time.time() > _client_retry:
+            client = DockerClient()
+            if os.access(DOCKER_SOCKET, os.R_OK | os.W_OK) and client.ping():
+                _client = client
+            else:
+                _logger.warning('Docker socket %s is not usable, using the docker CLI', DOCKER_SOCKET)
+                _client_retry = time.time() + CLIENT_RETRY
+        return _client
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Host-local cache of git exports
+
+Each git tree is extracted once in a directory named after its sha, build
+directories are then materialized from it with reflink copies (plain copies
+on filesystems without reflinks) or, opt-in, with hardlinks. The cached files
+are read-only so that a build cannot alter them through a hardlink, except
+when running as root.
+
+Each entry has its own lock file: an entry is extracted under an exclusive
+lock and copied under a shared one, so builds of different trees, or of the
+same cached tree, do not wait for each other. Entries are evicted in least
+recently used order when the total size of the cache exceeds its budget,
+skipping the entries in use.
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import subprocess
+
+_logger = logging.getLogger(__name__)
+
+COPY_OPTIONS = {
+    'reflink': ['--reflink=auto'],
+    'hardlink': ['--link'],
+}
+
+# cache directory: True if its filesystem supports reflinks, --reflink=auto does a plain copy otherwise
+_reflink_support = {}
+
+
+def _make_read_only(path):
+    """Remove the write permission of the files under path, return their total size"""
+    size = 0
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                st = os.stat(file_path)
+                os.chmod(file_path, st.st_mode & ~write_bits)
+                size += st.st_size
+    return size
+
+
+class ExportCache(object):
+
+    def __init__(self, cache_dir, max_size, mode='reflink'):
+        """
+        :param cache_dir: directory of the cache, must be on the same filesystem as the build directories
+        :param max_size: cache budget in bytes
+        :param mode: 'reflink' or 'hardlink'
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.mode = mode
+
+    def _supports_reflink(self):
+        if self.cache_dir not in _reflink_support:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            probe = os.path.join(self.cache_dir, '.reflink-probe-%s' % os.getpid())
+            try:
+                with open(probe, 'w') as f:
+                    f.write('probe')
+                result = subprocess.run(['cp', '--reflink=always', probe, probe + '.copy'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                _reflink_support[self.cache_dir] = result.returncode == 0
+            finally:
+                for path in (probe, probe + '.copy'):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return _reflink_support[self.cache_dir]
+
+    def _lock_path(self, tree=None):
+        return os.path.join(self.cache_dir, '.%s.lock' % tree if tree else '.lock')
+
+    @contextlib.contextmanager
+    def _lock(self, tree=None, operation=fcntl.LOCK_EX):
+        """Hold a flock on the lock file of the tree entry, or of the whole cache if tree is None"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        lock_path = self._lock_path(tree)
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, operation)
+                # the lock file is removed with its entry, it may have been evicted while waiting
+                if os.path.exists(lock_path) and os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+        try:
+            yield
+        finally:
+            lock_file.close()
+
+    def _entries(self):
+        """Return a list of (last use time, size, path) of the cache entries"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            size_path = path + '.size'
+            if name.startswith('.') or not os.path.isdir(path) or not os.path.isfile(size_path):
+                continue
+            try:
+                with open(size_path) as f:
+                    size = int(f.read() or 0)
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                # evicted meanwhile
+                continue
+        return entries
+
+    def _remove_entry(self, entry):
+        if os.path.isfile(entry + '.size'):
+            os.remove(entry + '.size')
+        if os.path.isdir(entry):
+            # read-only files can be removed, only the directories need to be writable
+            shutil.rmtree(entry)
+
+    def _evict(self, keep):
+        with self._lock():
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                tree = os.path.basename(path)
+                try:
+                    with self._lock(tree, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                        _logger.info('export cache: evicting %s (%s bytes)', path, size)
+                        self._remove_entry(path)
+                        os.remove(self._lock_path(tree))
+                except BlockingIOError:
+                    # being extracted or copied
+                    continue
+                total -= size
+
+    def materialize(self, tree, dest, extract):
+        """Populate dest with the content of tree.
+
+        :param tree: sha of the git tree, used as cache key
+        :param extract: function extracting the tree in the directory given as parameter
+        :return: dict with 'hit' (True if the tree was already cached),
+                 'bytes' (number of bytes extracted or copied) and 'shared'
+                 (number of bytes reflinked or hardlinked from the cache)
+        """
+        stats = {'hit': True, 'bytes': 0, 'shared': 0}
+        entry = os.path.join(self.cache_dir, tree)
+        while True:
+            with self._lock(tree, fcntl.LOCK_SH):
+                if os.path.isfile(entry + '.size'):
+                    os.utime(entry)
+                    os.makedirs(dest, exist_ok=True)
+                    subprocess.check_call(['cp', '-a', '--remove-destination'] + COPY_OPTIONS[self.mode] + [entry + '/.', dest])
+                    if self.mode != 'hardlink':
+                        subprocess.check_call(['chmod', '-R', 'u+w', dest])
+                    with open(entry + '.size') as f:
+                        size = int(f.read() or 0)
+                    if self.mode == 'hardlink' or self._supports_reflink():
+                        stats['shared'] += size
+                    else:
+                        stats['bytes'] += size
+                    return stats
+            with self._lock(tree, fcntl.LOCK_EX):
+                if not os.path.isfile(entry + '.size'):
+                    stats['hit'] = False
+                    tmp_entry = '%s.tmp-%s' % (entry, os.getpid())
+                    if os.path.isdir(tmp_entry):
+                        shutil.rmtree(tmp_entry)
+                    self._remove_entry(entry)
+                    os.makedirs(tmp_entry)
+                    extract(tmp_entry)
+                    size = _make_read_only(tmp_entry)
+                    os.rename(tmp_entry, entry)
+                    with open(entry + '.size', 'w') as f:
+                        f.write(str(size))
+                    stats['bytes'] = size
+            if not stats['hit']:
+                self._evict(keep=entry)
+            # copy under the shared lock
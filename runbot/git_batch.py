@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Long-lived git cat-file processes
+
+Each bare repository gets a `git cat-file --batch-check` and a
+`git cat-file --batch` process, started on first use, that answer object
+queries (existence, ref resolution, commit metadata) over a pipe instead
+of forking a new git process for each query.
+
+The processes must be restarted with reset_git_batch when the repository
+has been fetched, otherwise new packs may not be seen.
+"""
+import logging
+import subprocess
+import threading
+
+_logger = logging.getLogger(__name__)
+
+_batches = {}
+_batches_lock = threading.Lock()
+
+
+class GitBatchError(Exception):
+    pass
+
+
+class GitBatch(object):
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.lock = threading.Lock()
+        self.procs = {}
+
+    def _get_proc(self, mode):
+        proc = self.procs.get(mode)
+        if proc is not None and proc.poll() is not None:
+            self._close_proc(mode)
+            proc = None
+        if proc is None:
+            _logger.debug('starting git cat-file %s in %s', mode, self.git_dir)
+            proc = subprocess.Popen(
+                ['git', '--git-dir=%s' % self.git_dir, 'cat-file', mode],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.procs[mode] = proc
+        return proc
+
+    def _query(self, mode, obj):
+        """Send obj to the cat-file process and return (header, content)
+        header is None when obj is missing or ambiguous, content is only read in --batch mode"""
+        if not obj or '\n' in obj:
+            raise ValueError('Invalid object name %r' % obj)
+        with self.lock:
+            for attempt in (1, 2):
+                proc = self._get_proc(mode)
+                try:
+                    proc.stdin.write(obj.encode('utf-8') + b'\n')
+                    proc.stdin.flush()
+                    header = proc.stdout.readline().decode('utf-8')
+                    if not header:
+                        raise GitBatchError('git cat-file %s exited in %s' % (mode, self.git_dir))
+                    header = header.rstrip('\n').split(' ')
+                    if header[-1] in ('missing', 'ambiguous'):
+                        return None, None
+                    content = None
+                    if mode == '--batch':
+                        content = proc.stdout.read(int(header[2]))
+                        proc.stdout.read(1)  # trailing newline
+                    return header, content
+                except (OSError, ValueError, IndexError, GitBatchError):
+                    self._close_proc(mode)
+                    if attempt == 2:
+                        raise GitBatchError('git cat-file %s failed on %s in %s' % (mode, obj, self.git_dir))
+
+    def exists(self, obj):
+        """Return True if obj can be found in the repository"""
+        header, _ = self._query('--batch-check', obj)
+        return header is not None
+
+    def resolve(self, obj):
+        """Return the sha of obj like rev-parse, or None if it does not exist"""
+        header, _ = self._query('--batch-check', obj)
+        return header[0] if header else None
+
+    def commit_info(self, obj):
+        """Return a dict describing the commit pointed by obj, or None if it does not exist"""
+        header, content = self._query('--batch', '%s^{commit}' % obj)
+        if header is None:
+            return None
+        info = {'sha': header[0], 'parents': []}
+        headers, _, message = content.decode('utf-8', 'replace').partition('\n\n')
+        for line in headers.split('\n'):
+            key, _, value = line.partition(' ')
+            if key == 'parent':
+                info['parents'].append(value)
+            elif key in ('tree', 'author', 'committer'):
+                info[key] = value
+        info['subject'] = message.split('\n', 1)[0]
+        return info
+
+    def _close_proc(self, mode):
+        proc = self.procs.pop(mode, None)
+        if proc is not None:
+            try:
+                proc.stdin.close()
+                proc.wait(timeout=5)
+            except Exception:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+    def close(self):
+        with self.lock:
+            for mode in list(self.procs):
+                self._close_proc(mode)
+
+
+def get_git_batch(git_dir):
+    """Return the GitBatch of the repository git_dir"""
+    with _batches_lock:
+        if git_dir not in _batches:
+            _batches[git_dir] = GitBatch(git_dir)
+        return _batches[git_dir]
+
+
+def reset_git_batch(git_dir):
+    """Stop the cat-file processes of git_dir, they will be restarted on next use"""
+    with _batches_lock:
+        batch = _batches.pop(git_dir, None)
+    if batch:
+        batch.close()
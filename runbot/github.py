@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Shared github API client
+
+Keeps one pooled keep-alive session per (host, token), caches GET responses
+with their ETag to make conditional requests (a 304 does not count in the
+github rate limit) and throttles itself according to the X-RateLimit-*
+headers of the responses.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+import requests
+from urllib.parse import urlparse
+
+_logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class GithubClient(object):
+
+    def __init__(self, min_remaining=100, max_delay=10, cache_size=2000):
+        """
+        :param min_remaining: below this number of remaining requests, calls are delayed
+                              to spread the remaining budget until the rate limit reset
+        :param max_delay: maximum delay in seconds added before a call
+        :param cache_size: maximum number of cached GET responses
+        """
+        self.min_remaining = min_remaining
+        self.max_delay = max_delay
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.cache = collections.OrderedDict()  # (token, url): (etag, data)
+        self.rate_limits = {}  # (host, token): {'limit': int, 'remaining': int, 'reset': timestamp}
+
+    def _session(self, host, token):
+        with self.lock:
+            key = (host, token)
+            if key not in self.sessions:
+                session = requests.Session()
+                session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                session.auth = (token, 'x-oauth-basic')
+                session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
+                self.sessions[key] = session
+            return self.sessions[key]
+
+    def _throttle(self, host, token):
+        rate_limit = self.rate_limits.get((host, token))
+        if not rate_limit:
+            return
+        wait = rate_limit['reset'] - time.time()
+        if wait <= 0 or rate_limit['remaining'] >= self.min_remaining:
+            return
+        if rate_limit['remaining'] <= 0:
+            raise RateLimitExceeded('Github rate limit exceeded on %s, reset in %ss' % (host, int(wait)))
+        delay = min(wait / rate_limit['remaining'], self.max_delay)
+        _logger.debug('Github rate limit: %s requests remaining on %s, waiting %.2fs', rate_limit['remaining'], host, delay)
+        time.sleep(delay)
+
+    def _update_rate_limit(self, host, token, response):
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        rate_limit = {
+            'limit': int(headers.get('X-RateLimit-Limit', 0)),
+            'remaining': int(headers['X-RateLimit-Remaining']),
+            'reset': int(headers.get('X-RateLimit-Reset', 0)),
+        }
+        self.rate_limits[(host, token)] = rate_limit
+        if rate_limit['remaining'] < self.min_remaining:
+            _logger.warning('Github rate limit: %s/%s requests remaining on %s', rate_limit['remaining'], rate_limit['limit'], host)
+
+    def request(self, url, token, payload=None):
+        """Send a request to the github API and return the decoded json response.
+        A POST is sent if payload is given, otherwise a (conditional) GET"""
+        host = urlparse(url).netloc
+        session = self._session(host, token)
+        self._throttle(host, token)
+        if payload:
+            response = session.post(url, data=json.dumps(payload))
+        else:
+            cache_key = (token, url)
+            cached = self.cache.get(cache_key)
+            headers = {'If-None-Match': cached[0]} if cached else {}
+            response = session.get(url, headers=headers)
+        self._update_rate_limit(host, token, response)
+
+        if not payload and response.status_code == 304 and cached:
+            with self.lock:
+                self.cache.move_to_end(cache_key)
+            return cached[1]
+        response.raise_for_status()
+        data = response.json()
+        if not payload and response.headers.get('ETag'):
+            with self.lock:
+                self.cache[cache_key] = (response.headers['ETag'], data)
+                self.cache.move_to_end(cache_key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return data
+
+    def get_rate_limit(self, host, token):
+        """Return the last known rate limit budget of token on host, None if unknown"""
+        return self.rate_limits.get((host, token))
+
+
+github_client = GithubClient()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Wake up the runbot loops as soon as there is something to do
+
+Like the odoo bus, a dedicated connection LISTENs on postgres channels and
+the loops select() on it instead of sleeping. The builder loop also follows
+`docker events` to be woken when a build container exits, the exits are
+recorded in the container states cache.
+"""
+import logging
+import os
+import select
+import subprocess
+import time
+
+import odoo
+
+from .container import docker_record_exit
+
+_logger = logging.getLogger(__name__)
+
+# new pending build or kill request, NOTIFY'ed by a trigger on runbot_build
+CHANNEL_BUILD = 'runbot_build'
+# github hook received
+CHANNEL_HOOK = 'runbot_hook'
+# github commit status queued
+CHANNEL_STATUS = 'runbot_status'
+# container exited, not a postgres channel
+CHANNEL_DOCKER = 'docker'
+
+DOCKER_EVENTS_RETRY = 60
+
+
+class Listener(object):
+
+    def __init__(self, dbname, channels, docker_events=False):
+        """
+        :param dbname: database sending the notifications
+        :param channels: postgres channels to listen to
+        :param docker_events: also wake up when a container dies
+        """
+        self.cr = odoo.sql_db.db_connect(dbname).cursor()
+        self.cr.autocommit(True)
+        for channel in channels:
+            self.cr.execute('LISTEN %s' % channel)
+        self.conn = self.cr._cnx
+        self.docker_events = docker_events
+        self.docker_proc = None
+        self.docker_retry = 0
+        self.docker_buffer = b''
+
+    def _docker_fd(self):
+        if not self.docker_events:
+            return None
+        if self.docker_proc is None and time.time() > self.docker_retry:
+            try:
+                self.docker_proc = subprocess.Popen(
+                    ['docker', 'events', '--filter', 'type=container', '--filter', 'event=die',
+                     '--format', '{{.Actor.Attributes.name}} {{.Actor.Attributes.exitCode}} {{.Time}}'],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except OSError:
+                _logger.warning('Cannot follow docker events')
+                self.docker_retry = time.time() + DOCKER_EVENTS_RETRY
+        return self.docker_proc.stdout.fileno() if self.docker_proc else None
+
+    def _close_docker(self):
+        if self.docker_proc:
+            self.docker_proc.kill()
+            self.docker_proc.wait()
+            self.docker_proc.stdout.close()
+            self.docker_proc = None
+            self.docker_buffer = b''
+
+    def _read_docker_events(self, data):
+        self.docker_buffer += data
+        *lines, self.docker_buffer = self.docker_buffer.split(b'\n')
+        for line in lines:
+            try:
+                name, exit_code, finished_at = line.decode().split()
+                docker_record_exit(name, int(exit_code), int(finished_at))
+            except ValueError:
+                _logger.warning('Unexpected docker event %r', line)
+
+    def wait(self, timeout):
+        """Wait for a notification at most timeout seconds, return the set of notified channels"""
+        docker_fd = self._docker_fd()
+        fds = [self.conn] + ([docker_fd] if docker_fd is not None else [])
+        channels = set()
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except InterruptedError:
+            return channels
+        if self.conn in readable:
+            self.conn.poll()
+            while self.conn.notifies:
+                channels.add(self.conn.notifies.pop().channel)
+        if docker_fd is not None and docker_fd in readable:
+            data = os.read(docker_fd, 65536)
+            if data:
+                self._read_docker_events(data)
+                channels.add(CHANNEL_DOCKER)
+            else:
+                _logger.warning('docker events exited, retrying in %ss', DOCKER_EVENTS_RETRY)
+                self._close_docker()
+                self.docker_retry = time.time() + DOCKER_EVENTS_RETRY
+        return channels
+
+    def close(self):
+        self._close_docker()
+        self.cr.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Summarize the log of a test job in a single streaming pass
+
+The summary is saved next to the log with the offset of the last analyzed
+line, so the log of a running job can be analyzed incrementally and the
+final analysis only reads the lines written since the previous one.
+"""
+import json
+import logging
+import os
+import re
+
+_logger = logging.getLogger(__name__)
+
+# matched on each line independently of the logger name
+_re_error = re.compile(rb'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$')
+_re_warning = re.compile(rb'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING ')
+# only used to attribute the lines to the addon logging them
+_re_log_line = re.compile(rb'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ \w+ \S+ (\S+): ')
+_re_addon = re.compile(rb'^(?:odoo|openerp)\.addons\.(\w+)')
+
+MODULES_LOADED = b'.modules.loading: Modules loaded.'
+SHUTDOWN = b'Initiating shutdown.'
+
+
+class LogSummary(object):
+    """Structured summary of an odoo log, offsets are byte offsets in the log"""
+
+    def __init__(self, **state):
+        self.offset = state.get('offset', 0)
+        self.modules_loaded = state.get('modules_loaded', False)
+        self.shutdown = state.get('shutdown', False)
+        self.error_count = state.get('error_count', 0)
+        self.warning_count = state.get('warning_count', 0)
+        self.first_error = state.get('first_error')
+        self.first_warning = state.get('first_warning')
+        # addon name: {'start', 'end', 'errors', 'warnings'} of the lines logged by the addon
+        self.modules = state.get('modules', {})
+        # addon of the last log line, tracebacks are attributed to it
+        self.current_module = state.get('current_module')
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def feed_line(self, line, offset):
+        """Account for a log line starting at offset"""
+        line = line.rstrip(b'\r\n')
+        match = _re_log_line.match(line)
+        if match:
+            addon = _re_addon.match(match.group(1))
+            self.current_module = addon.group(1).decode() if addon else None
+        if not self.modules_loaded and MODULES_LOADED in line:
+            self.modules_loaded = True
+        if not self.shutdown and SHUTDOWN in line:
+            self.shutdown = True
+        is_error = _re_error.search(line) is not None
+        is_warning = _re_warning.match(line) is not None
+
+        if self.current_module:
+            segment = self.modules.setdefault(self.current_module, {'start': offset, 'end': offset, 'errors': 0, 'warnings': 0})
+            segment['end'] = offset
+        else:
+            segment = None
+
+        if is_error:
+            self.error_count += 1
+            if self.first_error is None:
+                self.first_error = offset
+            if segment:
+                segment['errors'] += 1
+        elif is_warning:
+            self.warning_count += 1
+            if self.first_warning is None:
+                self.first_warning = offset
+            if segment:
+                segment['warnings'] += 1
+
+    def feed(self, log_path, final=False):
+        """Analyze the lines of log_path written since the last analyzed one.
+
+        The last line is left for the next call unless it is terminated or final is set.
+        """
+        try:
+            size = os.path.getsize(log_path)
+        except OSError:
+            return self
+        if size < self.offset:
+            # the log was truncated by a new run of the job
+            self.__init__()
+        with open(log_path, 'rb') as f:
+            f.seek(self.offset)
+            offset = self.offset
+            for line in f:
+                if not line.endswith(b'\n') and not final:
+                    break
+                self.feed_line(line, offset)
+                offset += len(line)
+            self.offset = offset
+        return self
+
+
+def _summary_path(log_path):
+    return '%s.summary.json' % log_path
+
+
+def analyze_log(log_path, final=False):
+    """Return the LogSummary of log_path, resuming from the summary saved by the previous call"""
+    summary_path = _summary_path(log_path)
+    state = {}
+    if os.path.exists(summary_path):
+        try:
+            with open(summary_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            _logger.warning('Ignoring unreadable log summary %s', summary_path)
+    summary = LogSummary(**state).feed(log_path, final=final)
+    if os.path.exists(log_path):
+        tmp_path = '%s.tmp' % summary_path
+        with open(tmp_path, 'w') as f:
+            json.dump(summary.to_dict(), f)
+        os.rename(tmp_path, summary_path)
+    return summary
+
+
+def reset_log_summary(log_path):
+    """Forget the saved summary of log_path, to be called when the log is rewritten"""
+    try:
+        os.unlink(_summary_path(log_path))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+def migrate(cr, version):
+    # initialize the log counters maintained by the ir_logging trigger from then on
+    cr.execute("""
+        INSERT INTO runbot_build_log_count (build_id, error_count, critical_count, warning_count)
+            SELECT build_id,
+                   count(*) FILTER (WHERE level = 'ERROR'),
+                   count(*) FILTER (WHERE level = 'CRITICAL'),
+                   count(*) FILTER (WHERE level = 'WARNING')
+              FROM ir_logging
+             WHERE build_id IS NOT NULL
+               AND level IN ('ERROR', 'CRITICAL', 'WARNING')
+          GROUP BY build_id
+        ON CONFLICT (build_id) DO NOTHING;
+    """)
@@ -1,4 +1,4 @@
 # -*- coding: utf-8 -*-
 
-from . import repo, branch, build, event
+from . import repo, branch, build, event, hook_ref, commit_status, build_queue, port_lease
 from . import res_config_settings
\ No newline at end of file
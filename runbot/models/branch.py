@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
 import re
-from subprocess import CalledProcessError
 from odoo import models, fields, api
 
 _logger = logging.getLogger(__name__)
@@ -16,7 +15,7 @@ class runbot_branch(models.Model):
 
     repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade')
     name = fields.Char('Ref Name', required=True)
-    branch_name = fields.Char(compute='_get_branch_infos', string='Branch', readonly=1, store=True)
+    branch_name = fields.Char(compute='_get_branch_infos', string='Branch', readonly=1, store=True, index=True)
     branch_url = fields.Char(compute='_get_branch_url', string='Branch url', readonly=1)
     pull_head_name = fields.Char(compute='_get_branch_infos', string='PR HEAD name', readonly=1, store=True)
     target_branch_name = fields.Char(compute='_get_branch_infos', string='PR target branch', readonly=1, store=True)
@@ -68,18 +67,47 @@ class runbot_branch(models.Model):
     def _is_on_remote(self):
         # check that a branch still exists on remote
         self.ensure_one()
-        branch = self
-        repo = branch.repo_id
-        try:
-            repo._git(['ls-remote', '-q', '--exit-code', repo.name, branch.name])
-        except CalledProcessError:
-            return False
-        return True
+        return self.name in self.repo_id._get_remote_refs()
+
+    @api.model_cr
+    def init(self):
+        # versions of the branches of a repo, see runbot.repo._get_branches_versions
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_branch_repo_write_date_index
+                ON runbot_branch (repo_id, write_date)
+        """)
 
     def create(self, vals):
         vals.setdefault('coverage', _re_coverage.search(vals.get('name') or '') is not None)
         return super(runbot_branch, self).create(vals)
 
+    def _create_batch(self, repo_id, names):
+        """Create the branches named names in repo_id with a single multi-row insert.
+        Return the recordset of created branches, existing ones are ignored"""
+        if not names:
+            return self.browse()
+        defaults = self.default_get(['job_type', 'priority'])
+        self.env.cr.execute("""
+            INSERT INTO runbot_branch (repo_id, name, coverage, job_type, priority, create_uid, create_date, write_uid, write_date)
+                 SELECT %(repo_id)s, t.name, t.coverage, %(job_type)s, %(priority)s, %(uid)s, %(now)s, %(uid)s, %(now)s
+                   FROM unnest(%(names)s::varchar[], %(coverages)s::boolean[]) AS t (name, coverage)
+            ON CONFLICT DO NOTHING
+              RETURNING id
+        """, {
+            'repo_id': repo_id,
+            'names': list(names),
+            'coverages': [_re_coverage.search(name) is not None for name in names],
+            'job_type': defaults.get('job_type'),
+            'priority': defaults.get('priority', False),
+            'uid': self.env.uid,
+            'now': fields.Datetime.now(),
+        })
+        branches = self.browse([row[0] for row in self.env.cr.fetchall()])
+        # compute branch_name, pull_head_name and target_branch_name
+        branches.modified(['name'])
+        branches.recompute()
+        return branches
+
     def _get_branch_quickconnect_url(self, fqdn, dest):
         self.ensure_one()
         r = {}
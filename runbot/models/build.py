@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import collections
+import functools
 import glob
+import hashlib
+import json
 import logging
 import operator
 import os
@@ -9,35 +13,105 @@ import shlex
 import shutil
 import signal
 import subprocess
+import threading
 import time
 from subprocess import CalledProcessError
-from ..common import dt2time, fqdn, now, grep, time2str, rfind, uniq_list, local_pgadmin_cursor, get_py_version
-from ..container import docker_build, docker_run, docker_stop, docker_is_running, docker_get_gateway_ip
+from ..common import dt2time, fqdn, now, grep, uniq_list, local_pgadmin_cursor, get_py_version
+from ..container import docker_build, docker_run, docker_stop, docker_is_running, docker_state, docker_get_gateway_ip
+from ..listener import CHANNEL_BUILD
+from ..log_analyzer import analyze_log, reset_log_summary
 from odoo import models, fields, api
 from odoo.exceptions import UserError
 from odoo.http import request
 from odoo.tools import config, appdirs
 
-_re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$'
-_re_warning = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING '
 re_job = re.compile('_job_\d')
 
 _logger = logging.getLogger(__name__)
 
+# (branch id, target repo ids, branches versions of target repos): (expiration time, closest branch)
+# The branches versions invalidate the entries when branches are created or deleted,
+# the expiration bounds the staleness of the remote checks (PR state, branch still on remote)
+_closest_branch_cache = collections.OrderedDict()
+_closest_branch_cache_lock = threading.Lock()
+CLOSEST_BRANCH_CACHE_SIZE = 2000
+CLOSEST_BRANCH_CACHE_TTL = 600
 
-def runbot_job(*accepted_job_types):
-    """ Decorator for runbot_build _job_x methods to filter build jobs """
+
+# runbot.build class: (ordered job names, {job name: names of the jobs it depends on, directly or not}),
+# the classes are rebuilt when the registry is reloaded
+_job_pipelines = {}
+
+
+def runbot_job(*accepted_job_types, depends=None, resources=()):
+    """ Decorator for runbot_build _job_x methods to filter build jobs
+
+    :param depends: names of the jobs that must be finished before this one,
+                    by default the previous job in name order
+    :param resources: what the job holds until it is finished, 'container' for
+                      the jobs starting a docker container. A container job starts
+                      as soon as the jobs it depends on are finished, alongside
+                      the containers of the jobs before it.
+    """
     accepted_job_types += ('all', )
 
     def job_decorator(func):
+        @functools.wraps(func)
         def wrapper(self, build, log_path):
             if build.job_type == 'none' or build.job_type not in accepted_job_types:
                 build._log(func.__name__, 'Skipping job')
                 return -2
             return func(self, build, log_path)
+        wrapper.runbot_job = {
+            'job_types': accepted_job_types,
+            'depends': None if depends is None else tuple(depends),
+            'resources': tuple(resources),
+        }
         return wrapper
     return job_decorator
 
+
+def _resolve_depends(jobs):
+    """Return {name: set of the names of the jobs it directly depends on} for jobs ({name: runbot_job attributes})"""
+    names = sorted(jobs)
+    depends = {}
+    for index, name in enumerate(names):
+        job_depends = jobs[name]['depends']
+        if job_depends is None:
+            job_depends = names[index - 1:index]
+        missing = set(job_depends) - set(names)
+        if missing:
+            raise ValueError('Job %s depends on unknown jobs %s' % (name, ', '.join(sorted(missing))))
+        depends[name] = set(job_depends)
+    return depends
+
+
+def _sort_jobs(jobs):
+    """Return the job names of jobs ({name: runbot_job attributes}) in execution order.
+
+    Among the jobs whose dependencies are finished, the ones without container
+    run first so that they do not wait for an unrelated container job.
+    """
+    depends = _resolve_depends(jobs)
+    ordered = []
+    while depends:
+        ready = [name for name, job_depends in depends.items() if not job_depends - set(ordered)]
+        if not ready:
+            raise ValueError('Circular dependency between jobs %s' % ', '.join(sorted(depends)))
+        name = min(ready, key=lambda name: ('container' in jobs[name]['resources'], name))
+        ordered.append(name)
+        del depends[name]
+    return ordered
+
+
+def _all_depends(jobs, ordered):
+    """Return {name: set of the names of the jobs it depends on, directly or not}"""
+    depends = _resolve_depends(jobs)
+    all_depends = {}
+    for name in ordered:
+        all_depends[name] = set(depends[name]).union(*(all_depends[dep] for dep in depends[name]))
+    return all_depends
+
 class runbot_build(models.Model):
 
     _name = "runbot.build"
@@ -45,7 +119,7 @@ class runbot_build(models.Model):
 
     branch_id = fields.Many2one('runbot.branch', 'Branch', required=True, ondelete='cascade', index=True)
     repo_id = fields.Many2one(related='branch_id.repo_id', readonly=True, store=True)
-    name = fields.Char('Revno', required=True)
+    name = fields.Char('Revno', required=True, index=True)
     host = fields.Char('Host')
     port = fields.Integer('Port')
     dest = fields.Char(compute='_get_dest', type='char', string='Dest', readonly=1, store=True)
@@ -60,14 +134,25 @@ class runbot_build(models.Model):
     modules = fields.Char("Modules to Install")
     result = fields.Char('Result', default='')  # ok, ko, warn, skipped, killed, manually_killed
     guess_result = fields.Char(compute='_guess_result')
+    # read from runbot_build_log_count, maintained by the ir_logging insert trigger, see runbot_event.init
+    log_error_count = fields.Integer('Errors', compute='_get_log_counts')
+    log_critical_count = fields.Integer('Criticals', compute='_get_log_counts')
+    log_warning_count = fields.Integer('Warnings', compute='_get_log_counts')
     pid = fields.Integer('Pid')
     state = fields.Char('Status', default='pending')  # pending, testing, running, done, duplicate, deathrow
+    # maintained by the runbot_build_queue_date trigger, see init
+    queue_date = fields.Datetime('Queued since', readonly=True, copy=False)
     job = fields.Char('Job')  # job_*
     job_start = fields.Datetime('Job start')
     job_end = fields.Datetime('Job end')
     job_time = fields.Integer(compute='_get_time', string='Job time')
     job_age = fields.Integer(compute='_get_age', string='Job age')
+    running_jobs = fields.Text('Running jobs', copy=False, readonly=True,
+                               help="JSON of the start time of the jobs whose container is running, by job name")
     duplicate_id = fields.Many2one('runbot.build', 'Corresponding Build')
+    fingerprint = fields.Char('Fingerprint', index=True, readonly=True, help="Hash of the commit and of the closest branches of the dependencies")
+    duplicate_check = fields.Boolean('Duplicate check pending', copy=False, readonly=True,
+                                     help="Created in batch, not scheduled until the duplicate detection ran")
     server_match = fields.Selection([('builtin', 'This branch includes Odoo server'),
                                      ('exact', 'branch/PR exact name'),
                                      ('prefix', 'branch whose name is a prefix of current one'),
@@ -89,6 +174,7 @@ class runbot_build(models.Model):
                                    ],
                                   default='normal',
                                   string='Build type')
+    docker_image = fields.Char('Docker image', copy=False, help="Tag of the docker image the build ran on")
     job_type = fields.Selection([
         ('testing', 'Testing jobs only'),
         ('running', 'Running job only'),
@@ -97,6 +183,64 @@ class runbot_build(models.Model):
         ],
     )
 
+    @api.model_cr
+    def init(self):
+        # log counters of the builds, out of runbot_build so that the logging
+        # of a build never updates the build rows written by the scheduler
+        self._cr.execute("""
+CREATE TABLE IF NOT EXISTS runbot_build_log_count (
+    build_id integer PRIMARY KEY REFERENCES runbot_build(id) ON DELETE CASCADE,
+    error_count integer NOT NULL DEFAULT 0,
+    critical_count integer NOT NULL DEFAULT 0,
+    warning_count integer NOT NULL DEFAULT 0
+);
+        """)
+        # wake up the builder loops when there is a new build to schedule or to kill
+        self._cr.execute("""
+CREATE OR REPLACE FUNCTION runbot_notify_build() RETURNS TRIGGER AS $$
+BEGIN
+  IF (TG_OP = 'INSERT' OR old.state IS DISTINCT FROM new.state) THEN
+    PERFORM pg_notify('%(channel)s', new.state);
+  END IF;
+RETURN NULL;
+END;
+$$ language plpgsql;
+
+DO $$
+BEGIN
+    CREATE TRIGGER runbot_build_notify
+    AFTER INSERT OR UPDATE OF state ON runbot_build
+    FOR EACH ROW
+    WHEN (new.state IN ('pending', 'deathrow'))
+    EXECUTE PROCEDURE runbot_notify_build();
+EXCEPTION
+    WHEN duplicate_object THEN
+END;
+$$;
+
+-- the waiting time in the queue starts when the build becomes pending
+CREATE OR REPLACE FUNCTION runbot_set_queue_date() RETURNS TRIGGER AS $$
+BEGIN
+  IF (TG_OP = 'INSERT' OR old.state IS DISTINCT FROM new.state) THEN
+    new.queue_date := now() at time zone 'UTC';
+  END IF;
+RETURN new;
+END;
+$$ language plpgsql;
+
+DO $$
+BEGIN
+    CREATE TRIGGER runbot_build_queue_date
+    BEFORE INSERT OR UPDATE OF state ON runbot_build
+    FOR EACH ROW
+    WHEN (new.state = 'pending')
+    EXECUTE PROCEDURE runbot_set_queue_date();
+EXCEPTION
+    WHEN duplicate_object THEN
+END;
+$$;
+        """ % {'channel': CHANNEL_BUILD})
+
     def copy(self, values=None):
         raise UserError("Cannot duplicate build!")
 
@@ -108,35 +252,127 @@ class runbot_build(models.Model):
         extra_info = {'sequence': build_id.id if not build_id.sequence else build_id.sequence}
         job_type = vals['job_type'] if 'job_type' in vals else build_id.branch_id.job_type
         extra_info.update({'job_type': job_type})
-        context = self.env.context
-
-        if not context.get('force_rebuild'):
-            # detect duplicate
-            duplicate_id = None
-            domain = [
-                ('repo_id', '=', build_id.repo_id.duplicate_id.id),
-                ('name', '=', build_id.name),
-                ('duplicate_id', '=', False),
-                '|', ('result', '=', False), ('result', '!=', 'skipped')
-            ]
-            # TODO xdo extract build_id._get_closest_branch_name(extra_repo.id) here
-            for duplicate in self.search(domain, limit=10):
-                duplicate_id = duplicate.id
-                # Consider the duplicate if its closest branches are the same than the current build closest branches.
-                for extra_repo in build_id.repo_id.dependency_ids:
-                    build_closest_name = build_id._get_closest_branch_name(extra_repo.id)[1]
-                    duplicate_closest_name = duplicate._get_closest_branch_name(extra_repo.id)[1]
-                    if build_closest_name != duplicate_closest_name:
-                        duplicate_id = None
-                if duplicate_id:
-                    extra_info.update({'state': 'duplicate', 'duplicate_id': duplicate_id})
-                    break
-
         build_id.write(extra_info)
-        if build_id.state == 'duplicate' and build_id.duplicate_id.state in ('running', 'done'):
-            build_id._github_status()
+
+        if not self.env.context.get('force_rebuild'):
+            build_id._check_duplicates()
+        else:
+            build_id._set_fingerprint()
         return build_id
 
+    def _create_batch(self, vals_list):
+        """Create builds with a single multi-row insert.
+
+        Unlike create, duplicates are not detected: the builds of the repos of a
+        duplicate chain are flagged with duplicate_check and left out of the
+        queue until _check_pending_duplicates processes them, once the
+        transaction creating them is committed.
+        """
+        branch_ids = list({vals['branch_id'] for vals in vals_list})
+        branches = {branch.id: branch for branch in self.env['runbot.branch'].browse(branch_ids)}
+        in_chain = {repo.id: repo._in_duplicate_chain() for repo in self.env['runbot.branch'].browse(branch_ids).mapped('repo_id')}
+        defaults = self.default_get(['state', 'result', 'build_type'])
+        now = fields.Datetime.now()
+        rows = []
+        for vals in vals_list:
+            branch = branches[vals['branch_id']]
+            job_type = vals.get('job_type') or branch.job_type
+            if job_type == 'none':
+                continue
+            row = dict(defaults, job_type=job_type, duplicate_check=in_chain[branch.repo_id.id], create_uid=self.env.uid, create_date=now, write_uid=self.env.uid, write_date=now)
+            row.update(vals)
+            rows.append(row)
+        if not rows:
+            return self.browse()
+
+        columns = sorted(set().union(*rows))
+        query = 'INSERT INTO runbot_build (%s) VALUES %s RETURNING id' % (
+            ', '.join('"%s"' % column for column in columns),
+            ', '.join(['%s'] * len(rows)),
+        )
+        self.env.cr.execute(query, [tuple(row.get(column) for column in columns) for row in rows])
+        builds = self.browse([row[0] for row in self.env.cr.fetchall()])
+        self.env.cr.execute("UPDATE runbot_build SET sequence = id WHERE id IN %s AND sequence IS NULL", [tuple(builds.ids)])
+        # compute repo_id and dest
+        builds.modified(['branch_id', 'name'])
+        builds.recompute()
+        return builds
+
+    def _set_fingerprint(self):
+        """Store the fingerprint of the builds, builds with the same fingerprint test the same code.
+
+        Resolving the closest branches is costly, only the builds of the repos
+        of a duplicate chain get a fingerprint. The closest branches are resolved
+        for the dependencies of the whole chain, in the first repo of their own
+        chain, so that the fingerprints of the builds of a chain are comparable.
+        They are resolved once, when the build is created.
+        """
+        target_repo_ids = {}
+        for repo in self.mapped('repo_id'):
+            if repo._in_duplicate_chain():
+                dependencies = repo._get_duplicate_chain().mapped('dependency_ids')
+                target_repo_ids[repo.id] = sorted({min(dependency._get_duplicate_chain().ids) for dependency in dependencies})
+        for build in self:
+            if build.repo_id.id not in target_repo_ids:
+                continue
+            closest_names = [build._get_closest_branch_name(target_repo_id)[1] for target_repo_id in target_repo_ids[build.repo_id.id]]
+            build.fingerprint = hashlib.sha1('\n'.join([build.name] + closest_names).encode('utf-8')).hexdigest()
+
+    def _find_duplicate(self):
+        """Return the id of a build of the duplicate repo that can be used instead of this one"""
+        self.ensure_one()
+        build_id = self
+        domain = [
+            ('repo_id', '=', build_id.repo_id.duplicate_id.id),
+            ('name', '=', build_id.name),
+            ('duplicate_id', '=', False),
+            '|', ('result', '=', False), ('result', '!=', 'skipped')
+        ]
+        duplicate = self.search(domain + [('fingerprint', '=', build_id.fingerprint)], limit=1)
+        if duplicate:
+            return duplicate.id
+
+        # builds created before the fingerprints
+        for duplicate in self.search(domain + [('fingerprint', '=', False)], limit=10):
+            duplicate_id = duplicate.id
+            # Consider the duplicate if its closest branches are the same than the current build closest branches.
+            for extra_repo in build_id.repo_id.dependency_ids:
+                build_closest_name = build_id._get_closest_branch_name(extra_repo.id)[1]
+                duplicate_closest_name = duplicate._get_closest_branch_name(extra_repo.id)[1]
+                if build_closest_name != duplicate_closest_name:
+                    duplicate_id = None
+            if duplicate_id:
+                return duplicate_id
+        return None
+
+    def _check_duplicates(self):
+        """Mark builds as duplicate when an equivalent build exists in the duplicate repo"""
+        self._set_fingerprint()
+        for build in self:
+            if not build.repo_id.duplicate_id:
+                continue
+            duplicate_id = build._find_duplicate()
+            if duplicate_id:
+                build.write({'state': 'duplicate', 'duplicate_id': duplicate_id})
+                if build.duplicate_id.state in ('running', 'done'):
+                    build._github_status()
+
+    @api.model
+    def _check_pending_duplicates(self, limit=500):
+        """Run the duplicate detection and notifications of the builds created by _create_batch"""
+        builds = self.search([('duplicate_check', '=', True)], order='id', limit=limit)
+        # builds skipped by a newer ref in the meantime do not need it anymore
+        for build in builds.filtered(lambda build: build.state == 'pending'):
+            try:
+                with self.env.cr.savepoint():
+                    build._check_duplicates()
+            except Exception:
+                # e.g. github unreachable when resolving the closest branches, build it
+                _logger.exception('%s duplicate detection failed', build.dest)
+                build.invalidate_cache()
+        builds.write({'duplicate_check': False})
+        return builds
+
     def _reset(self):
         self.write({'state': 'pending'})
 
@@ -158,15 +394,11 @@ class runbot_build(models.Model):
         4. Common ancestors (git merge-base)
         Note that PR numbers are replaced by the branch name of the PR target
         to prevent the above rules to mistakenly link PR of different repos together.
+
+        The result is cached until a branch is created or deleted in the target repos.
         """
         self.ensure_one()
-        Branch = self.env['runbot.branch']
-
-        build = self
-        branch, repo = build.branch_id, build.repo_id
-        name = branch.pull_head_name or branch.branch_name
-        target_branch = branch.target_branch_name or 'master'
-
+        branch = self.branch_id
         target_repo = self.env['runbot.repo'].browse(target_repo_id)
 
         target_repo_ids = [target_repo.id]
@@ -177,6 +409,32 @@ class runbot_build(models.Model):
             target_repo_ids.append(r.id)
             r = r.duplicate_id
 
+        versions = self.env['runbot.repo'].browse(target_repo_ids)._get_branches_versions()
+        cache_key = (branch.id, tuple(target_repo_ids), versions)
+        with _closest_branch_cache_lock:
+            cached = _closest_branch_cache.get(cache_key)
+            if cached and cached[0] > time.time():
+                _closest_branch_cache.move_to_end(cache_key)
+                return cached[1]
+
+        closest = self._find_closest_branch_name(target_repo_id, target_repo_ids)
+        with _closest_branch_cache_lock:
+            _closest_branch_cache[cache_key] = (time.time() + CLOSEST_BRANCH_CACHE_TTL, closest)
+            while len(_closest_branch_cache) > CLOSEST_BRANCH_CACHE_SIZE:
+                _closest_branch_cache.popitem(last=False)
+        return closest
+
+    def _find_closest_branch_name(self, target_repo_id, target_repo_ids):
+        """Uncached search of _get_closest_branch_name, target_repo_ids being
+        target_repo_id followed by its duplicate repos"""
+        self.ensure_one()
+        Branch = self.env['runbot.branch']
+
+        build = self
+        branch, repo = build.branch_id, build.repo_id
+        name = branch.pull_head_name or branch.branch_name
+        target_branch = branch.target_branch_name or 'master'
+
         _logger.debug('Search closest of %s (%s) in repos %r', name, repo.name, target_repo_ids)
 
         sort_by_repo = lambda d: (not d['sticky'],      # sticky first
@@ -215,14 +473,15 @@ class runbot_build(models.Model):
                     return (pull.repo_id.id, pull.name, 'exact PR')
 
         # 3. Match a branch which is the dashed-prefix of current branch name
-        branches = Branch.search_read(
-            [('repo_id', 'in', target_repo_ids), ('name', '=like', 'refs/heads/%')],
+        prefixes = [name[:i] for i, char in enumerate(name) if char == '-' and i > 0]
+        branches = prefixes and Branch.search_read(
+            [('repo_id', 'in', target_repo_ids), ('branch_name', 'in', prefixes), ('name', '=like', 'refs/heads/%')],
             fields + ['branch_name'], order='id DESC',
         )
         branches = sorted(branches, key=sort_by_repo)
 
         for branch in branches:
-            if name.startswith(branch['branch_name'] + '-') and self._branch_exists(branch['id']):
+            if self._branch_exists(branch['id']):
                 return result_for(branch, 'prefix')
 
         # 4.Match a PR in enterprise without community PR
@@ -258,22 +517,30 @@ class runbot_build(models.Model):
             else:
                 build.domain = "%s:%s" % (domain, build.port)
 
+    def _get_log_counts(self):
+        counts = {}
+        build_ids = tuple(build.id for build in self if isinstance(build.id, int))
+        if build_ids:
+            self.env.cr.execute("""
+                SELECT build_id, error_count, critical_count, warning_count
+                  FROM runbot_build_log_count
+                 WHERE build_id IN %s
+            """, [build_ids])
+            counts = {row[0]: row[1:] for row in self.env.cr.fetchall()}
+        for build in self:
+            build.log_error_count, build.log_critical_count, build.log_warning_count = counts.get(build.id, (0, 0, 0))
+
+    @api.depends('state', 'result', 'log_error_count', 'log_critical_count', 'log_warning_count')
     def _guess_result(self):
-        cr = self.env.cr
-        cr.execute("""
-            SELECT b.id,
-                   CASE WHEN array_agg(l.level)::text[] && ARRAY['ERROR', 'CRITICAL'] THEN 'ko'
-                        WHEN array_agg(l.level)::text[] && ARRAY['WARNING'] THEN 'warn'
-                        ELSE 'ok'
-                    END
-              FROM runbot_build b
-         LEFT JOIN ir_logging l ON (l.build_id = b.id AND l.level != 'INFO')
-             WHERE b.id = ANY(%s)
-          GROUP BY b.id
-        """, [list(self.filtered(lambda b: b.state == 'testing').ids)])
-        result = {row[0]: row[1] for row in cr.fetchall()}
         for build in self:
-            build.guess_result = result.get(build.id, build.result)
+            if build.state != 'testing':
+                build.guess_result = build.result
+            elif build.log_error_count or build.log_critical_count:
+                build.guess_result = 'ko'
+            elif build.log_warning_count:
+                build.guess_result = 'warn'
+            else:
+                build.guess_result = 'ok'
 
     def _get_time(self):
         """Return the time taken by the tests"""
@@ -385,22 +652,29 @@ class runbot_build(models.Model):
                 self._local_pg_dropdb(db)
 
     def _list_jobs(self):
-        """List methods that starts with _job_[[:digit:]]"""
-        return sorted(job[1:] for job in dir(self) if re_job.match(job))
+        """List the jobs (methods that starts with _job_[[:digit:]]) in execution order"""
+        return self._get_job_pipeline()[0]
+
+    def _get_job_depends(self):
+        """Return {job name: names of the jobs it depends on, directly or not}"""
+        return self._get_job_pipeline()[1]
+
+    def _get_job_pipeline(self):
+        cls = type(self)
+        if cls not in _job_pipelines:
+            jobs = {}
+            for attr in dir(cls):
+                if re_job.match(attr):
+                    # methods without runbot_job decorator run in all job types, after the previous job
+                    jobs[attr[1:]] = getattr(getattr(cls, attr), 'runbot_job', {'depends': None, 'resources': ()})
+            ordered = _sort_jobs(jobs)
+            _job_pipelines[cls] = (ordered, _all_depends(jobs, ordered))
+        return _job_pipelines[cls]
 
     def _find_port(self):
-        # currently used port
-        ids = self.search([('state', 'not in', ['pending', 'done'])])
-        ports = set(i['port'] for i in ids.read(['port']))
-
-        # starting port
-        icp = self.env['ir.config_parameter']
-        port = int(icp.get_param('runbot.runbot_starting_port', default=2000))
-
-        # find next free port
-        while port in ports:
-            port += 3
-        return port
+        """Lease a free port of the current host to the build"""
+        self.ensure_one()
+        return self.env['runbot.port.lease']._acquire(self, fqdn())
 
     def _logger(self, *l):
         l = list(l)
@@ -408,13 +682,28 @@ class runbot_build(models.Model):
             l[0] = "%s %s" % (build.dest, l[0])
             _logger.debug(*l)
 
-    def _get_docker_name(self):
+    def _get_docker_name(self, job=None):
         self.ensure_one()
-        return '%s_%s' % (self.dest, self.job)
+        return '%s_%s' % (self.dest, job or self.env.context.get('runbot_job') or self.job)
+
+    def _get_running_jobs(self):
+        """Return {job name: start timestamp} of the jobs whose container was started and not reaped yet,
+        the start timestamp is None for the jobs after the current one that are already finished"""
+        self.ensure_one()
+        if self.running_jobs:
+            return json.loads(self.running_jobs)
+        if self.state in ('testing', 'running') and self.job:
+            # scheduled before the running jobs were recorded, only the current job can be running
+            return {self.job: dt2time(self.job_start) if self.job_start else time.time()}
+        return {}
+
+    def _set_running_jobs(self, running):
+        self.write({'running_jobs': json.dumps(running)})
 
     def _schedule(self):
         """schedule the build"""
         jobs = self._list_jobs()
+        job_depends = self._get_job_depends()
 
         icp = self.env['ir.config_parameter']
         # For retro-compatibility, keep this parameter in seconds
@@ -426,7 +715,7 @@ class runbot_build(models.Model):
                 continue
             elif build.state == 'pending':
                 # allocate port and schedule first job
-                port = self._find_port()
+                port = build._find_port()
                 values = {
                     'host': fqdn(),
                     'port': port,
@@ -434,65 +723,125 @@ class runbot_build(models.Model):
                     'job': jobs[0],
                     'job_start': now(),
                     'job_end': False,
+                    'running_jobs': json.dumps({}),
                 }
                 build.write(values)
+                running = {}
             else:
-                # check if current job is finished
-                if docker_is_running(build._get_docker_name()):
-                    # kill if overpassed
-                    timeout = (build.branch_id.job_timeout or default_timeout) * 60 * ( build.coverage and 1.5 or 1)
-                    if build.job != jobs[-1] and build.job_time > timeout:
-                        build._logger('%s time exceded (%ss)', build.job, build.job_time)
-                        build.write({'job_end': now()})
-                        build._kill(result='killed')
+                # check if the running jobs are finished, kill the build if one of them overpassed the timeout
+                running = build._get_running_jobs()
+                timeout = (build.branch_id.job_timeout or default_timeout) * 60 * ( build.coverage and 1.5 or 1)
+                killed = False
+                for job in [job for job in jobs if running.get(job)]:
+                    docker_name = build._get_docker_name(job)
+                    if docker_is_running(docker_name):
+                        job_time = int(time.time() - running[job])
+                        if job != jobs[-1] and job_time > timeout:
+                            build._logger('%s time exceded (%ss)', job, job_time)
+                            build.write({'job_end': now()})
+                            build._kill(result='killed')
+                            killed = True
+                            break
+                        if job == 'job_20_test_all':
+                            # keep the log summary up to date so that the results job only reads the tail
+                            analyze_log(build._path('logs', 'job_20_test_all.txt'))
+                        continue
+                    container_state = docker_state(docker_name)
+                    build._logger('%s finished (exit code %s)', job, container_state and container_state['exit_code'])
+                    if job == build.job:
+                        del running[job]
+                        build._set_running_jobs(running)
+                        build._next_job(jobs)
                     else:
-                        # failfast
-                        if not build.result and build.guess_result in ('ko', 'warn'):
-                            build.result = build.guess_result
-                            build._github_status()
+                        # started before its turn, skipped when the build gets to it
+                        running[job] = None
+                        build._set_running_jobs(running)
+                if killed:
                     continue
-                build._logger('%s finished', build.job)
-                # schedule
-                v = {}
-                # testing -> running
-                if build.job == jobs[-2]:
-                    v['state'] = 'running'
-                    v['job'] = jobs[-1]
-                    v['job_end'] = now(),
-                # running -> done
-                elif build.job == jobs[-1]:
-                    v['state'] = 'done'
-                    v['job'] = ''
-                # testing
-                else:
-                    v['job'] = jobs[jobs.index(build.job) + 1]
-                build.write(v)
-
-            # run job
-            pid = None
-            if build.state != 'done':
-                build._logger('running %s', build.job)
-                job_method = getattr(self, '_' + build.job)  # compute the job method to run
-                os.makedirs(build._path('logs'), exist_ok=True)
-                os.makedirs(build._path('datadir'), exist_ok=True)
-                log_path = build._path('logs', '%s.txt' % build.job)
-                try:
-                    pid = job_method(build, log_path)
-                    build.write({'pid': pid})
-                except Exception:
-                    _logger.exception('%s failed running method %s', build.dest, build.job)
-                    build._log(build.job, "failed running job method, see runbot log")
-                    build._kill(result='ko')
+                # failfast
+                if any(running.values()) and not build.result and build.guess_result in ('ko', 'warn'):
+                    build.result = build.guess_result
+                    build._github_status()
+
+            # run jobs until the current one waits for a process
+            while build.state != 'done':
+                if build.job in running and running[build.job] is None:
+                    # already run alongside the previous jobs
+                    del running[build.job]
+                    build._set_running_jobs(running)
+                    build._next_job(jobs)
                     continue
+                active = {job for job, start in running.items() if start}
+                if build.job in active or job_depends[build.job] & active:
+                    # wait for them, meanwhile start the container jobs that do not depend on them
+                    build._start_ready_jobs(jobs, job_depends, running)
+                    break
+                pid = build._run_job(build.job)
+                if pid is None:
+                    break
+                if pid != -2:
+                    running[build.job] = time.time()
+                    build._set_running_jobs(running)
+                    continue
+                # no process to wait, directly run the next job
+                build._next_job(jobs)
+            else:
+                # cleanup only needed if it was not killed
+                self.env['runbot.port.lease']._release(build)
+                build._local_cleanup()
 
+    def _start_ready_jobs(self, jobs, job_depends, running):
+        """Start the container jobs after the current one whose dependencies are finished, updating running"""
+        self.ensure_one()
+        current = jobs.index(self.job)
+        active = {job for job, start in running.items() if start}
+        finished = {job for job in jobs[:current] if job not in active} | {job for job, start in running.items() if start is None}
+        for job in jobs[current + 1:]:
+            if job in running or not job_depends[job] <= finished:
+                continue
+            if 'container' not in getattr(getattr(type(self), '_' + job), 'runbot_job', {}).get('resources', ()):
+                continue
+            pid = self._run_job(job)
+            if pid is None:
+                return
+            running[job] = time.time() if pid != -2 else None
+            self._set_running_jobs(running)
             if pid == -2:
-                # no process to wait, directly call next job
-                # FIXME find a better way that this recursive call
-                build._schedule()
+                finished.add(job)
 
-            # cleanup only needed if it was not killed
-            if build.state == 'done':
-                build._local_cleanup()
+    def _run_job(self, job):
+        """Run the job method, return its pid, -2 if it has no process to wait for
+        and None if it failed and the build was killed"""
+        self.ensure_one()
+        build = self
+        build._logger('running %s', job)
+        job_method = getattr(self, '_' + job)  # compute the job method to run
+        os.makedirs(build._path('logs'), exist_ok=True)
+        os.makedirs(build._path('datadir'), exist_ok=True)
+        log_path = build._path('logs', '%s.txt' % job)
+        reset_log_summary(log_path)
+        try:
+            pid = job_method(build.with_context(runbot_job=job), log_path)
+            build.write({'pid': pid})
+        except Exception:
+            _logger.exception('%s failed running method %s', build.dest, job)
+            build._log(job, "failed running job method, see runbot log")
+            build._kill(result='ko')
+            return None
+        return pid
+
+    def _next_job(self, jobs):
+        """Move the build to the job following its current one, the last job keeps the build running"""
+        self.ensure_one()
+        next_index = jobs.index(self.job) + 1
+        if next_index == len(jobs):
+            # running -> done
+            self.write({'state': 'done', 'job': ''})
+        elif next_index == len(jobs) - 1:
+            # testing -> running
+            self.write({'state': 'running', 'job': jobs[next_index], 'job_end': now()})
+        else:
+            self.write({'job': jobs[next_index]})
 
     def _path(self, *l, **kw):
         """Return the repo build path"""
@@ -537,7 +886,7 @@ class runbot_build(models.Model):
                 build.repo_id._update(build.repo_id)
 
             # checkout branch
-            build.branch_id.repo_id._git_export(build.name, build._path())
+            exports = [build.branch_id.repo_id._git_export(build.name, build._path())]
 
             has_server = os.path.isfile(build._server('__init__.py'))
             server_match = 'builtin'
@@ -570,13 +919,13 @@ class runbot_build(models.Model):
                         '%s match branch %s of %s' % (server_match, closest_name, repo.name)
                     )
                     repo._update_git(force=True)
-                    latest_commit = repo._git(['rev-parse', closest_name]).strip()
-                    commit_oneline = repo._git(['show', '--pretty="%H -- %s"', '-s', latest_commit]).strip()
+                    latest_commit = repo._git_rev_parse(closest_name)
+                    commit_oneline = repo._git_commit_oneline(latest_commit)
                     build._log(
                         'Building environment',
                         'Server built based on commit %s from %s' % (commit_oneline, closest_name)
                     )
-                    repo._git_export(closest_name, build._path())
+                    exports.append(repo._git_export(closest_name, build._path()))
 
                 # Finally mark all addons to move to openerp/addons
                 modules_to_move += [
@@ -585,6 +934,19 @@ class runbot_build(models.Model):
                                    glob.glob(build._path('*/__manifest__.py')))
                 ]
 
+            written = [export['bytes'] for export in exports if export['bytes'] is not None]
+            build._log(
+                'Building environment',
+                'Checkout done in %.1fs, %.1f MB written%s, %.1f MB shared, %s/%s trees from export cache' % (
+                    sum(export['time'] for export in exports),
+                    sum(written) / 1024 ** 2,
+                    '' if len(written) == len(exports) else ' (partial)',
+                    sum(export['shared'] for export in exports) / 1024 ** 2,
+                    len([export for export in exports if export['hit']]),
+                    len(exports),
+                )
+            )
+
             # move all addons to server addons path
             for module in uniq_list(glob.glob(build._path('addons/*')) + modules_to_move):
                 basename = os.path.basename(module)
@@ -662,18 +1024,28 @@ class runbot_build(models.Model):
 
     def _kill(self, result=None):
         host = fqdn()
-        for build in self:
-            if build.host != host:
-                continue
+        builds = self.filtered(lambda build: build.host == host)
+        # stop all the containers at once, then wait for each of them before dropping its databases
+        containers = {build.id: [build._get_docker_name(job) for job, start in build._get_running_jobs().items() if start] for build in builds}
+        for build in builds:
+            for container_name in containers[build.id]:
+                docker_stop(container_name, wait=False)
+        for build in builds:
             build._log('kill', 'Kill build %s' % build.dest)
-            docker_stop(build._get_docker_name())
-            v = {'state': 'done', 'job': False}
+            for container_name in containers[build.id]:
+                docker_stop(container_name)
+            v = {'state': 'done', 'job': False, 'running_jobs': json.dumps({})}
             if result:
                 v['result'] = result
             build.write(v)
+            self.env['runbot.port.lease']._release(build)
             self.env.cr.commit()
             build._github_status()
-            build._local_cleanup()
+            try:
+                build._local_cleanup()
+            except Exception:
+                # the leftovers are removed by the cleanup of the next builds
+                _logger.exception('%s cleanup failed', build.dest)
 
     def _ask_kill(self):
         self.ensure_one()
@@ -733,12 +1105,12 @@ class runbot_build(models.Model):
 
 
     def _github_status_notify_all(self, status):
-        """Notify each repo with a status"""
+        """Queue a status for the build commit in each repo where it was built"""
         self.ensure_one()
-        commits = {(b.repo_id, b.name) for b in self.search([('name', '=', self.name)])}
-        for repo, commit_hash in commits:
-            _logger.debug("github updating %s status %s to %s in repo %s", status['context'], commit_hash, status['state'], repo.name)
-            repo._github('/repos/:owner/:repo/statuses/%s' % commit_hash, status, ignore_errors=True)
+        self.env.cr.execute("SELECT DISTINCT repo_id FROM runbot_build WHERE name = %s", [self.name])
+        CommitStatus = self.env['runbot.commit.status']
+        for repo in self.env['runbot.repo'].browse([row[0] for row in self.env.cr.fetchall()]):
+            CommitStatus._queue(repo, self.name, status)
 
     def _github_status(self):
         """Notify github of failed/successful builds"""
@@ -766,7 +1138,7 @@ class runbot_build(models.Model):
 
     # Jobs definitions
     # They all need "build log_path" parameters
-    @runbot_job('testing', 'running')
+    @runbot_job('testing', 'running', depends=[])
     def _job_00_init(self, build, log_path):
         build._log('init', 'Init build environment')
         # notify pending build - avoid confusing users by saying nothing
@@ -774,14 +1146,14 @@ class runbot_build(models.Model):
         build._checkout()
         return -2
 
-    @runbot_job('testing', 'running')
+    @runbot_job('testing', 'running', depends=['job_00_init'])
     def _job_02_docker_build(self, build, log_path):
         """Build the docker image"""
         build._log('docker_build', 'Building docker image')
-        docker_build(log_path, build._path())
+        build.docker_image = docker_build(log_path, build._path())
         return -2
 
-    @runbot_job('testing')
+    @runbot_job('testing', depends=['job_02_docker_build'], resources=['container'])
     def _job_10_test_base(self, build, log_path):
         build._log('test_base', 'Start test base module')
         self._local_pg_createdb("%s-base" % build.dest)
@@ -789,9 +1161,9 @@ class runbot_build(models.Model):
         cmd += ['-d', '%s-base' % build.dest, '-i', 'base', '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
         if build.extra_params:
             cmd.extend(shlex.split(build.extra_params))
-        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=600)
+        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=600, image=build.docker_image)
 
-    @runbot_job('testing', 'running')
+    @runbot_job('testing', 'running', depends=['job_10_test_base'], resources=['container'])
     def _job_20_test_all(self, build, log_path):
 
         cpu_limit = 2400
@@ -817,9 +1189,9 @@ class runbot_build(models.Model):
             cmd = [ get_py_version(build), '-m', 'coverage', 'run', '--branch', '--source', '/data/build'] + omit + cmd
         # reset job_start to an accurate job_20 job_time
         build.write({'job_start': now()})
-        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=cpu_limit)
+        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), cpu_limit=cpu_limit, image=build.docker_image)
 
-    @runbot_job('testing')
+    @runbot_job('testing', depends=['job_20_test_all'], resources=['container'])
     def _job_21_coverage_html(self, build, log_path):
         if not build.coverage:
             return -2
@@ -827,9 +1199,9 @@ class runbot_build(models.Model):
         cov_path = build._path('coverage')
         os.makedirs(cov_path, exist_ok=True)
         cmd = [ get_py_version(build), "-m", "coverage", "html", "-d", "/data/build/coverage", "--ignore-errors"]
-        return docker_run(cmd, log_path, build._path(), build._get_docker_name())
+        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), image=build.docker_image)
 
-    @runbot_job('testing')
+    @runbot_job('testing', depends=['job_21_coverage_html'])
     def _job_22_coverage_result(self, build, log_path):
         if not build.coverage:
             return -2
@@ -844,20 +1216,18 @@ class runbot_build(models.Model):
             build._log('coverage_result', 'Coverage file not found')
         return -2  # nothing to wait for
 
-    @runbot_job('testing', 'running')
+    @runbot_job('testing', 'running', depends=['job_20_test_all'])
     def _job_29_results(self, build, log_path):
         build._log('run', 'Getting results for build %s' % build.dest)
         log_all = build._path('logs', 'job_20_test_all.txt')
-        log_time = time.localtime(os.path.getmtime(log_all))
-        v = {
-            'job_end': time2str(log_time),
-        }
-        if grep(log_all, ".modules.loading: Modules loaded."):
-            if rfind(log_all, _re_error):
+        v = {}
+        summary = analyze_log(log_all, final=True)
+        if summary.modules_loaded:
+            if summary.error_count:
                 v['result'] = "ko"
-            elif rfind(log_all, _re_warning):
+            elif summary.warning_count:
                 v['result'] = "warn"
-            elif not grep(build._server("test/common.py"), "post_install") or grep(log_all, "Initiating shutdown."):
+            elif not grep(build._server("test/common.py"), "post_install") or summary.shutdown:
                 v['result'] = "ok"
         else:
             v['result'] = "ko"
@@ -865,7 +1235,8 @@ class runbot_build(models.Model):
         build._github_status()
         return -2
 
-    @runbot_job('running')
+    # the coverage html is generated alongside the running build
+    @runbot_job('running', depends=['job_29_results'], resources=['container'])
     def _job_30_run(self, build, log_path):
         # adjust job_end to record an accurate job_20 job_time
         build._log('run', 'Start running build %s' % build.dest)
@@ -889,4 +1260,4 @@ class runbot_build(models.Model):
         smtp_host = docker_get_gateway_ip()
         if smtp_host:
             cmd += ['--smtp', smtp_host]
-        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), exposed_ports = [build.port, build.port + 1])
+        return docker_run(cmd, log_path, build._path(), build._get_docker_name(), exposed_ports = [build.port, build.port + 1], image=build.docker_image)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, api, tools
+
+QUEUE_ORDERS = {
+    # sticky branches first, then priority branches, then oldest builds
+    'legacy': 'runbot_build_queue.sticky DESC, runbot_build_queue.priority DESC, runbot_build_queue.sequence ASC',
+    # sticky branches first, then priority branches, then interleave repositories according to their weight and the waiting time
+    'fair': 'runbot_build_queue.sticky DESC, runbot_build_queue.priority DESC, runbot_build_queue.repo_rank::float / runbot_build_queue.weight - runbot_build_queue.wait_time / %(aging)s ASC, runbot_build_queue.sequence ASC',
+}
+
+
+class runbot_build_queue(models.Model):
+    """Pending builds waiting for a host, with their position in the queue.
+
+    With the fair policy, after the sticky and priority branches, builds
+    are ordered by their rank in the queue of
+    their repository, counting the builds of the repository already being
+    tested, divided by the repository weight, minus one unit per
+    `runbot_queue_aging` minutes of waiting, so that the repository with the
+    most pending builds cannot starve the others.
+    """
+
+    _name = "runbot.build.queue"
+    _auto = False
+    _order = 'sticky desc, priority desc, repo_rank, sequence'
+
+    build_id = fields.Many2one('runbot.build', 'Build', readonly=True)
+    repo_id = fields.Many2one('runbot.repo', 'Repository', readonly=True)
+    sequence = fields.Integer('Sequence', readonly=True)
+    sticky = fields.Boolean('Sticky', readonly=True)
+    priority = fields.Boolean('Build priority', readonly=True)
+    weight = fields.Integer('Repository weight', readonly=True)
+    repo_rank = fields.Integer('Rank in repository queue', readonly=True)
+    wait_time = fields.Float('Waiting time (minutes)', readonly=True, help="Since the build was queued")
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_build_pending_queue_index
+                ON runbot_build (repo_id, sequence)
+             WHERE state = 'pending' AND host IS NULL
+        """)
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute("""
+            CREATE VIEW runbot_build_queue AS (
+                SELECT
+                    runbot_build.id AS id,
+                    runbot_build.id AS build_id,
+                    runbot_build.repo_id AS repo_id,
+                    runbot_build.sequence AS sequence,
+                    coalesce(runbot_branch.sticky, false) AS sticky,
+                    coalesce(runbot_branch.priority, false) AS priority,
+                    greatest(coalesce(runbot_repo.queue_weight, 1), 1) AS weight,
+                    coalesce(repo_load.nb_builds, 0) + row_number() OVER (
+                        PARTITION BY runbot_build.repo_id
+                        ORDER BY runbot_branch.sticky DESC, runbot_build.sequence ASC
+                    ) AS repo_rank,
+                    extract(epoch FROM (now() at time zone 'UTC') - coalesce(runbot_build.queue_date, runbot_build.create_date)) / 60 AS wait_time
+                FROM
+                    runbot_build
+                JOIN runbot_branch ON runbot_branch.id = runbot_build.branch_id
+                JOIN runbot_repo ON runbot_repo.id = runbot_build.repo_id
+                LEFT JOIN (
+                    SELECT repo_id, count(*) AS nb_builds
+                      FROM runbot_build
+                     WHERE state = 'testing' OR (state = 'pending' AND host IS NOT NULL)
+                  GROUP BY repo_id
+                ) AS repo_load ON repo_load.repo_id = runbot_build.repo_id
+                WHERE
+                    runbot_build.state = 'pending'
+                    AND runbot_build.host IS NULL
+                    AND runbot_branch.job_type != 'none'
+                    AND NOT coalesce(runbot_build.duplicate_check, false)
+            )""")
+
+    @api.model
+    def _get_aging(self):
+        """Minutes of waiting worth one rank in the queue"""
+        aging = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_queue_aging', default=30))
+        return max(aging, 1)
+
+    @api.model
+    def _get_order(self):
+        """Return the ORDER BY clause of the configured queue policy"""
+        policy = self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_queue_policy', default='fair')
+        return QUEUE_ORDERS.get(policy, QUEUE_ORDERS['fair']) % {'aging': self._get_aging()}
+
+    @api.model
+    def _get_next_builds(self, repo_ids, limit, lock=False):
+        """Return the ids of the next limit builds of repo_ids to schedule
+
+        :param lock: lock the returned builds, skipping the ones locked by other hosts
+        """
+        self.env.cr.execute("""
+            SELECT runbot_build_queue.build_id
+              FROM runbot_build_queue
+              JOIN runbot_build ON runbot_build.id = runbot_build_queue.build_id
+             WHERE runbot_build_queue.repo_id IN %%s
+          ORDER BY %s
+             LIMIT %%s
+               %s
+        """ % (self._get_order(), 'FOR UPDATE OF runbot_build SKIP LOCKED' if lock else ''), [tuple(repo_ids), limit])
+        return [row[0] for row in self.env.cr.fetchall()]
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+import psycopg2
+import requests
+
+from odoo import models, fields, api
+
+from ..common import fqdn
+from ..listener import CHANNEL_STATUS, Listener
+
+_logger = logging.getLogger(__name__)
+
+# delay before the first retry of a failed status, doubled at each retry
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+MAX_RETRIES = 10
+
+
+class runbot_commit_status(models.Model):
+    """Outbox of github commit statuses waiting to be sent.
+
+    Only the last status of a (repo, commit, context) is kept, a status
+    replaced before being sent never reaches github. The outbox is drained
+    by the scheduling cron at each pass and, when it is set up, as soon as a
+    status is queued by a dedicated cron. A status that could not be sent is
+    retried with an exponential backoff.
+    """
+
+    _name = "runbot.commit.status"
+    _order = 'id'
+    _sql_constraints = [('status_uniq', 'unique (repo_id, sha, context)', 'Only one pending status per commit and context !')]
+
+    repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade')
+    sha = fields.Char('Revno', required=True)
+    context = fields.Char('Context', required=True)
+    state = fields.Char('State', required=True)
+    target_url = fields.Char('Target url')
+    description = fields.Char('Description')
+    retry_count = fields.Integer('Failed attempts', default=0)
+    next_try = fields.Datetime('Next attempt', help="Not sent before this date, immediately if not set")
+
+    @api.model
+    def _queue(self, repo, sha, status):
+        """Queue status for commit sha of repo, replacing any unsent status of the same context"""
+        _logger.debug("github queuing %s status %s to %s in repo %s", status['context'], sha, status['state'], repo.name)
+        self.env.cr.execute("""
+            INSERT INTO runbot_commit_status (repo_id, sha, context, state, target_url, description, create_uid, create_date, write_uid, write_date)
+                 VALUES (%(repo_id)s, %(sha)s, %(context)s, %(state)s, %(target_url)s, %(description)s, %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC')
+            ON CONFLICT (repo_id, sha, context) DO UPDATE
+                    SET state = EXCLUDED.state,
+                        target_url = EXCLUDED.target_url,
+                        description = EXCLUDED.description,
+                        write_date = EXCLUDED.write_date,
+                        retry_count = 0,
+                        next_try = NULL
+        """, {
+            'repo_id': repo.id,
+            'sha': sha,
+            'context': status['context'],
+            'state': status['state'],
+            'target_url': status.get('target_url'),
+            'description': status.get('description'),
+            'uid': self.env.uid,
+        })
+        # wake up the sending cron once the transaction is committed
+        self.env.cr.execute("SELECT pg_notify(%s, %s)", [CHANNEL_STATUS, str(repo.id)])
+
+    @api.model
+    def _send_statuses(self, limit=200):
+        """Send a batch of queued statuses to github, return the number of sent statuses
+
+        The requests are all sent before touching the outbox rows, so that no
+        row is locked while waiting for github. A status replaced meanwhile is
+        kept to be sent again.
+        """
+        self.env.cr.execute("""
+            SELECT id, write_date
+              FROM runbot_commit_status
+             WHERE next_try IS NULL OR next_try <= now() at time zone 'UTC'
+          ORDER BY id
+             LIMIT %s
+        """, [limit])
+        write_dates = dict(self.env.cr.fetchall())
+        sent = []
+        failed = []
+        for status in self.browse(list(write_dates)):
+            _logger.debug("github updating %s status %s to %s in repo %s", status.context, status.sha, status.state, status.repo_id.name)
+            try:
+                status.repo_id._github('/repos/:owner/:repo/statuses/%s' % status.sha, {
+                    'state': status.state,
+                    'target_url': status.target_url,
+                    'description': status.description,
+                    'context': status.context,
+                })
+                sent.append(status.id)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                # the same request would be refused again, unless rate limited
+                retry = not isinstance(e, requests.HTTPError) or response is None or response.status_code in (403, 429) or response.status_code >= 500
+                if retry and status.retry_count + 1 < MAX_RETRIES:
+                    _logger.warning('Fail to send github status %s of %s in repo %s, retrying later: %s', status.context, status.sha, status.repo_id.name, e)
+                    failed.append(status.id)
+                else:
+                    _logger.exception('Fail to send github status %s of %s in repo %s, giving up', status.context, status.sha, status.repo_id.name)
+                    sent.append(status.id)
+
+        for status_id in sent + failed:
+            try:
+                with self.env.cr.savepoint():
+                    if status_id in failed:
+                        self.env.cr.execute("""
+                            UPDATE runbot_commit_status
+                               SET retry_count = retry_count + 1,
+                                   next_try = (now() at time zone 'UTC') + least(%s * power(2, retry_count), %s) * interval '1 second'
+                             WHERE id = %s AND write_date = %s
+                        """, [RETRY_DELAY, MAX_RETRY_DELAY, status_id, write_dates[status_id]])
+                    else:
+                        self.env.cr.execute("DELETE FROM runbot_commit_status WHERE id = %s AND write_date = %s", [status_id, write_dates[status_id]])
+            except psycopg2.extensions.TransactionRollbackError:
+                # replaced by a new status meanwhile, it will be sent by the next batch
+                continue
+        self.invalidate_cache()
+        return len(sent)
+
+    @api.model
+    def _cron_send_statuses(self, hostname):
+        """ This method can be called from a dedicated cron on a single
+        runbot instance, it sends the queued statuses as they come instead of
+        waiting for the next pass of _cron_fetch_and_schedule.
+        """
+        if hostname != fqdn():
+            return 'Not for me'
+        start_time = time.time()
+        timeout = self.env['runbot.repo']._get_cron_period()
+        icp = self.env['ir.config_parameter']
+        update_frequency = int(icp.get_param('runbot.runbot_update_frequency', default=10))
+        listener = Listener(self.env.cr.dbname, [CHANNEL_STATUS])
+        try:
+            while time.time() - start_time < timeout:
+                nb_sent = self._send_statuses()
+                self.env.cr.commit()
+                if not nb_sent:
+                    # wake up on new statuses, otherwise retry the failed ones every update_frequency
+                    listener.wait(min(update_frequency, max(timeout - (time.time() - start_time), 0)))
+        finally:
+            listener.close()
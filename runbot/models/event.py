@@ -25,12 +25,25 @@ class runbot_event(models.Model):
 
         self._cr.execute("""
 CREATE OR REPLACE FUNCTION runbot_set_logging_build() RETURNS TRIGGER AS $$
+DECLARE
+  log_build_id integer := new.build_id;
 BEGIN
   IF (new.build_id IS NULL AND new.dbname IS NOT NULL AND new.dbname != current_database()) THEN
+    log_build_id := split_part(new.dbname, '-', 1)::integer;
     UPDATE ir_logging l
-       SET build_id = split_part(new.dbname, '-', 1)::integer
+       SET build_id = log_build_id
      WHERE l.id = new.id;
   END IF;
+  -- keep the build counters used by guess_result up to date, out of runbot_build
+  -- so that a build logging a lot does not conflict with the scheduler
+  IF (log_build_id IS NOT NULL AND new.level IN ('ERROR', 'CRITICAL', 'WARNING')) THEN
+    INSERT INTO runbot_build_log_count AS c (build_id, error_count, critical_count, warning_count)
+         VALUES (log_build_id, (new.level = 'ERROR')::integer, (new.level = 'CRITICAL')::integer, (new.level = 'WARNING')::integer)
+    ON CONFLICT (build_id) DO UPDATE
+            SET error_count = c.error_count + EXCLUDED.error_count,
+                critical_count = c.critical_count + EXCLUDED.critical_count,
+                warning_count = c.warning_count + EXCLUDED.warning_count;
+  END IF;
 RETURN NULL;
 END;
 $$ language plpgsql;
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+class runbot_hook_ref(models.Model):
+
+    _name = "runbot.hook.ref"
+    _order = 'id'
+
+    repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade', index=True)
+    name = fields.Char('Ref Name', required=True)
+    # as announced by the unauthenticated hook, only used to skip the refs already
+    # fetched, the commit itself is read from the fetched ref
+    sha = fields.Char('Revno', required=True)
+
+    @api.model
+    def _create_from_payload(self, repo, event, payload):
+        """Queue the ref updated by a github push or pull_request event payload"""
+        vals = None
+        if event == 'push' and not payload.get('deleted') and payload.get('ref', '').startswith('refs/heads/'):
+            vals = {'name': payload['ref'], 'sha': payload['after']}
+        elif event == 'pull_request' and payload.get('action') in ('opened', 'synchronize', 'reopened'):
+            vals = {'name': 'refs/pull/%s' % payload['number'], 'sha': payload['pull_request']['head']['sha']}
+        if not vals or repo.mode == 'disabled':
+            return self.browse()
+        vals['repo_id'] = repo.id
+        _logger.debug('repo %s queued hook ref %s at %s', repo.name, vals['name'], vals['sha'])
+        return self.create(vals)
+
+    def _get_refspec(self):
+        self.ensure_one()
+        if self.name.startswith('refs/pull/'):
+            return '+%s/head:%s' % (self.name, self.name)
+        return '+%s:%s' % (self.name, self.name)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import psycopg2
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# a build uses its port and the next one (longpolling), keep a spare one
+PORT_STEP = 3
+# leases younger than this are never expired, the build of a fresh lease may not be committed as testing yet
+LEASE_GRACE = '5 minutes'
+
+
+class runbot_port_lease(models.Model):
+    """Ports allocated to the builds of a host.
+
+    Lease rows are created lazily and kept when released, so allocating a port
+    is a single indexed update in the common case.
+    """
+
+    _name = "runbot.port.lease"
+    _order = 'host, port'
+    _sql_constraints = [('port_uniq', 'unique (host, port)', 'A port can only be leased once per host !')]
+
+    host = fields.Char('Host', required=True)
+    port = fields.Integer('Port', required=True)
+    build_id = fields.Many2one('runbot.build', 'Build', ondelete='set null')
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_port_lease_free_index
+                ON runbot_port_lease (host, port)
+             WHERE build_id IS NULL
+        """)
+
+    @api.model
+    def _acquire(self, build, host):
+        """Lease a free port of host to build and return it
+
+        The leases committed by another scheduler after the start of the
+        transaction are not visible to it, under REPEATABLE READ locking or
+        inserting over them raises a serialization failure: the statement is
+        rolled back to a savepoint and the next port is tried.
+        """
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    UPDATE runbot_port_lease
+                       SET build_id = %(build_id)s, write_date = now() at time zone 'UTC', write_uid = %(uid)s
+                     WHERE id = (
+                        SELECT id
+                          FROM runbot_port_lease
+                         WHERE host = %(host)s AND build_id IS NULL
+                      ORDER BY port
+                         LIMIT 1
+                           FOR UPDATE SKIP LOCKED)
+                 RETURNING port
+                """, {'build_id': build.id, 'host': host, 'uid': self.env.uid})
+                row = self.env.cr.fetchone()
+        except psycopg2.extensions.TransactionRollbackError:
+            # the free lease was taken meanwhile, lease a new port
+            row = None
+        if row:
+            return row[0]
+
+        # no free port, lease a new one after the highest port of host
+        starting_port = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_starting_port', default=2000))
+        offset = 0
+        while True:
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute("""
+                        INSERT INTO runbot_port_lease (host, port, build_id, create_uid, create_date, write_uid, write_date)
+                             SELECT %(host)s, greatest(max(port) + %(step)s, %(starting_port)s) + %(offset)s, %(build_id)s,
+                                    %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+                               FROM runbot_port_lease
+                              WHERE host = %(host)s
+                        ON CONFLICT (host, port) DO NOTHING
+                          RETURNING port
+                    """, {'host': host, 'step': PORT_STEP, 'starting_port': starting_port, 'offset': offset, 'build_id': build.id, 'uid': self.env.uid})
+                    row = self.env.cr.fetchone()
+            except psycopg2.extensions.TransactionRollbackError:
+                row = None
+            if row:
+                return row[0]
+            # another scheduler inserted the same port concurrently, try the next one
+            offset += PORT_STEP
+
+    @api.model
+    def _release(self, builds):
+        """Free the ports leased to builds"""
+        if builds:
+            self.env.cr.execute("""
+                UPDATE runbot_port_lease
+                   SET build_id = NULL, write_date = now() at time zone 'UTC', write_uid = %s
+                 WHERE build_id IN %s
+            """, [self.env.uid, tuple(builds.ids)])
+
+    @api.model
+    def _expire(self, host):
+        """Free the ports of host leased to builds that are no longer alive (crashed scheduler,
+        build reset or killed outside of the scheduler) and lease the ports of the alive builds
+        of host that were allocated without a lease"""
+        self.env.cr.execute("""
+            UPDATE runbot_port_lease
+               SET build_id = NULL, write_date = now() at time zone 'UTC', write_uid = %(uid)s
+             WHERE id IN (
+                SELECT runbot_port_lease.id
+                  FROM runbot_port_lease
+             LEFT JOIN runbot_build ON runbot_build.id = runbot_port_lease.build_id
+                 WHERE runbot_port_lease.host = %(host)s
+                   AND runbot_port_lease.build_id IS NOT NULL
+                   AND runbot_port_lease.write_date < (now() at time zone 'UTC') - interval %(grace)s
+                   AND (runbot_build.host IS DISTINCT FROM %(host)s OR runbot_build.state NOT IN ('testing', 'running', 'deathrow'))
+                   FOR UPDATE OF runbot_port_lease SKIP LOCKED)
+         RETURNING port
+        """, {'host': host, 'grace': LEASE_GRACE, 'uid': self.env.uid})
+        expired = [row[0] for row in self.env.cr.fetchall()]
+        if expired:
+            _logger.info('expired port leases on %s: %s', host, sorted(expired))
+
+        self.env.cr.execute("""
+            INSERT INTO runbot_port_lease (host, port, build_id, create_uid, create_date, write_uid, write_date)
+                 SELECT %(host)s, runbot_build.port, runbot_build.id, %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+                   FROM runbot_build
+                  WHERE runbot_build.host = %(host)s
+                    AND runbot_build.state IN ('testing', 'running', 'deathrow')
+                    AND runbot_build.port IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM runbot_port_lease WHERE build_id = runbot_build.id)
+            ON CONFLICT (host, port) DO NOTHING
+        """, {'host': host, 'uid': self.env.uid})
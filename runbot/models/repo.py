@@ -1,23 +1,71 @@
 # -*- coding: utf-8 -*-
 import datetime
 import dateutil
+import hashlib
 import json
 import logging
 import os
 import random
 import re
-import requests
 import signal
 import subprocess
 import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from odoo import models, fields, api
 from odoo.modules.module import get_module_resource
 from odoo.tools import config
 from ..common import fqdn, dt2time
+from ..container import docker_refresh_states
+from ..export_cache import ExportCache
+from ..git_batch import get_git_batch, reset_git_batch
+from ..github import github_client
+from ..listener import Listener, CHANNEL_BUILD, CHANNEL_HOOK
 
 _logger = logging.getLogger(__name__)
 
+# repo id: (consecutive fetch failures, time before which the repo is not fetched)
+_fetch_backoff = {}
+
+
+def _fetch(cmd, timeout):
+    """Run a git fetch command, killing it if it takes more than timeout seconds"""
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout, check=True)
+
+
+def _write_if_changed(path, content):
+    """Write content in path unless the file already has this content, return True if written"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(content)
+    return True
+
+
+# git maintenance steps: commit-graph speeds up history walks (for-each-ref sorting, merge-base),
+# the multi-pack-index lets git search all packs at once and incrementally repacks small packs
+MAINTENANCE_STEPS = [
+    ('commit-graph', ['commit-graph', 'write', '--reachable', '--split']),
+    ('multi-pack-index', ['multi-pack-index', 'write']),
+    ('expire', ['multi-pack-index', 'expire']),
+    ('repack', ['multi-pack-index', 'repack', '--batch-size=2g']),
+]
+MAINTENANCE_TIMEOUT = 3600
+
+# repo id: (expiration time, set of the ref names on the remote, named like runbot branches)
+_remote_refs = {}
+REMOTE_REFS_TTL = 60
+# touched in the repo directory after each pruned fetch of all the refs,
+# FETCH_HEAD is also written by the fetches of the hook refs
+FULL_FETCH_FILE = 'runbot_full_fetch'
+
+# repo id: last seen refs snapshot {'stamp': refs stamp, 'refs': {refname: sha}}
+_refs_snapshots = {}
+
 
 class runbot_repo(models.Model):
 
@@ -48,6 +96,8 @@ class runbot_repo(models.Model):
         string='Extra dependencies',
         help="Community addon repos which need to be present to run tests.")
     token = fields.Char("Github token", groups="runbot.group_runbot_admin")
+    partial_clone = fields.Boolean('Partial clone', help="Clone and fetch without the file contents (--filter=blob:none), the blobs are fetched on demand when a build is exported")
+    queue_weight = fields.Integer('Queue weight', default=1, help="Share of the build slots given to this repository when several repositories have pending builds")
     group_ids = fields.Many2many('res.groups', string='Limited to groups')
 
     def _root(self):
@@ -81,24 +131,95 @@ class runbot_repo(models.Model):
             _logger.info("git command: %s", ' '.join(cmd))
             return subprocess.check_output(cmd).decode('utf-8')
 
-    def _git_export(self, treeish, dest):
-        """Export a git repo to dest"""
+    def _git_archive(self, treeish, dest):
+        """Extract the content of treeish in dest"""
         self.ensure_one()
         _logger.debug('checkout %s %s %s', self.name, treeish, dest)
+        if self.partial_clone:
+            self._git_prefetch_blobs(treeish)
         p1 = subprocess.Popen(['git', '--git-dir=%s' % self.path, 'archive', treeish], stdout=subprocess.PIPE)
         p2 = subprocess.Popen(['tar', '-xmC', dest], stdin=p1.stdout, stdout=subprocess.PIPE)
         p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
         p2.communicate()[0]
 
+    def _git_prefetch_blobs(self, treeish):
+        """Fetch the blobs of treeish missing in a partial clone in a single request,
+        instead of letting git archive fetch them one by one"""
+        self.ensure_one()
+        timeout = int(self.env['ir.config_parameter'].get_param('runbot.runbot_fetch_timeout', default=300))
+        rev_list = subprocess.run(['git', '--git-dir=%s' % self.path, 'rev-list', '--objects', '--no-object-names', '--missing=print', '%s^{tree}' % treeish],
+                                  stdout=subprocess.PIPE, timeout=timeout, check=True)
+        missing = [line[1:] for line in rev_list.stdout.decode('utf-8').splitlines() if line.startswith('?')]
+        if not missing:
+            return
+        _logger.debug('fetching %s missing blobs of %s in repo %s', len(missing), treeish, self.name)
+        subprocess.run(['git', '--git-dir=%s' % self.path, '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', 'origin',
+                        '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no', '--filter=blob:none', '--stdin'],
+                       input='\n'.join(missing).encode('utf-8'), stdout=subprocess.DEVNULL, timeout=timeout, check=True)
+
+    def _git_export(self, treeish, dest):
+        """Export a git repo to dest
+
+        The tree is extracted once in the host export cache and dest is
+        materialized from it. Return a dict of stats with 'hit' (tree found in
+        cache), 'bytes' (bytes extracted or copied, None if unknown), 'shared'
+        (bytes reflinked or hardlinked from the cache) and 'time' (seconds).
+        """
+        self.ensure_one()
+        t0 = time.time()
+        icp = self.env['ir.config_parameter']
+        max_size = int(icp.get_param('runbot.runbot_export_cache_size', default=20)) * 1024 ** 3
+        mode = icp.get_param('runbot.runbot_export_cache_mode', default='reflink')
+        stats = None
+        if max_size:
+            try:
+                tree = self._git_batch().resolve('%s^{tree}' % treeish)
+                if tree:
+                    cache = ExportCache(os.path.join(self._root(), 'export_cache'), max_size, mode)
+                    stats = cache.materialize(tree, dest, lambda path: self._git_archive(tree, path))
+            except Exception:
+                _logger.exception('Export cache failed for %s in repo %s, exporting directly', treeish, self.name)
+        if stats is None:
+            self._git_archive(treeish, dest)
+            stats = {'hit': False, 'bytes': None, 'shared': 0}
+        stats['time'] = time.time() - t0
+        return stats
+
+    def _git_batch(self):
+        """Return the long-lived cat-file helper of the repo"""
+        self.ensure_one()
+        return get_git_batch(self.path)
+
     def _hash_exists(self, commit_hash):
         """ Verify that a commit hash exists in the repo """
         self.ensure_one()
+        try:
+            return self._git_batch().exists(commit_hash)
+        except Exception:
+            _logger.warning('git cat-file batch failed in repo %s, falling back to cat-file -e', self.name)
         try:
             self._git(['cat-file', '-e', commit_hash])
         except subprocess.CalledProcessError:
             return False
         return True
 
+    def _git_rev_parse(self, ref):
+        """Return the commit sha of ref"""
+        self.ensure_one()
+        sha = self._git_batch().resolve(ref)
+        if not sha:
+            # let git raise a meaningful error
+            sha = self._git(['rev-parse', ref]).strip()
+        return sha
+
+    def _git_commit_oneline(self, ref):
+        """Return the '<sha> -- <subject>' description of the commit pointed by ref"""
+        self.ensure_one()
+        info = self._git_batch().commit_info(ref)
+        if not info:
+            return self._git(['show', '--pretty=%H -- %s', '-s', ref]).strip()
+        return '%s -- %s' % (info['sha'], info['subject'])
+
     def _github(self, url, payload=None, ignore_errors=False):
         """Return a http request to be sent to github"""
         for repo in self:
@@ -110,100 +231,94 @@ class runbot_repo(models.Model):
                     url = url.replace(':owner', match_object.group(2))
                     url = url.replace(':repo', match_object.group(3))
                     url = 'https://api.%s%s' % (match_object.group(1), url)
-                    session = requests.Session()
-                    session.auth = (repo.token, 'x-oauth-basic')
-                    session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
-                    if payload:
-                        response = session.post(url, data=json.dumps(payload))
-                    else:
-                        response = session.get(url)
-                    response.raise_for_status()
-                    return response.json()
+                    return github_client.request(url, repo.token, payload)
             except Exception:
                 if ignore_errors:
                     _logger.exception('Ignored github error %s %r', url, payload)
                 else:
                     raise
 
+    def _github_rate_limit(self):
+        """Return the last known github rate limit budget of the repo token"""
+        self.ensure_one()
+        match_object = re.search('([^/]+)/([^/]+)/([^/.]+(.git)?)', self.base)
+        if not self.token or not match_object:
+            return None
+        return github_client.get_rate_limit('api.%s' % match_object.group(1), self.token)
+
+    def _get_refs_stamp(self):
+        """Return a stamp that changes whenever the refs of the repo may have changed.
+
+        FETCH_HEAD is rewritten by every fetch so its content is used instead of its mtime.
+        """
+        self.ensure_one()
+        stamp = hashlib.sha1()
+        fetch_head = os.path.join(self.path, 'FETCH_HEAD')
+        if os.path.isfile(fetch_head):
+            with open(fetch_head, 'rb') as f:
+                stamp.update(f.read())
+        packed_refs = os.path.join(self.path, 'packed-refs')
+        if os.path.isfile(packed_refs):
+            st = os.stat(packed_refs)
+            stamp.update(('%s %s' % (st.st_mtime, st.st_size)).encode())
+        return stamp.hexdigest()
+
+    def _get_refs_snapshot(self):
+        """Return the last seen refs snapshot of the repo, loaded from disk if needed"""
+        self.ensure_one()
+        if self.id not in _refs_snapshots:
+            snapshot = {'stamp': None, 'refs': {}}
+            snapshot_path = os.path.join(self.path, 'runbot_refs.json')
+            if os.path.isfile(snapshot_path):
+                try:
+                    with open(snapshot_path) as f:
+                        snapshot = json.load(f)
+                except ValueError:
+                    _logger.warning('repo %s ignoring corrupted refs snapshot', self.name)
+            _refs_snapshots[self.id] = snapshot
+        return _refs_snapshots[self.id]
+
+    def _set_refs_snapshot(self, stamp, refs):
+        """Store the refs snapshot of the repo in memory and on disk"""
+        self.ensure_one()
+        snapshot = {'stamp': stamp, 'refs': refs}
+        os.makedirs(self.path, exist_ok=True)
+        snapshot_path = os.path.join(self.path, 'runbot_refs.json')
+        with open(snapshot_path + '.tmp', 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        _refs_snapshots[self.id] = snapshot
+
     def _find_new_commits(self, repo):
-        """ Find new commits in bare repo """
+        """ Find new commits in bare repo
+
+        Only the refs that were added or moved since the last saved refs snapshot
+        are processed, and the repo is skipped if its refs did not change at all.
+        Return the new (stamp, refs) snapshot of the repo, None if unchanged. It
+        must only be saved once the created builds are committed.
+        """
         self.ensure_one()
-        Branch = self.env['runbot.branch']
         Build = self.env['runbot.build']
-        icp = self.env['ir.config_parameter']
-        max_age = int(icp.get_param('runbot.runbot_max_age', default=30))
+
+        stamp = repo._get_refs_stamp()
+        snapshot = repo._get_refs_snapshot()
+        if snapshot['stamp'] == stamp:
+            _logger.debug('repo %s refs did not change', repo.name)
+            return
 
         fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
         fmt = "%00".join(["%(" + field + ")" for field in fields])
         git_refs = repo._git(['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/heads', 'refs/pull'])
         git_refs = git_refs.strip()
 
-        refs = [[field for field in line.split('\x00')] for line in git_refs.split('\n')]
-
-        self.env.cr.execute("""
-            WITH t (branch) AS (SELECT unnest(%s))
-          SELECT t.branch, b.id
-            FROM t LEFT JOIN runbot_branch b ON (b.name = t.branch)
-           WHERE b.repo_id = %s;
-        """, ([r[0] for r in refs], repo.id))
-        ref_branches = {r[0]: r[1] for r in self.env.cr.fetchall()}
-
-        for name, sha, date, author, author_email, subject, committer, committer_email in refs:
-            # create or get branch
-            if ref_branches.get(name):
-                branch_id = ref_branches[name]
-            else:
-                _logger.debug('repo %s found new branch %s', repo.name, name)
-                branch_id = Branch.create({'repo_id': repo.id, 'name': name}).id
-            branch = Branch.browse([branch_id])[0]
-
-            # skip the build for old branches (Could be checked before creating the branch in DB ?)
-            if dateutil.parser.parse(date[:19]) + datetime.timedelta(days=max_age) < datetime.datetime.now():
-                continue
+        refs = [[field for field in line.split('\x00')] for line in git_refs.split('\n')] if git_refs else []
+        current_refs = {ref[0]: ref[1] for ref in refs}
+        known_refs = snapshot['refs']
+        deleted_refs = set(known_refs) - set(current_refs)
+        refs = [ref for ref in refs if known_refs.get(ref[0]) != ref[1]]
+        _logger.debug('repo %s refs: %s changed, %s deleted', repo.name, len(refs), len(deleted_refs))
 
-            # create build (and mark previous builds as skipped) if not found
-            build_ids = Build.search([('branch_id', '=', branch.id), ('name', '=', sha)])
-            if not build_ids:
-                _logger.debug('repo %s branch %s new build found revno %s', branch.repo_id.name, branch.name, sha)
-                build_info = {
-                    'branch_id': branch.id,
-                    'name': sha,
-                    'author': author,
-                    'author_email': author_email,
-                    'committer': committer,
-                    'committer_email': committer_email,
-                    'subject': subject,
-                    'date': dateutil.parser.parse(date[:19]),
-                    'coverage': branch.coverage,
-                }
-                if not branch.sticky:
-                    # pending builds are skipped as we have a new ref
-                    builds_to_skip = Build.search(
-                        [('branch_id', '=', branch.id), ('state', '=', 'pending')],
-                        order='sequence asc')
-                    builds_to_skip._skip(reason='New ref found')
-                    if builds_to_skip:
-                        build_info['sequence'] = builds_to_skip[0].sequence
-                    # testing builds are killed
-                    builds_to_kill = Build.search([
-                        ('branch_id', '=', branch.id),
-                        ('state', '=', 'testing'),
-                        ('committer', '=', committer)
-                    ])
-                    builds_to_kill.write({'state': 'deathrow'})
-                    for btk in builds_to_kill:
-                        btk._log('repo._update_git', 'Build automatically killed, newer build found.')
-
-                new_build = Build.create(build_info)
-                # create a reverse dependency build if needed
-                if branch.sticky:
-                    for rev_repo in self.search([('dependency_ids', 'in', self.id)]):
-                        # find the latest build with the same branch name
-                        latest_rev_build = Build.search([('repo_id.id', '=', rev_repo.id), ('branch_id.branch_name', '=', branch.branch_name)], order='id desc', limit=1)
-                        if latest_rev_build:
-                            _logger.debug('Reverse dependency build %s forced in repo %s by commit %s', latest_rev_build.dest, rev_repo.name, sha[:6])
-                            latest_rev_build.build_type = 'indirect'
-                            new_build.revdep_build_ids += latest_rev_build._force(message='Rebuild from dependency %s commit %s' % (repo.name, sha[:6]))
+        repo._create_builds(refs)
 
         # skip old builds (if their sequence number is too low, they will not ever be built)
         skippable_domain = [('repo_id', '=', repo.id), ('state', '=', 'pending')]
@@ -211,14 +326,228 @@ class runbot_repo(models.Model):
         running_max = int(icp.get_param('runbot.runbot_running_max', default=75))
         builds_to_be_skipped = Build.search(skippable_domain, order='sequence desc', offset=running_max)
         builds_to_be_skipped._skip()
+        return stamp, current_refs
+
+    def _create_builds(self, refs):
+        """ Create the branches and pending builds for the given refs of the repo
+
+        refs is a list of (refname, sha, date, author, author_email, subject, committer, committer_email).
+        Branches and builds are created in batch, the duplicate detection and the
+        notifications are deferred to runbot.build._check_pending_duplicates.
+        """
+        self.ensure_one()
+        repo = self
+        Branch = self.env['runbot.branch']
+        Build = self.env['runbot.build']
+        icp = self.env['ir.config_parameter']
+        max_age = int(icp.get_param('runbot.runbot_max_age', default=30))
+
+        # skip old refs before creating anything
+        min_date = datetime.datetime.now() - datetime.timedelta(days=max_age)
+        new_refs = []
+        for name, sha, date, author, author_email, subject, committer, committer_email in refs:
+            date = dateutil.parser.parse(date[:19])
+            if date >= min_date:
+                new_refs.append((name, sha, date, author, author_email, subject, committer, committer_email))
+        if not new_refs:
+            return Build
+
+        # create or get branches
+        def get_branch_ids(names):
+            self.env.cr.execute("""
+                WITH t (branch) AS (SELECT unnest(%s))
+              SELECT t.branch, b.id
+                FROM t LEFT JOIN runbot_branch b ON (b.name = t.branch)
+               WHERE b.repo_id = %s;
+            """, (names, repo.id))
+            return {r[0]: r[1] for r in self.env.cr.fetchall()}
+
+        ref_branches = get_branch_ids([r[0] for r in new_refs])
+        missing_names = [r[0] for r in new_refs if r[0] not in ref_branches]
+        if missing_names:
+            _logger.debug('repo %s found %s new branches', repo.name, len(missing_names))
+            Branch._create_batch(repo.id, missing_names)
+            # the branches inserted meanwhile by another transaction are not returned by _create_batch
+            ref_branches.update(get_branch_ids(missing_names))
+        branches = {branch.id: branch for branch in Branch.browse(list(ref_branches.values()))}
+
+        # create builds (and mark previous builds as skipped) if not found
+        existing = Build.search_read([('branch_id', 'in', list(branches)), ('name', 'in', [r[1] for r in new_refs])], ['branch_id', 'name'])
+        existing = {(b['branch_id'][0], b['name']) for b in existing}
+        new_refs = [r for r in new_refs if (ref_branches[r[0]], r[1]) not in existing]
+        if not new_refs:
+            return Build
+
+        non_sticky_ids = [ref_branches[r[0]] for r in new_refs if not branches[ref_branches[r[0]]].sticky]
+        pending_builds = {}
+        for build in Build.search([('branch_id', 'in', non_sticky_ids), ('state', '=', 'pending')], order='sequence asc'):
+            pending_builds.setdefault(build.branch_id.id, Build)
+            pending_builds[build.branch_id.id] |= build
+        testing_builds = {}
+        for build in Build.search([('branch_id', 'in', non_sticky_ids), ('state', '=', 'testing')]):
+            testing_builds.setdefault((build.branch_id.id, build.committer), Build)
+            testing_builds[(build.branch_id.id, build.committer)] |= build
+
+        builds_info = []
+        builds_to_skip = Build
+        builds_to_kill = Build
+        for name, sha, date, author, author_email, subject, committer, committer_email in new_refs:
+            branch = branches[ref_branches[name]]
+            _logger.debug('repo %s branch %s new build found revno %s', repo.name, branch.name, sha)
+            build_info = {
+                'branch_id': branch.id,
+                'name': sha,
+                'author': author,
+                'author_email': author_email,
+                'committer': committer,
+                'committer_email': committer_email,
+                'subject': subject,
+                'date': date,
+                'coverage': branch.coverage,
+            }
+            if not branch.sticky:
+                # pending builds are skipped as we have a new ref
+                branch_pending = pending_builds.get(branch.id, Build)
+                builds_to_skip |= branch_pending
+                if branch_pending:
+                    build_info['sequence'] = branch_pending[0].sequence
+                # testing builds are killed
+                builds_to_kill |= testing_builds.get((branch.id, committer), Build)
+            builds_info.append(build_info)
+
+        builds_to_skip._skip(reason='New ref found')
+        builds_to_kill.write({'state': 'deathrow'})
+        for btk in builds_to_kill:
+            btk._log('repo._update_git', 'Build automatically killed, newer build found.')
+
+        new_builds = Build._create_batch(builds_info)
+
+        # create reverse dependency builds if needed
+        repo._force_revdep_builds(new_builds.filtered(lambda b: b.branch_id.sticky))
+        return new_builds
+
+    def _force_revdep_builds(self, builds):
+        """ Rebuild the latest build of the same branch name in the repos depending on this one
+
+        All the reverse dependencies of builds are found in one query. A pending
+        reverse dependency build is not forced again, it will test the new
+        commits anyway, so a burst of commits only triggers one rebuild.
+        """
+        self.ensure_one()
+        Build = self.env['runbot.build']
+        if not builds:
+            return
+        rev_repos = self.search([('dependency_ids', 'in', self.id)])
+        if not rev_repos:
+            return
+        # the last new build of each branch name triggers the rebuild
+        triggers = {}
+        for build in builds.sorted('id'):
+            triggers[build.branch_id.branch_name] = build
+
+        # find the latest build of each rev repo with the same branch name
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (runbot_build.repo_id, runbot_branch.branch_name) runbot_build.id
+              FROM runbot_build
+              JOIN runbot_branch ON runbot_branch.id = runbot_build.branch_id
+             WHERE runbot_build.repo_id IN %s
+               AND runbot_branch.branch_name IN %s
+          ORDER BY runbot_build.repo_id, runbot_branch.branch_name, runbot_build.id DESC
+        """, [tuple(rev_repos.ids), tuple(triggers)])
+        for latest_rev_build in Build.browse([row[0] for row in self.env.cr.fetchall()]):
+            new_build = triggers[latest_rev_build.branch_id.branch_name]
+            sha = new_build.name
+            if latest_rev_build.state == 'pending':
+                _logger.debug('Reverse dependency build %s already pending in repo %s for commit %s', latest_rev_build.dest, latest_rev_build.repo_id.name, sha[:6])
+                new_build.revdep_build_ids += latest_rev_build
+                continue
+            _logger.debug('Reverse dependency build %s forced in repo %s by commit %s', latest_rev_build.dest, latest_rev_build.repo_id.name, sha[:6])
+            latest_rev_build.build_type = 'indirect'
+            new_build.revdep_build_ids += latest_rev_build._force(message='Rebuild from dependency %s commit %s' % (self.name, sha[:6]))
+
+    def _fetch_hook_refs(self, hook_refs):
+        """ Fetch only the refs received by the hook and create their builds
+
+        The hook is not authenticated, it only tells which refs to fetch: their
+        commit and its metadata are read from the fetched refs.
+        """
+        self.ensure_one()
+        repo = self
+        if not os.path.isdir(repo.path):
+            os.makedirs(repo.path)
+        repo._clone()
+
+        # only fetch each ref once, and not at all if it already points to the announced commit
+        local_refs = repo._git(['for-each-ref', '--format', '%(refname)%00%(objectname)'] + list(set(hook_refs.mapped('name'))))
+        local_shas = dict(line.split('\x00') for line in local_refs.split('\n') if line)
+        refspecs = {}
+        for hook_ref in hook_refs:
+            if local_shas.get(hook_ref.name) != hook_ref.sha:
+                refspecs[hook_ref.name] = hook_ref._get_refspec()
+        if not refspecs:
+            return
+
+        _logger.debug('repo %s fetching %s refs from hook', repo.name, len(refspecs))
+        try:
+            repo._git(['fetch', 'origin'] + list(refspecs.values()))
+        except subprocess.CalledProcessError:
+            # a ref deleted meanwhile fails the whole fetch, fetch them one by one
+            for name, refspec in list(refspecs.items()):
+                try:
+                    repo._git(['fetch', 'origin', refspec])
+                except subprocess.CalledProcessError:
+                    _logger.warning('Fail to fetch hook ref %s of repo %s', name, repo.name)
+                    del refspecs[name]
+        reset_git_batch(repo.path)
+        if not refspecs:
+            return
+
+        fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
+        fmt = "%00".join(["%(" + field + ")" for field in fields])
+        git_refs = repo._git(['for-each-ref', '--format', fmt] + list(refspecs)).strip()
+        # for-each-ref patterns also match the refs below them
+        refs = [ref for ref in (line.split('\x00') for line in git_refs.split('\n') if line) if ref[0] in refspecs]
+        repo._create_builds(refs)
+
+    def _process_hook_refs(self, repos):
+        """ Fetch the refs queued by the hook for repos """
+        HookRef = self.env['runbot.hook.ref']
+        # queued before their repo was disabled
+        HookRef.search([('repo_id.mode', '=', 'disabled')]).unlink()
+        for repo in repos:
+            hook_refs = HookRef.search([('repo_id', '=', repo.id)])
+            if not hook_refs:
+                continue
+            try:
+                # a failing repo must not abort the transaction of the others
+                with self.env.cr.savepoint():
+                    repo._fetch_hook_refs(hook_refs)
+            except Exception:
+                _logger.exception('Fail to fetch hook refs of repo %s', repo.name)
+            hook_refs.unlink()
 
     def _create_pending_builds(self, repos):
-        """ Find new commits in physical repos"""
+        """ Find new commits in physical repos
+
+        Return the new refs snapshots {repo id: (stamp, refs)}, to be saved with
+        _save_refs_snapshots once the transaction is committed.
+        """
+        snapshots = {}
         for repo in repos:
             try:
-                repo._find_new_commits(repo)
+                # a failing repo must not abort the transaction of the others
+                with self.env.cr.savepoint():
+                    snapshot = repo._find_new_commits(repo)
+                if snapshot:
+                    snapshots[repo.id] = snapshot
             except Exception:
                 _logger.exception('Fail to find new commits in repo %s', repo.name)
+        return snapshots
+
+    def _save_refs_snapshots(self, snapshots):
+        """ Save the refs snapshots returned by _create_pending_builds """
+        for repo_id, (stamp, refs) in snapshots.items():
+            self.browse(repo_id)._set_refs_snapshot(stamp, refs)
 
     def _clone(self):
         """ Clone the remote repo if needed """
@@ -226,10 +555,147 @@ class runbot_repo(models.Model):
         repo = self
         if not os.path.isdir(os.path.join(repo.path, 'refs')):
             _logger.info("Cloning repository '%s' in '%s'" % (repo.name, repo.path))
-            subprocess.call(['git', 'clone', '--bare', repo.name, repo.path])
+            filter_args = ['--filter=blob:none'] if repo.partial_clone else []
+            objects_root = repo._get_objects_root()
+            if objects_root and objects_root != repo:
+                objects_root._protect_objects()
+                filter_args += ['--reference', objects_root.path]
+            subprocess.call(['git', 'clone', '--bare'] + filter_args + [repo.name, repo.path])
+        elif repo.partial_clone:
+            with open(os.path.join(repo.path, 'config')) as f:
+                is_partial = 'partialclonefilter' in f.read()
+            if not is_partial:
+                # convert an existing clone, next fetches will omit blobs
+                _logger.info("Enabling partial clone on repository '%s'", repo.name)
+                repo._git(['config', 'remote.origin.promisor', 'true'])
+                repo._git(['config', 'remote.origin.partialclonefilter', 'blob:none'])
+        repo._setup_alternates()
+
+    def _get_branches_versions(self):
+        """ Return a version of the branches of each repo, in the order of the recordset
+
+        The version is the number of branches and their last write date, it
+        changes when a branch is created, deleted or modified without writing
+        on the hot repo row, and never matches the one of a rolled back
+        transaction.
+        """
+        self.env.cr.execute("""
+            SELECT repo_id, count(*), max(write_date)
+              FROM runbot_branch
+             WHERE repo_id IN %s
+          GROUP BY repo_id
+        """, [tuple(self.ids)])
+        versions = {row[0]: row[1:] for row in self.env.cr.fetchall()}
+        return tuple(versions.get(repo_id, (0, None)) for repo_id in self.ids)
+
+    def _get_remote_refs(self):
+        """ Return the set of the heads and pull requests refs of the remote
+
+        The local refs are used when all the refs of the repo were fetched less than
+        REMOTE_REFS_TTL seconds ago (full fetches prune deleted refs), otherwise a
+        single ls-remote is made.
+        The result is cached REMOTE_REFS_TTL seconds.
+        """
+        self.ensure_one()
+        now = time.time()
+        expiration, refs = _remote_refs.get(self.id, (0, None))
+        if expiration > now:
+            return refs
+        fetch_time = self._get_full_fetch_time()
+        try:
+            if fetch_time and now - fetch_time < REMOTE_REFS_TTL:
+                refs = set(self._git(['for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/pull']).split())
+                expiration = fetch_time + REMOTE_REFS_TTL
+            else:
+                refs = set()
+                for line in self._git(['ls-remote', '-q', self.name, 'refs/heads/*', 'refs/pull/*/head']).splitlines():
+                    ref = line.split('\t')[-1]
+                    refs.add(ref[:-len('/head')] if ref.startswith('refs/pull/') else ref)
+                expiration = now + REMOTE_REFS_TTL
+        except subprocess.CalledProcessError:
+            _logger.warning('Cannot list the remote refs of repo %s', self.name)
+            return set()
+        _remote_refs[self.id] = (expiration, refs)
+        return refs
 
-    def _update_git(self, force):
-        """ Update the git repo on FS """
+    def _get_duplicate_chain(self):
+        """ Return the repos linked to this one through duplicate_id, in both directions """
+        self.ensure_one()
+        chain = self
+        to_check = self
+        while to_check:
+            linked = to_check.mapped('duplicate_id') | self.search([('duplicate_id', 'in', to_check.ids)])
+            to_check = linked - chain
+            chain |= linked
+        return chain
+
+    def _in_duplicate_chain(self):
+        """ Return True if the builds of the repo can be a duplicate or have one """
+        self.ensure_one()
+        return bool(self.duplicate_id) or bool(self.search_count([('duplicate_id', '=', self.id)]))
+
+    def _get_objects_root(self):
+        """ Return the repo of the duplicate chain storing the shared objects (the oldest
+        full clone of the chain), None if the objects of the repo cannot be shared """
+        self.ensure_one()
+        if self.partial_clone:
+            return None
+        chain = self._get_duplicate_chain().filtered(lambda r: not r.partial_clone)
+        roots = chain.filtered(lambda r: r == self or os.path.isdir(os.path.join(r.path, 'refs')))
+        return roots.sorted('id')[0]
+
+    def _protect_objects(self):
+        """ Never prune the objects of a repo used as alternate, other repos may need
+        objects it does not reference anymore """
+        self.ensure_one()
+        with open(os.path.join(self.path, 'config')) as f:
+            config = f.read()
+        if 'pruneExpire = never' not in config:
+            _logger.info("Disabling objects pruning in repository '%s' used as alternate", self.name)
+            self._git(['config', 'gc.pruneExpire', 'never'])
+            self._git(['config', 'gc.auto', '0'])
+
+    def _setup_alternates(self):
+        """ Share the objects of the duplicate chain root through git alternates """
+        self.ensure_one()
+        objects_root = self._get_objects_root()
+        if not objects_root or objects_root == self:
+            return
+        objects_path = os.path.join(objects_root.path, 'objects')
+        alternates_path = os.path.join(self.path, 'objects', 'info', 'alternates')
+        alternates = []
+        if os.path.isfile(alternates_path):
+            with open(alternates_path) as f:
+                alternates = f.read().splitlines()
+        if objects_path in alternates:
+            return
+        _logger.info("Using objects of repository '%s' in '%s'", objects_root.name, self.name)
+        objects_root._protect_objects()
+        os.makedirs(os.path.dirname(alternates_path), exist_ok=True)
+        with open(alternates_path, 'a') as f:
+            f.write(objects_path + '\n')
+        # drop the local copies of the objects found in the alternate
+        self._git(['repack', '-a', '-d', '-l', '-q'])
+        reset_git_batch(self.path)
+
+    def _get_fetch_args(self):
+        """Return the git arguments used to fetch all the heads and pull requests of the repo"""
+        self.ensure_one()
+        return ['fetch', '-p', 'origin', '+refs/heads/*:refs/heads/*', '+refs/pull/*/head:refs/pull/*']
+
+    def _get_full_fetch_time(self):
+        """ Return the time of the last fetch of all the refs of the repo, None if unknown """
+        self.ensure_one()
+        path = os.path.join(self.path, FULL_FETCH_FILE)
+        return os.path.getmtime(path) if os.path.isfile(path) else None
+
+    def _set_full_fetch_time(self):
+        self.ensure_one()
+        with open(os.path.join(self.path, FULL_FETCH_FILE), 'w'):
+            pass
+
+    def _need_fetch(self, force):
+        """ Prepare the git repo on FS and return True if it has to be fetched """
         self.ensure_one()
         repo = self
         _logger.debug('repo %s updating branches', repo.name)
@@ -239,24 +705,69 @@ class runbot_repo(models.Model):
         self._clone()
 
         # check for mode == hook
-        fname_fetch_head = os.path.join(repo.path, 'FETCH_HEAD')
-        if not force and os.path.isfile(fname_fetch_head):
-            fetch_time = os.path.getmtime(fname_fetch_head)
+        fetch_time = repo._get_full_fetch_time()
+        if not force and fetch_time:
             if repo.mode == 'hook' and repo.hook_time and dt2time(repo.hook_time) < fetch_time:
                 t0 = time.time()
                 _logger.debug('repo %s skip hook fetch fetch_time: %ss ago hook_time: %ss ago',
                               repo.name, int(t0 - fetch_time), int(t0 - dt2time(repo.hook_time)))
-                return
+                return False
+        return True
 
-        repo._git(['fetch', '-p', 'origin', '+refs/heads/*:refs/heads/*', '+refs/pull/*/head:refs/pull/*'])
+    def _update_git(self, force):
+        """ Update the git repo on FS """
+        self.ensure_one()
+        if self._need_fetch(force):
+            self._git(self._get_fetch_args())
+            self._set_full_fetch_time()
+            reset_git_batch(self.path)
 
     def _update(self, repos, force=True):
-        """ Update the physical git reposotories on FS"""
+        """ Update the physical git reposotories on FS
+
+        Fetches are run concurrently by runbot_fetch_workers threads, each one
+        being killed after runbot_fetch_timeout seconds. A repo that fails to
+        fetch is not fetched again (unless forced) before an exponential backoff delay.
+        """
+        icp = self.env['ir.config_parameter']
+        workers = int(icp.get_param('runbot.runbot_fetch_workers', default=4))
+        timeout = int(icp.get_param('runbot.runbot_fetch_timeout', default=300))
+
+        to_fetch = {}
         for repo in repos:
+            failures, retry_time = _fetch_backoff.get(repo.id, (0, 0))
+            if not force and retry_time > time.time():
+                _logger.debug('repo %s skip fetch after %s failures, next try in %ss', repo.name, failures, int(retry_time - time.time()))
+                continue
             try:
-                repo._update_git(force)
+                if repo._need_fetch(force):
+                    to_fetch[repo] = ['git', '--git-dir=%s' % repo.path] + repo._get_fetch_args()
             except Exception:
                 _logger.exception('Fail to update repo %s', repo.name)
+        if not to_fetch:
+            return
+
+        # Only the git commands are run in threads, records are never used outside of the current thread
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(_fetch, cmd, timeout): repo for repo, cmd in to_fetch.items()}
+            for future in as_completed(futures):
+                repo = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failures = _fetch_backoff.get(repo.id, (0, 0))[0] + 1
+                    delay = min(60 * 2 ** (failures - 1), 3600)
+                    _fetch_backoff[repo.id] = (failures, time.time() + delay)
+                    if isinstance(e, subprocess.TimeoutExpired):
+                        _logger.warning('Fetch of repo %s killed after %ss, next try in %ss', repo.name, timeout, delay)
+                    elif isinstance(e, subprocess.CalledProcessError):
+                        _logger.warning('Fail to fetch repo %s, next try in %ss: %s', repo.name, delay, (e.stderr or b'').decode('utf-8', 'ignore').strip())
+                    else:
+                        _logger.exception('Fail to update repo %s', repo.name)
+                else:
+                    _fetch_backoff.pop(repo.id, None)
+                    repo._set_full_fetch_time()
+                    reset_git_batch(repo.path)
 
     def _scheduler(self, ids=None):
         """Schedule builds for the repository"""
@@ -271,8 +782,13 @@ class runbot_repo(models.Model):
         domain = [('repo_id', 'in', ids), ('branch_id.job_type', '!=', 'none')]
         domain_host = domain + [('host', '=', host)]
 
+        # free the ports of builds that died without releasing them
+        self.env['runbot.port.lease']._expire(host)
+
         # schedule jobs (transitions testing -> running, kill jobs, ...)
         build_ids = Build.search(domain_host + [('state', 'in', ['testing', 'running', 'deathrow'])])
+        if build_ids:
+            docker_refresh_states()
         build_ids._schedule()
 
         # launch new tests
@@ -282,30 +798,9 @@ class runbot_repo(models.Model):
             # commit transaction to reduce the critical section duration
             self.env.cr.commit()
             # self-assign to be sure that another runbot instance cannot self assign the same builds
-            query = """UPDATE
-                            runbot_build
-                        SET
-                            host = %(host)s
-                        WHERE
-                            runbot_build.id IN (
-                                SELECT
-                                    runbot_build.id
-                                FROM
-                                    runbot_build
-                                LEFT JOIN runbot_branch ON runbot_branch.id = runbot_build.branch_id
-                            WHERE
-                                runbot_build.repo_id IN %(repo_ids)s
-                                AND runbot_build.state = 'pending'
-                                AND runbot_branch.job_type != 'none'
-                                AND runbot_build.host IS NULL
-                            ORDER BY
-                                runbot_branch.sticky DESC,
-                                runbot_branch.priority DESC,
-                                runbot_build.sequence ASC
-                            FOR UPDATE OF runbot_build SKIP LOCKED
-                        LIMIT %(available_slots)s)"""
-
-            self.env.cr.execute(query, {'repo_ids': tuple(ids), 'host': fqdn(), 'available_slots': available_slots})
+            build_ids = self.env['runbot.build.queue']._get_next_builds(ids, available_slots, lock=True)
+            if build_ids:
+                self.env.cr.execute("UPDATE runbot_build SET host = %s WHERE id IN %s", [host, tuple(build_ids)])
             pending_build = Build.search(domain + domain_host + [('state', '=', 'pending')])
             if pending_build:
                 pending_build._schedule()
@@ -340,15 +835,19 @@ class runbot_repo(models.Model):
         settings['fqdn'] = fqdn()
         nginx_repos = self.search([('nginx', '=', True)], order='id')
         if nginx_repos:
-            settings['builds'] = self.env['runbot.build'].search([('repo_id', 'in', nginx_repos.ids), ('state', '=', 'running'), ('host', '=', fqdn())])
+            settings['builds'] = self.env['runbot.build'].search([('repo_id', 'in', nginx_repos.ids), ('state', '=', 'running'), ('host', '=', fqdn())], order='id')
 
-            nginx_config = self.env['ir.ui.view'].render_template("runbot.nginx_config", settings)
+            View = self.env['ir.ui.view']
             os.makedirs(nginx_dir, exist_ok=True)
-            open(os.path.join(nginx_dir, 'nginx.conf'), 'wb').write(nginx_config)
+            changed = _write_if_changed(os.path.join(nginx_dir, 'builds.conf'), View.render_template("runbot.nginx_builds", settings))
+            changed |= _write_if_changed(os.path.join(nginx_dir, 'nginx.conf'), View.render_template("runbot.nginx_config", settings))
             try:
-                _logger.debug('reload nginx')
                 pid = int(open(os.path.join(nginx_dir, 'nginx.pid')).read().strip(' \n'))
-                os.kill(pid, signal.SIGHUP)
+                if changed:
+                    _logger.debug('reload nginx')
+                    os.kill(pid, signal.SIGHUP)
+                else:
+                    os.kill(pid, 0)  # only check that nginx is still running
             except Exception:
                 _logger.debug('start nginx')
                 if subprocess.call(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf']):
@@ -359,6 +858,44 @@ class runbot_repo(models.Model):
                     else:
                         _logger.debug('failed to start nginx - failed to kill orphan worker - oh well')
 
+    def _git_maintenance(self):
+        """ Optimize the bare repository and return the duration of each step """
+        self.ensure_one()
+        git = ['git', '--git-dir=%s' % self.path]
+        # probe reading all the refs and their commits, like the new commits detection does
+        probe = git + ['for-each-ref', '--sort=-committerdate', '--count=1', '--format=%(objectname)', 'refs/heads', 'refs/pull']
+        timings = {}
+
+        t0 = time.time()
+        subprocess.run(probe, stdout=subprocess.DEVNULL, timeout=MAINTENANCE_TIMEOUT, check=True)
+        timings['probe_before'] = time.time() - t0
+        for step, args in MAINTENANCE_STEPS:
+            t0 = time.time()
+            subprocess.run(git + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=MAINTENANCE_TIMEOUT, check=True)
+            timings[step] = time.time() - t0
+        # packs may have been removed under the feet of the cat-file processes
+        reset_git_batch(self.path)
+        t0 = time.time()
+        subprocess.run(probe, stdout=subprocess.DEVNULL, timeout=MAINTENANCE_TIMEOUT, check=True)
+        timings['probe_after'] = time.time() - t0
+
+        _logger.info('repo %s maintenance done: %s', self.name, ', '.join('%s %.2fs' % (step, timings[step]) for step in ['probe_before'] + [step for step, _ in MAINTENANCE_STEPS] + ['probe_after']))
+        return timings
+
+    def _cron_git_maintenance(self, hostname):
+        """ This method have to be called from a dedicated daily cron
+        created on each runbot instance.
+        """
+        if hostname != fqdn():
+            return 'Not for me'
+        for repo in self.search([('mode', '!=', 'disabled')]):
+            if not os.path.isdir(os.path.join(repo.path, 'refs')):
+                continue
+            try:
+                repo._git_maintenance()
+            except Exception:
+                _logger.exception('Git maintenance failed on repo %s', repo.name)
+
     def _get_cron_period(self, min_margin=120):
         """ Compute a randomized cron period with a 2 min margin below
         real cron timeout from config.
@@ -378,13 +915,27 @@ class runbot_repo(models.Model):
         timeout = self._get_cron_period()
         icp = self.env['ir.config_parameter']
         update_frequency = int(icp.get_param('runbot.runbot_update_frequency', default=10))
-        while time.time() - start_time < timeout:
-            repos = self.search([('mode', '!=', 'disabled')])
-            self._update(repos, force=False)
-            self._create_pending_builds(repos)
-            self.env.cr.commit()
-            self.invalidate_cache()
-            time.sleep(update_frequency)
+        listener = Listener(self.env.cr.dbname, [CHANNEL_HOOK])
+        try:
+            while time.time() - start_time < timeout:
+                repos = self.search([('mode', '!=', 'disabled')])
+                self._process_hook_refs(repos)
+                self._update(repos, force=False)
+                snapshots = self._create_pending_builds(repos)
+                self.env.cr.commit()
+                # the refs are only known as processed once their builds are committed
+                self._save_refs_snapshots(snapshots)
+                # the duplicate detection of the new builds is done out of the ingestion transaction
+                self.env['runbot.build']._check_pending_duplicates()
+                self.env.cr.commit()
+                # also drained by runbot.commit.status._cron_send_statuses when it is set up
+                self.env['runbot.commit.status']._send_statuses()
+                self.env.cr.commit()
+                self.invalidate_cache()
+                # wake up on hooks, otherwise do a full pass every update_frequency
+                listener.wait(min(update_frequency, max(timeout - (time.time() - start_time), 0)))
+        finally:
+            listener.close()
 
     def _cron_fetch_and_build(self, hostname):
         """ This method have to be called from a dedicated cron
@@ -396,11 +947,16 @@ class runbot_repo(models.Model):
         timeout = self._get_cron_period()
         icp = self.env['ir.config_parameter']
         update_frequency = int(icp.get_param('runbot.runbot_update_frequency', default=10))
-        while time.time() - start_time < timeout:
-            repos = self.search([('mode', '!=', 'disabled')])
-            self._scheduler(repos.ids)
-            self.env.cr.commit()
-            self.env.reset()
-            self = self.env()[self._name]
-            self._reload_nginx()
-            time.sleep(update_frequency)
+        listener = Listener(self.env.cr.dbname, [CHANNEL_BUILD], docker_events=True)
+        try:
+            while time.time() - start_time < timeout:
+                repos = self.search([('mode', '!=', 'disabled')])
+                self._scheduler(repos.ids)
+                self.env.cr.commit()
+                self.env.reset()
+                self = self.env()[self._name]
+                self._reload_nginx()
+                # wake up on new builds, kill requests and container exits, otherwise do a full pass every update_frequency
+                listener.wait(min(update_frequency, max(timeout - (time.time() - start_time), 0)))
+        finally:
+            listener.close()
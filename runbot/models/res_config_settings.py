@@ -15,6 +15,13 @@ class ResConfigSettings(models.TransientModel):
     runbot_max_age = fields.Integer('Max branch age (in days)')
     runbot_logdb_uri = fields.Char('Runbot URI for build logs')
     runbot_update_frequency = fields.Integer('Update frequency (in seconds)')
+    runbot_fetch_workers = fields.Integer('Number of concurrent git fetch')
+    runbot_fetch_timeout = fields.Integer('Git fetch timeout (in seconds)')
+    runbot_export_cache_size = fields.Integer('Export cache size (in GB, 0 to disable)')
+    runbot_queue_policy = fields.Selection([('fair', 'Fair share between repositories'),
+                                            ('legacy', 'Sticky branches first')],
+                                           string='Build queue policy')
+    runbot_queue_aging = fields.Integer('Queue aging (in minutes of waiting per rank)')
 
     @api.model
     def get_values(self):
@@ -28,6 +35,11 @@ class ResConfigSettings(models.TransientModel):
                    runbot_max_age=int(get_param('runbot.runbot_max_age', default=30)),
                    runbot_logdb_uri=get_param('runbot.runbot_logdb_uri', default=False),
                    runbot_update_frequency=int(get_param('runbot.runbot_update_frequency', default=10)),
+                   runbot_fetch_workers=int(get_param('runbot.runbot_fetch_workers', default=4)),
+                   runbot_fetch_timeout=int(get_param('runbot.runbot_fetch_timeout', default=300)),
+                   runbot_export_cache_size=int(get_param('runbot.runbot_export_cache_size', default=20)),
+                   runbot_queue_policy=get_param('runbot.runbot_queue_policy', default='fair'),
+                   runbot_queue_aging=int(get_param('runbot.runbot_queue_aging', default=30)),
                    )
         return res
 
@@ -43,3 +55,8 @@ class ResConfigSettings(models.TransientModel):
         set_param("runbot.runbot_max_age", self.runbot_max_age)
         set_param("runbot.runbot_logdb_uri", self.runbot_logdb_uri)
         set_param('runbot.runbot_update_frequency', self.runbot_update_frequency)
+        set_param('runbot.runbot_fetch_workers', self.runbot_fetch_workers)
+        set_param('runbot.runbot_fetch_timeout', self.runbot_fetch_timeout)
+        set_param('runbot.runbot_export_cache_size', self.runbot_export_cache_size)
+        set_param('runbot.runbot_queue_policy', self.runbot_queue_policy)
+        set_param('runbot.runbot_queue_aging', self.runbot_queue_aging)
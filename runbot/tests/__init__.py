@@ -6,3 +6,9 @@ from . import test_frontend
 from . import test_job_types
 from . import test_schedule
 from . import test_cron
+from . import test_git_batch
+from . import test_export_cache
+from . import test_github
+from . import test_log_analyzer
+from . import test_container
+from . import test_docker_api
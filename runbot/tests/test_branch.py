@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tempfile
 from unittest.mock import patch
 from odoo.tests import common
 
@@ -51,3 +55,40 @@ class Test_Branch(common.TransactionCase):
             'name': 'refs/head/foo-coverage-branch-bar'
         })
         self.assertTrue(cov_branch.coverage)
+
+    @patch.dict('odoo.addons.runbot.models.repo._remote_refs')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_is_on_remote(self, mock_root):
+        """Test that the remote branches are listed once"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mock_root.return_value = tmp_dir
+        src = os.path.join(tmp_dir, 'src')
+        git = lambda *args: subprocess.check_call(('git', '-C', src) + args)
+        git('init', '-q')
+        git('-c', 'user.name=Marc', '-c', 'user.email=marc@example.com', 'commit', '-q', '--allow-empty', '-m', 'init')
+        git('branch', '-q', 'feature')
+        git('update-ref', 'refs/pull/12/head', 'HEAD')
+
+        repo = self.env['runbot.repo'].create({'name': 'file://%s' % src})
+        feature = self.Branch.create({'repo_id': repo.id, 'name': 'refs/heads/feature'})
+        pull = self.Branch.create({'repo_id': repo.id, 'name': 'refs/pull/12'})
+        gone = self.Branch.create({'repo_id': repo.id, 'name': 'refs/heads/gone'})
+        with patch('odoo.addons.runbot.models.repo.runbot_repo._git', wraps=repo._git) as mock_git:
+            self.assertTrue(feature._is_on_remote())
+            self.assertTrue(pull._is_on_remote())
+            self.assertFalse(gone._is_on_remote())
+            self.assertEqual(mock_git.call_count, 1, 'The remote refs should be listed once')
+
+        # a recently fetched repo uses its local refs
+        repo._clone()
+        repo._update_git(force=True)
+        git('branch', '-q', '-D', 'feature')
+        with patch.dict('odoo.addons.runbot.models.repo._remote_refs', clear=True):
+            self.assertTrue(feature._is_on_remote(), 'Local refs of a recent fetch should be used')
+
+        # fetching single refs does not prune, only a full fetch makes the local refs trusted
+        os.utime(os.path.join(repo.path, 'runbot_full_fetch'), (0, 0))
+        repo._git(['fetch', 'origin', '+refs/pull/12/head:refs/pull/12'])
+        with patch.dict('odoo.addons.runbot.models.repo._remote_refs', clear=True):
+            self.assertFalse(feature._is_on_remote(), 'Local refs of a partial fetch should not be used')
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from unittest.mock import patch
+import psycopg2
+from odoo import fields
 from odoo.tools.config import configmanager
 from odoo.tests import common
+from odoo.addons.runbot.github import RateLimitExceeded
 
 
 class Test_Build(common.TransactionCase):
@@ -74,6 +77,14 @@ class Test_Build(common.TransactionCase):
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""", ('testing', 'server', 'somewhere', 'test', 0, build.id, 'ERROR', 'blabla'))
         build.invalidate_cache()
         self.assertEqual(build.guess_result, 'ko', 'A testing build with errors should be ko')
+        self.assertEqual((build.log_error_count, build.log_warning_count), (1, 1))
+
+        # logs of the build database are counted once linked to the build
+        self.env.cr.execute("""
+            INSERT INTO ir_logging(name, type, path, func, line, dbname, level, message)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""", ('testing', 'server', 'somewhere', 'test', 0, '%s-foo' % build.id, 'WARNING', 'blabla'))
+        build.invalidate_cache()
+        self.assertEqual((build.log_error_count, build.log_warning_count), (1, 2))
 
     @patch('odoo.addons.runbot.models.build.os.mkdir')
     @patch('odoo.addons.runbot.models.build.grep')
@@ -158,6 +169,97 @@ class Test_Build(common.TransactionCase):
         log_first_part = '%s skip %%s' % (other_build.dest)
         mock_logger.debug.assert_called_with(log_first_part, 'A good reason')
 
+    @patch('odoo.addons.runbot.models.build.fqdn')
+    def test_port_lease(self, mock_fqdn):
+        """test that ports are leased once per host and reused once released"""
+        mock_fqdn.return_value = 'runbotxx'
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_starting_port', 2000)
+        builds = self.Build
+        for i in range(3):
+            builds |= self.Build.create({
+                'branch_id': self.branch.id,
+                'name': '%040x' % (i + 1),
+                'state': 'testing',
+                'host': 'runbotxx',
+            })
+        build_1, build_2, build_3 = builds
+        self.assertEqual(build_1._find_port(), 2000)
+        self.assertEqual(build_2._find_port(), 2003)
+
+        Lease = self.env['runbot.port.lease']
+        Lease._release(build_1)
+        self.assertEqual(build_3._find_port(), 2000)
+        self.assertEqual(Lease._acquire(build_1, 'runbotyy'), 2000, 'Ports are leased per host')
+
+        # a lease of a dead build expires
+        build_2.write({'state': 'done'})
+        Lease._expire('runbotxx')
+        self.assertEqual(Lease.search([('port', '=', 2003), ('host', '=', 'runbotxx')]).build_id, build_2, 'Fresh leases should not expire')
+        self.env.cr.execute("UPDATE runbot_port_lease SET write_date = write_date - interval '1 hour'")
+        Lease._expire('runbotxx')
+        self.assertFalse(Lease.search([('port', '=', 2003), ('host', '=', 'runbotxx')]).build_id)
+        self.assertEqual(Lease.search([('port', '=', 2000), ('host', '=', 'runbotxx')]).build_id, build_3)
+
+        # a port leased by a concurrent scheduler, not visible to the transaction, is skipped
+        execute = self.env.cr.execute
+        conflicts = []
+
+        def execute_side_effect(query, params=None, *args, **kwargs):
+            if 'INSERT INTO runbot_port_lease' in query and not conflicts:
+                conflicts.append(params['offset'])
+                raise psycopg2.extensions.TransactionRollbackError('could not serialize access due to concurrent update')
+            return execute(query, params, *args, **kwargs)
+        with patch.object(self.env.cr, 'execute', side_effect=execute_side_effect):
+            self.assertEqual(Lease._acquire(build_2, 'runbotyy'), 2006)
+        self.assertEqual(conflicts, [0])
+
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._github')
+    def test_github_status_coalescing(self, mock_github):
+        """test that only the last status of a commit context is sent"""
+        build = self.Build.create({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+        })
+        for state in ('pending', 'failure', 'success'):
+            build._github_status_notify_all({'state': state, 'context': 'ci/runbot', 'target_url': 'http://x', 'description': state})
+        build._github_status_notify_all({'state': 'pending', 'context': 'ci/other', 'target_url': 'http://x', 'description': 'other'})
+        CommitStatus = self.env['runbot.commit.status']
+        self.assertEqual(CommitStatus.search_count([]), 2)
+        self.assertEqual(CommitStatus._send_statuses(), 2)
+        self.assertEqual(mock_github.call_count, 2)
+        mock_github.assert_any_call('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', {
+            'state': 'success', 'target_url': 'http://x', 'description': 'success', 'context': 'ci/runbot'
+        })
+        self.assertFalse(CommitStatus.search([]))
+
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._github')
+    def test_github_status_retry(self, mock_github):
+        """test that the statuses that could not be sent are retried later"""
+        build = self.Build.create({
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+        })
+        CommitStatus = self.env['runbot.commit.status']
+        build._github_status_notify_all({'state': 'pending', 'context': 'ci/runbot', 'target_url': 'http://x', 'description': 'pending'})
+        mock_github.side_effect = RateLimitExceeded('Github rate limit exceeded')
+        self.assertEqual(CommitStatus._send_statuses(), 0)
+        status = CommitStatus.search([])
+        self.assertEqual(status.retry_count, 1)
+        self.assertGreater(status.next_try, fields.Datetime.now())
+
+        # not retried before its next try
+        mock_github.reset_mock()
+        mock_github.side_effect = None
+        self.assertEqual(CommitStatus._send_statuses(), 0)
+        self.assertFalse(mock_github.called)
+
+        # a new status of the same context is sent right away
+        build._github_status_notify_all({'state': 'success', 'context': 'ci/runbot', 'target_url': 'http://x', 'description': 'success'})
+        self.assertEqual(CommitStatus._send_statuses(), 1)
+        self.assertFalse(CommitStatus.search([]))
+
 
 class TestClosestBranch(common.TransactionCase):
 
@@ -199,6 +301,7 @@ class TestClosestBranch(common.TransactionCase):
                 self.assertClosest(build2, closest[b2])
 
             self.assertEqual(build2.duplicate_id.id, build1.id, "build on %s wasn't detected as duplicate of build on %s" % (self.branch_description(b2), self.branch_description(b1)))
+            self.assertEqual(build2.fingerprint, build1.fingerprint)
             self.assertEqual(build2.state, 'duplicate')
 
             self.assertEqual(build1.state, 'pending')
@@ -255,6 +358,39 @@ class TestClosestBranch(common.TransactionCase):
 
         self.Build = self.env['runbot.build']
 
+    @patch('odoo.addons.runbot.models.build.runbot_build._branch_exists')
+    def test_fingerprint_resolved_at_creation(self, mock_branch_exists):
+        """ test that a build is not a duplicate of a build tested with other closest branches """
+        mock_branch_exists.return_value = True
+        enterprise_branch = self.Branch.create({'repo_id': self.enterprise_repo.id, 'name': 'refs/heads/11.0-fix-thing'})
+        enterprise_dev_branch = self.Branch.create({'repo_id': self.enterprise_dev_repo.id, 'name': 'refs/heads/11.0-fix-thing'})
+        build1 = self.Build.create({'branch_id': enterprise_branch.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+        self.assertClosest(build1, (self.community_repo.id, 'refs/heads/11.0', 'prefix'))
+
+        # the community fix is pushed after build1 was created, build1 did not test it
+        self.Branch.create({'repo_id': self.community_dev_repo.id, 'name': 'refs/heads/11.0-fix-thing'})
+        build2 = self.Build.create({'branch_id': enterprise_dev_branch.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+        self.assertNotEqual(build2.fingerprint, build1.fingerprint)
+        self.assertEqual(build2.state, 'pending')
+
+    def test_pending_duplicates_error(self):
+        """ test that a failing duplicate detection does not block the other builds """
+        Build = type(self.Build)
+        builds = self.Build.with_context(force_rebuild=True).create({'branch_id': self.branch_enterprise_11.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+        builds |= self.Build.with_context(force_rebuild=True).create({'branch_id': self.branch_enterprise_10.id, 'name': 'deadbeef0000ffffffffffffffffffffffffffff'})
+        builds.write({'duplicate_check': True})
+        checked = []
+
+        def check_duplicates(build):
+            if build == builds[0]:
+                raise Exception('github is down')
+            checked.append(build)
+
+        with patch.object(Build, '_check_duplicates', autospec=True, side_effect=check_duplicates):
+            self.assertEqual(self.Build._check_pending_duplicates(), builds)
+        self.assertEqual(checked, [builds[1]])
+        self.assertFalse(any(builds.mapped('duplicate_check')), 'The builds should reach the queue')
+
     @patch('odoo.addons.runbot.models.repo.runbot_repo._github')
     def test_pr_is_duplicate(self, mock_github):
         """ test PR is a duplicate of a dev branch build """
@@ -516,3 +652,31 @@ class TestClosestBranch(common.TransactionCase):
         })
 
         self.assertEqual((self.community_repo.id, 'refs/heads/master', 'default'), addons_build._get_closest_branch_name(self.community_repo.id))
+
+    @patch('odoo.addons.runbot.models.build.runbot_build._branch_exists')
+    def test_closest_branch_cache(self, mock_branch_exists):
+        """ test that the closest branch is cached until the target repos branches change """
+        mock_branch_exists.return_value = True
+        addons_branch = self.Branch.create({
+            'repo_id': self.enterprise_dev_repo.id,
+            'name': 'refs/heads/10.0-fix-blah-moc'
+        })
+        addons_build = self.Build.create({
+            'branch_id': addons_branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+        })
+        self.assertEqual((self.community_repo.id, 'refs/heads/10.0', 'prefix'), addons_build._get_closest_branch_name(self.community_repo.id))
+        call_count = mock_branch_exists.call_count
+        self.assertEqual((self.community_repo.id, 'refs/heads/10.0', 'prefix'), addons_build._get_closest_branch_name(self.community_repo.id))
+        self.assertEqual(mock_branch_exists.call_count, call_count, 'The closest branch should be cached')
+
+        # a new branch in a target repo invalidates the cache
+        new_branch = self.Branch.create({
+            'repo_id': self.community_dev_repo.id,
+            'name': 'refs/heads/10.0-fix-blah-moc'
+        })
+        self.assertEqual((self.community_dev_repo.id, 'refs/heads/10.0-fix-blah-moc', 'exact'), addons_build._get_closest_branch_name(self.community_repo.id))
+
+        # and so does its deletion
+        new_branch.unlink()
+        self.assertEqual((self.community_repo.id, 'refs/heads/10.0', 'prefix'), addons_build._get_closest_branch_name(self.community_repo.id))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from odoo.addons.runbot import container
+
+
+@patch.dict('odoo.addons.runbot.container._container_states', clear=True)
+class TestContainerStates(unittest.TestCase):
+
+    def setUp(self):
+        super(TestContainerStates, self).setUp()
+        patcher = patch('odoo.addons.runbot.container.subprocess.run')
+        self.mock_run = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('odoo.addons.runbot.container.get_docker_client', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, container, '_container_states_time', 0)
+
+    def docker_ps(self, *names):
+        self.mock_run.return_value = subprocess.CompletedProcess([], 0, stdout=('\n'.join(names) + '\n').encode())
+        container.docker_refresh_states()
+
+    def test_states(self):
+        self.docker_ps('1234-master-d0d0ca_job_20_test_all', '1235-master-d0d0ca_job_30_run')
+        self.mock_run.reset_mock()
+        self.assertTrue(container.docker_is_running('1234-master-d0d0ca_job_20_test_all'))
+        self.assertTrue(container.docker_is_running('1235-master-d0d0ca_job_30_run'))
+        self.assertFalse(container.docker_is_running('1236-master-d0d0ca_job_20_test_all'))
+        self.assertFalse(self.mock_run.called, 'The states should be read from memory')
+
+        # exit recorded from the docker events
+        container.docker_record_exit('1234-master-d0d0ca_job_20_test_all', 1, 1546862400)
+        self.assertFalse(container.docker_is_running('1234-master-d0d0ca_job_20_test_all'))
+        state = container.docker_state('1234-master-d0d0ca_job_20_test_all')
+        self.assertEqual((state['exit_code'], state['finished_at']), (1, 1546862400))
+
+        # a container that just started is not listed yet
+        container._container_states['1237-master-d0d0ca_job_10_test_base'] = {'running': True, 'started_at': time.time(), 'exit_code': None, 'finished_at': None}
+        self.docker_ps('1235-master-d0d0ca_job_30_run')
+        self.assertTrue(container.docker_is_running('1237-master-d0d0ca_job_10_test_base'))
+
+        # an exit without event is noticed by the next listing after the grace period
+        with patch('odoo.addons.runbot.container.time.time', return_value=time.time() + container.START_GRACE + 1):
+            self.docker_ps()
+            self.assertFalse(container.docker_is_running('1235-master-d0d0ca_job_30_run'))
+            self.assertFalse(container.docker_is_running('1237-master-d0d0ca_job_10_test_base'))
+
+    def test_listing_failure(self):
+        self.docker_ps('1234-master-d0d0ca_job_20_test_all')
+        self.mock_run.return_value = subprocess.CompletedProcess([], 1, stdout=b'')
+        container.docker_refresh_states()
+        # fallback to container inspect
+        self.assertFalse(container.docker_is_running('1234-master-d0d0ca_job_20_test_all'))
+        self.mock_run.assert_called_with(['docker', 'container', 'inspect', '1234-master-d0d0ca_job_20_test_all'], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+
+class TestDockerBuild(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDockerBuild, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.images = set()
+        self.builds = []
+        self.returncode = 0
+        for target, kwargs in [
+            ('get_docker_client', {'return_value': None}),
+            ('docker_image_exists', {'side_effect': lambda tag: tag in self.images}),
+            ('subprocess.Popen', {'side_effect': self.docker_build_process}),
+        ]:
+            patcher = patch('odoo.addons.runbot.container.%s' % target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def docker_build_process(self, cmd, **kwargs):
+        tag = cmd[cmd.index('--tag') + 1]
+        self.builds.append(tag)
+
+        class Process(object):
+            returncode = self.returncode
+
+            def wait(process):
+                time.sleep(0.2)
+                if not process.returncode:
+                    self.images.add(tag)
+                return process.returncode
+        return Process()
+
+    def test_docker_build(self):
+        def build(index):
+            build_dir = os.path.join(self.tmp_dir, str(index))
+            os.makedirs(os.path.join(build_dir, 'logs'))
+            tags.append(container.docker_build(os.path.join(build_dir, 'logs', 'job_02_docker_build.txt'), build_dir))
+
+        # concurrent builds of the same Dockerfile build the image once
+        tags = []
+        threads = [threading.Thread(target=build, args=(index,)) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tag = container.docker_image_tag()[1]
+        self.assertTrue(tag.startswith('odoo:runbot_'))
+        self.assertEqual(tags, [tag] * 3)
+        self.assertEqual(self.builds, [tag])
+
+        # the image exists, nothing to build
+        build(3)
+        self.assertEqual(self.builds, [tag])
+        with open(os.path.join(self.tmp_dir, '3', 'logs', 'job_02_docker_build.txt')) as log:
+            self.assertEqual(log.read(), 'Using existing image %s\n' % tag)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, '3', 'docker')))
+
+    def test_docker_build_failed(self):
+        build_dir = os.path.join(self.tmp_dir, 'failed')
+        os.makedirs(os.path.join(build_dir, 'logs'))
+        log_path = os.path.join(build_dir, 'logs', 'job_02_docker_build.txt')
+        self.returncode = 1
+        with self.assertRaises(container.DockerBuildError):
+            container.docker_build(log_path, build_dir)
+        self.assertFalse(self.images)
+
+        # the errors reported by the docker daemon fail the build as well
+        client = MagicMock()
+        client.image_build.return_value = False
+        with patch('odoo.addons.runbot.container.get_docker_client', return_value=client):
+            with self.assertRaises(container.DockerBuildError):
+                container.docker_build(log_path, build_dir)
+        self.assertEqual(len(self.builds), 1, 'The CLI is only a fallback when the API is not usable')
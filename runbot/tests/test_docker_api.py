@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+
+from odoo.addons.runbot.docker_api import DockerClient, DockerAPIError
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super(FakeDockerHandler, self).setup()
+        self.server.connections += 1
+
+    def _respond(self, code, body=None, content_type='application/json'):
+        if isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _respond_chunked(self, chunks, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path, parse_qs(url.query)))
+        if url.path == '/v1.25/_ping':
+            self._respond(200, b'OK', 'text/plain')
+        elif url.path == '/v1.25/containers/json':
+            self._respond(200, [{'Names': ['/1234-master-d0d0ca_job_20_test_all']}])
+        elif url.path == '/v1.25/containers/1234-master-d0d0ca_job_20_test_all/json':
+            self._respond(200, {'State': {'Running': True}})
+        elif url.path == '/v1.25/networks/bridge':
+            self._respond(200, {'IPAM': {'Config': [{'Gateway': '172.17.0.1'}]}})
+        else:
+            self._respond(404, {'message': 'No such container'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(('POST', url.path, parse_qs(url.query)))
+        if url.path.endswith('/stop'):
+            self.server.stop_started.set()
+            self.server.stop_release.wait(5)
+            self._respond(204)
+        elif url.path == '/v1.25/build':
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                dockerfile = tar.extractfile('./Dockerfile').read()
+            lines = [{'stream': 'Step 1/1 : %s\n' % dockerfile.decode().strip()}]
+            if b'fail' in dockerfile:
+                lines.append({'error': 'The command returned a non-zero code: 1'})
+            self._respond_chunked([json.dumps(line).encode() + b'\r\n' for line in lines], 'application/json')
+        else:
+            self._respond(404, {'message': 'page not found'})
+
+
+class FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class TestDockerClient(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDockerClient, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        socket_path = os.path.join(self.tmp_dir, 'docker.sock')
+        self.server = FakeDockerServer(socket_path, FakeDockerHandler)
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.stop_started = threading.Event()
+        self.server.stop_release = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.stop_release.set)
+        self.client = DockerClient(socket_path, timeout=5)
+
+    def test_requests(self):
+        self.assertTrue(self.client.ping())
+        self.assertEqual(self.client.container_names(), {'1234-master-d0d0ca_job_20_test_all'})
+        self.assertTrue(self.client.container_inspect('1234-master-d0d0ca_job_20_test_all'))
+        self.assertIsNone(self.client.container_inspect('1235-master-d0d0ca_job_20_test_all'))
+        self.assertEqual(self.client.network_inspect('bridge')['IPAM']['Config'][0]['Gateway'], '172.17.0.1')
+        with self.assertRaises(DockerAPIError) as e:
+            self.client.request('GET', '/nowhere')
+        self.assertEqual(e.exception.status, 404)
+        self.assertEqual(self.server.connections, 1, 'The connection should be reused')
+
+    def test_stop(self):
+        start = time.time()
+        self.client.container_stop('1234-master-d0d0ca_job_20_test_all', timeout=3, wait=False)
+        self.assertLess(time.time() - start, 1, 'A non blocking stop should not wait for the container')
+        self.assertTrue(self.server.stop_started.wait(5))
+        self.assertEqual(self.server.requests[-1], ('POST', '/v1.25/containers/1234-master-d0d0ca_job_20_test_all/stop', {'t': ['3']}))
+
+        self.server.stop_release.set()
+        self.client.container_stop('1234-master-d0d0ca_job_20_test_all', timeout=3)
+        self.assertEqual(len([r for r in self.server.requests if r[0] == 'POST']), 2)
+
+    def test_build(self):
+        context = os.path.join(self.tmp_dir, 'docker')
+        os.makedirs(context)
+        with open(os.path.join(context, 'Dockerfile'), 'w') as f:
+            f.write('FROM ubuntu:bionic\n')
+        log = io.StringIO()
+        self.assertTrue(self.client.image_build(context, 'odoo:runbot_tests', log))
+        self.assertEqual(log.getvalue(), 'Step 1/1 : FROM ubuntu:bionic\n')
+        self.assertEqual(self.server.requests[-1][2], {'t': ['odoo:runbot_tests'], 'rm': ['1']})
+
+        with open(os.path.join(context, 'Dockerfile'), 'a') as f:
+            f.write('RUN fail\n')
+        log = io.StringIO()
+        self.assertFalse(self.client.image_build(context, 'odoo:runbot_tests', log))
+        self.assertIn('non-zero code', log.getvalue())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from odoo.addons.runbot.export_cache import ExportCache
+
+
+class TestExportCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestExportCache, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.extracted = []
+
+    def extract(self, tree, size):
+        def extract(path):
+            self.extracted.append(tree)
+            os.makedirs(os.path.join(path, 'addons'))
+            with open(os.path.join(path, 'addons', tree), 'w') as f:
+                f.write('x' * size)
+        return extract
+
+    @patch('odoo.addons.runbot.export_cache.ExportCache._supports_reflink', return_value=False)
+    def test_materialize(self, mock_reflink):
+        cache = ExportCache(self.cache_dir, 1000)
+        dest1 = os.path.join(self.tmp_dir, 'build1')
+        dest2 = os.path.join(self.tmp_dir, 'build2')
+
+        # without reflinks, the files are extracted then copied
+        stats = cache.materialize('aaaa', dest1, self.extract('aaaa', 100))
+        self.assertEqual(stats, {'hit': False, 'bytes': 200, 'shared': 0})
+        stats = cache.materialize('aaaa', dest2, self.extract('aaaa', 100))
+        self.assertEqual(stats, {'hit': True, 'bytes': 100, 'shared': 0})
+
+        mock_reflink.return_value = True
+        stats = cache.materialize('aaaa', os.path.join(self.tmp_dir, 'build3'), self.extract('aaaa', 100))
+        self.assertEqual(stats, {'hit': True, 'bytes': 0, 'shared': 100})
+        self.assertEqual(self.extracted, ['aaaa'], 'A tree should only be extracted once')
+
+        # copied from the read-only cache
+        cache_file = os.path.join(self.cache_dir, 'aaaa', 'addons', 'aaaa')
+        build_file = os.path.join(dest2, 'addons', 'aaaa')
+        self.assertNotEqual(os.stat(build_file).st_ino, os.stat(cache_file).st_ino)
+        self.assertFalse(os.stat(cache_file).st_mode & 0o222, 'Cached files should be read-only')
+        self.assertTrue(os.stat(build_file).st_mode & 0o200, 'Copied files should be writable')
+
+        # a second tree is merged in the same build directory
+        cache.materialize('bbbb', dest2, self.extract('bbbb', 100))
+        self.assertEqual(sorted(os.listdir(os.path.join(dest2, 'addons'))), ['aaaa', 'bbbb'])
+
+    def test_materialize_hardlink(self):
+        cache = ExportCache(self.cache_dir, 1000, mode='hardlink')
+        dest = os.path.join(self.tmp_dir, 'build')
+        stats = cache.materialize('aaaa', dest, self.extract('aaaa', 100))
+        self.assertEqual(stats, {'hit': False, 'bytes': 100, 'shared': 100})
+        build_file = os.path.join(dest, 'addons', 'aaaa')
+        self.assertEqual(os.stat(build_file).st_ino, os.stat(os.path.join(self.cache_dir, 'aaaa', 'addons', 'aaaa')).st_ino)
+        self.assertFalse(os.stat(build_file).st_mode & 0o222, 'Hardlinked files should be read-only')
+
+    def test_concurrent_materialize(self):
+        """ Test that the extraction of a tree does not block the other trees """
+        cache = ExportCache(self.cache_dir, 1000)
+        cache.materialize('bbbb', os.path.join(self.tmp_dir, 'bbbb'), self.extract('bbbb', 100))
+        extracting = threading.Event()
+        release = threading.Event()
+
+        def slow_extract(path):
+            extracting.set()
+            release.wait(5)
+            self.extract('aaaa', 100)(path)
+        thread = threading.Thread(target=cache.materialize, args=('aaaa', os.path.join(self.tmp_dir, 'aaaa'), slow_extract))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        self.assertTrue(extracting.wait(5))
+
+        # another tree, cached or not, is materialized meanwhile
+        cache.materialize('bbbb', os.path.join(self.tmp_dir, 'bbbb2'), self.extract('bbbb', 100))
+        cache.materialize('cccc', os.path.join(self.tmp_dir, 'cccc'), self.extract('cccc', 100))
+        self.assertTrue(thread.is_alive())
+        release.set()
+        thread.join(5)
+        self.assertEqual(self.extracted, ['bbbb', 'cccc', 'aaaa'])
+
+    def test_eviction(self):
+        cache = ExportCache(self.cache_dir, 250)
+        for tree in ('aaaa', 'bbbb'):
+            cache.materialize(tree, os.path.join(self.tmp_dir, tree), self.extract(tree, 100))
+        # make bbbb the least recently used entry
+        os.utime(os.path.join(self.cache_dir, 'bbbb'), (0, 0))
+        cache.materialize('aaaa', os.path.join(self.tmp_dir, 'aaaa2'), self.extract('aaaa', 100))
+        cache.materialize('cccc', os.path.join(self.tmp_dir, 'cccc'), self.extract('cccc', 100))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['.aaaa.lock', '.cccc.lock', '.lock', 'aaaa', 'aaaa.size', 'cccc', 'cccc.size'])
+
+    def test_supports_reflink(self):
+        cache = ExportCache(self.cache_dir, 1000)
+        self.assertIn(cache._supports_reflink(), (True, False))
+        self.assertEqual(os.listdir(self.cache_dir), [], 'The probe files should be removed')
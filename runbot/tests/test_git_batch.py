@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from odoo.addons.runbot.git_batch import get_git_batch, reset_git_batch, GitBatchError
+
+
+class TestGitBatch(unittest.TestCase):
+
+    def setUp(self):
+        super(TestGitBatch, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.git_dir = os.path.join(self.tmp_dir, '.git')
+        self.git('init', '-q', self.tmp_dir)
+        self.git('-c', 'user.name=Marc', '-c', 'user.email=marc@example.com', 'commit', '-q', '--allow-empty', '-m', 'First commit\n\nWith a body')
+        self.addCleanup(reset_git_batch, self.git_dir)
+
+    def git(self, *args):
+        return subprocess.check_output(['git', '--git-dir=%s' % self.git_dir, '--work-tree=%s' % self.tmp_dir] + list(args)).decode().strip()
+
+    def test_queries(self):
+        batch = get_git_batch(self.git_dir)
+        head = self.git('rev-parse', 'HEAD')
+        self.assertTrue(batch.exists(head))
+        self.assertFalse(batch.exists('d0d0caca0000ffffffffffffffffffffffffffff'))
+        self.assertEqual(batch.resolve('HEAD'), head)
+        self.assertIsNone(batch.resolve('refs/heads/nothing'))
+
+        info = batch.commit_info('HEAD')
+        self.assertEqual(info['sha'], head)
+        self.assertEqual(info['subject'], 'First commit')
+        self.assertEqual(info['parents'], [])
+        self.assertTrue(info['author'].startswith('Marc <marc@example.com>'))
+        self.assertIsNone(batch.commit_info('refs/heads/nothing'))
+
+    def test_restart(self):
+        batch = get_git_batch(self.git_dir)
+        self.assertTrue(batch.exists('HEAD'))
+        # a dead process is transparently restarted
+        batch.procs['--batch-check'].kill()
+        batch.procs['--batch-check'].wait()
+        self.assertTrue(batch.exists('HEAD'))
+
+        # new objects are seen after a reset
+        self.git('-c', 'user.name=Marc', '-c', 'user.email=marc@example.com', 'commit', '-q', '--allow-empty', '-m', 'Second commit')
+        reset_git_batch(self.git_dir)
+        self.assertEqual(get_git_batch(self.git_dir).commit_info('HEAD')['subject'], 'Second commit')
+
+    def test_no_repo(self):
+        with self.assertRaises(GitBatchError):
+            get_git_batch(os.path.join(self.tmp_dir, 'nothing')).exists('HEAD')
+        reset_git_batch(os.path.join(self.tmp_dir, 'nothing'))
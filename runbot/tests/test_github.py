@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from odoo.addons.runbot.github import GithubClient, RateLimitExceeded
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, code, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(code)
+        for header, value in dict(self.server.rate_headers, **(headers or {})).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, self.headers.get('If-None-Match'), self.client_address))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self._respond(304)
+        else:
+            self._respond(200, {'state': 'open'}, {'ETag': '"v1"'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.requests.append(('POST', self.path, body, self.client_address))
+        self._respond(201, body)
+
+
+class FakeGithubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestGithubClient(unittest.TestCase):
+
+    def setUp(self):
+        super(TestGithubClient, self).setUp()
+        self.server = FakeGithubServer(('127.0.0.1', 0), FakeGithubHandler)
+        self.server.requests = []
+        self.server.rate_headers = {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4999', 'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.client = GithubClient(min_remaining=10, max_delay=0.01)
+
+    def test_conditional_get(self):
+        url = self.base_url + '/repos/odoo/odoo/pulls/1'
+        self.assertEqual(self.client.request(url, 'token'), {'state': 'open'})
+        self.assertEqual(self.client.request(url, 'token'), {'state': 'open'}, 'A 304 should return the cached response')
+        (_, _, etag1, address1), (_, _, etag2, address2) = self.server.requests
+        self.assertIsNone(etag1)
+        self.assertEqual(etag2, '"v1"')
+        self.assertEqual(address1, address2, 'The connection should be kept alive')
+
+        # other tokens do not share the cache
+        self.client.request(url, 'other_token')
+        self.assertIsNone(self.server.requests[-1][2])
+
+    def test_post(self):
+        status = {'state': 'success', 'context': 'ci/runbot'}
+        self.assertEqual(self.client.request(self.base_url + '/repos/odoo/odoo/statuses/d0d0caca', 'token', status), status)
+        self.assertEqual(self.server.requests[-1][:3], ('POST', '/repos/odoo/odoo/statuses/d0d0caca', status))
+
+    def test_rate_limit(self):
+        url = self.base_url + '/repos/odoo/odoo/pulls/1'
+        self.client.request(url, 'token')
+        self.assertEqual(self.client.get_rate_limit('127.0.0.1:%s' % self.server.server_port, 'token')['remaining'], 4999)
+
+        self.server.rate_headers['X-RateLimit-Remaining'] = '0'
+        self.client.request(url, 'token')
+        with self.assertRaises(RateLimitExceeded):
+            self.client.request(url, 'token')
+        self.assertEqual(len(self.server.requests), 2, 'No request should be sent once the rate limit is exhausted')
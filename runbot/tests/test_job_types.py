@@ -4,6 +4,7 @@ from time import localtime
 from unittest.mock import patch
 from odoo.tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
 from odoo.tests import common
+from odoo.addons.runbot.models.build import _sort_jobs, _all_depends
 
 
 class Test_Jobs(common.TransactionCase):
@@ -52,4 +53,31 @@ class Test_Jobs(common.TransactionCase):
         # test run when job_type is all
         self.build.job_type = 'all'
         ret = self.Build._job_10_test_base(self.build, '/tmp/x.log')
-        self.assertEqual("Mocked run", ret, "A build with job_type 'all' should run job_10")
\ No newline at end of file
+        self.assertEqual("Mocked run", ret, "A build with job_type 'all' should run job_10")
+
+    def test_job_pipeline(self):
+        """ Test that jobs run after their dependencies, process-less jobs first """
+        jobs = self.Build._list_jobs()
+        self.assertEqual(jobs[0], 'job_00_init')
+        self.assertEqual(jobs[-1], 'job_30_run')
+        self.assertLess(jobs.index('job_02_docker_build'), jobs.index('job_10_test_base'))
+        self.assertLess(jobs.index('job_20_test_all'), jobs.index('job_29_results'))
+        # the results do not wait for the coverage container
+        self.assertLess(jobs.index('job_29_results'), jobs.index('job_21_coverage_html'))
+        self.assertLess(jobs.index('job_21_coverage_html'), jobs.index('job_22_coverage_result'))
+        # the coverage html is generated alongside the running build
+        depends = self.Build._get_job_depends()
+        self.assertIn('job_10_test_base', depends['job_20_test_all'])
+        self.assertIn('job_29_results', depends['job_30_run'])
+        self.assertNotIn('job_21_coverage_html', depends['job_30_run'])
+
+        def job(depends, resources=()):
+            return {'depends': depends, 'resources': resources}
+
+        self.assertEqual(_sort_jobs({'job_00': job(None), 'job_10': job(None), 'job_05': job(None)}), ['job_00', 'job_05', 'job_10'])
+        jobs = {'job_00': job(None), 'job_10': job(['job_00']), 'job_20': job(['job_00']), 'job_30': job(['job_10'])}
+        self.assertEqual(_all_depends(jobs, _sort_jobs(jobs)), {'job_00': set(), 'job_10': {'job_00'}, 'job_20': {'job_00'}, 'job_30': {'job_00', 'job_10'}})
+        with self.assertRaises(ValueError):
+            _sort_jobs({'job_00': job(['job_10']), 'job_10': job(['job_00'])})
+        with self.assertRaises(ValueError):
+            _sort_jobs({'job_00': job(['job_05'])})
@@ -4,6 +4,7 @@ from time import localtime
 from unittest.mock import patch
 from odoo.tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
 from odoo.tests import common
+from odoo.addons.runbot.log_analyzer import LogSummary
 
 
 class Test_Jobs(common.TransactionCase):
@@ -36,6 +37,7 @@ class Test_Jobs(common.TransactionCase):
             'job_end': False,
         })
         res = self.Build._job_00_init(build, '/tmp/x.log')
+        self.env['runbot.commit.status']._send_statuses()
         self.assertEqual(res, -2)
         expected_status = {
             'state': 'pending',
@@ -43,7 +45,7 @@ class Test_Jobs(common.TransactionCase):
             'description': 'runbot build %s (runtime 0s)' % build.dest,
             'context': 'ci/runbot'
         }
-        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status, ignore_errors=True)
+        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status)
 
     @patch('odoo.addons.runbot.models.build.docker_get_gateway_ip')
     @patch('odoo.addons.runbot.models.repo.runbot_repo._domain')
@@ -73,6 +75,7 @@ class Test_Jobs(common.TransactionCase):
         })
         self.assertFalse(build.result)
         self.Build._job_29_results(build, '/tmp/x.log')
+        self.env['runbot.commit.status']._send_statuses()
         self.assertEqual(build.result, 'ko')
         expected_status = {
             'state': 'failure',
@@ -80,9 +83,9 @@ class Test_Jobs(common.TransactionCase):
             'description': 'runbot build %s (runtime 0s)' % build.dest,
             'context': 'ci/runbot'
         }
-        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status, ignore_errors=True)
+        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status)
 
-    @patch('odoo.addons.runbot.models.build.rfind')
+    @patch('odoo.addons.runbot.models.build.analyze_log')
     @patch('odoo.addons.runbot.models.build.docker_get_gateway_ip')
     @patch('odoo.addons.runbot.models.repo.runbot_repo._domain')
     @patch('odoo.addons.runbot.models.repo.runbot_repo._github')
@@ -91,14 +94,10 @@ class Test_Jobs(common.TransactionCase):
     @patch('odoo.addons.runbot.models.build.time.localtime')
     @patch('odoo.addons.runbot.models.build.docker_run')
     @patch('odoo.addons.runbot.models.build.grep')
-    def test_job_29_warned(self, mock_grep, mock_docker_run, mock_localtime, mock_getmtime, mock_cmd, mock_github, mock_domain, mock_docker_get_gateway, mock_rfind):
+    def test_job_29_warned(self, mock_grep, mock_docker_run, mock_localtime, mock_getmtime, mock_cmd, mock_github, mock_domain, mock_docker_get_gateway, mock_analyze_log):
         """ Test that a warn build sets the failure state on github """
-
-        def rfind_side_effect(logfile, regex):
-            return True if 'WARNING' in regex else False
-
         a_time = datetime.datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
-        mock_rfind.side_effect = rfind_side_effect
+        mock_analyze_log.return_value = LogSummary(modules_loaded=True, warning_count=1)
         mock_grep.return_value = True
         mock_docker_run.return_value = 2
         now = localtime()
@@ -116,6 +115,7 @@ class Test_Jobs(common.TransactionCase):
         })
         self.assertFalse(build.result)
         self.Build._job_29_results(build, '/tmp/x.log')
+        self.env['runbot.commit.status']._send_statuses()
         self.assertEqual(build.result, 'warn')
         expected_status = {
             'state': 'failure',
@@ -123,4 +123,4 @@ class Test_Jobs(common.TransactionCase):
             'description': 'runbot build %s (runtime 0s)' % build.dest,
             'context': 'ci/runbot'
         }
-        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status, ignore_errors=True)
+        mock_github.assert_called_with('/repos/:owner/:repo/statuses/d0d0caca0000ffffffffffffffffffffffffffff', expected_status)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from odoo.addons.runbot.log_analyzer import analyze_log, reset_log_summary
+
+LOG_START = """\
+2019-01-07 10:00:00,000 42 INFO 1234-master-d0d0ca-all odoo.modules.loading: loading 1 modules...
+2019-01-07 10:00:01,000 42 INFO 1234-master-d0d0ca-all odoo.addons.base.models.ir_ui_view: rendering
+2019-01-07 10:00:02,000 42 WARNING 1234-master-d0d0ca-all odoo.addons.mail.models.mail_thread: deprecated
+"""
+LOG_END = """\
+2019-01-07 10:00:03,000 42 ERROR 1234-master-d0d0ca-all odoo.addons.sale.tests.test_sale: FAIL: test_sale
+Traceback (most recent call last):
+  File "sale/tests/test_sale.py", line 1, in test_sale
+2019-01-07 10:00:04,000 42 INFO 1234-master-d0d0ca-all odoo.modules.loading: Modules loaded.
+2019-01-07 10:00:05,000 42 INFO 1234-master-d0d0ca-all odoo.service.server: Initiating shutdown.
+"""
+
+
+class TestLogAnalyzer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestLogAnalyzer, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.log_path = os.path.join(self.tmp_dir, 'job_20_test_all.txt')
+
+    def write(self, content, mode='a'):
+        with open(self.log_path, mode) as f:
+            f.write(content)
+
+    def test_summary(self):
+        self.write(LOG_START + LOG_END)
+        summary = analyze_log(self.log_path, final=True)
+        self.assertTrue(summary.modules_loaded)
+        self.assertTrue(summary.shutdown)
+        self.assertEqual(summary.error_count, 2)
+        self.assertEqual(summary.warning_count, 1)
+        self.assertEqual(summary.first_warning, LOG_START.rindex('2019'))
+        self.assertEqual(summary.first_error, len(LOG_START))
+        self.assertEqual(summary.modules['sale']['errors'], 2)
+        self.assertEqual(summary.modules['mail']['warnings'], 1)
+        self.assertEqual(summary.modules['base'], {'start': LOG_START.index('2019', 1), 'end': LOG_START.index('2019', 1), 'errors': 0, 'warnings': 0})
+        self.assertEqual(summary.offset, os.path.getsize(self.log_path))
+
+    def test_resume(self):
+        # the unterminated last line is left for the next analysis
+        self.write(LOG_START + LOG_END[:20])
+        summary = analyze_log(self.log_path)
+        self.assertEqual((summary.offset, summary.error_count, summary.warning_count), (len(LOG_START), 0, 1))
+        self.assertFalse(summary.modules_loaded)
+
+        self.write(LOG_END[20:])
+        summary = analyze_log(self.log_path)
+        self.assertEqual((summary.error_count, summary.warning_count), (2, 1))
+        self.assertTrue(summary.modules_loaded)
+        self.assertEqual(summary.first_error, len(LOG_START))
+        self.assertEqual(summary.offset, os.path.getsize(self.log_path))
+
+        # nothing new to read
+        self.assertEqual(analyze_log(self.log_path).to_dict(), summary.to_dict())
+
+        # a new run of the job truncates the log
+        self.write(LOG_START, mode='w')
+        summary = analyze_log(self.log_path)
+        self.assertEqual((summary.error_count, summary.warning_count), (0, 1))
+
+        reset_log_summary(self.log_path)
+        self.write(LOG_END, mode='w')
+        summary = analyze_log(self.log_path)
+        self.assertEqual((summary.error_count, summary.warning_count), (2, 0))
+        self.assertIsNone(summary.first_warning)
+
+    def test_error_rules(self):
+        """ Test that errors and warnings are found on any line, whatever its logger name """
+        self.write(
+            "2019-01-07 10:00:00,000 42 ERROR 1234-master-d0d0ca-all odoo.addons.sale-fix[1]: Boom\n"
+            "2019-01-07 10:00:01,000 42 INFO 1234-master-d0d0ca-all odoo.http: Exception during request: Traceback (most recent call last):\n"
+            "2019-01-07 10:00:02,000 42 WARNING ? werkzeug/serving: Slow request\n"
+            "2019-01-07 10:00:03,000 42 INFO 1234-master-d0d0ca-all odoo.addons.sale: An ERROR in the message\n"
+        )
+        summary = analyze_log(self.log_path, final=True)
+        self.assertEqual((summary.error_count, summary.warning_count), (2, 1))
+
+    def test_missing_log(self):
+        summary = analyze_log(self.log_path, final=True)
+        self.assertFalse(summary.modules_loaded)
+        self.assertFalse(os.path.exists('%s.summary.json' % self.log_path))
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
-from unittest.mock import patch
+import datetime
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+from unittest.mock import call, patch
 from odoo.tests import common
 
 class Test_Repo(common.TransactionCase):
@@ -15,3 +21,362 @@ class Test_Repo(common.TransactionCase):
         self.assertEqual(repo.path, '/tmp/static/repo/bla_example.com_foo_bar')
 
         self.assertEqual(repo.base, 'example.com/foo/bar')
+
+    @patch.dict('odoo.addons.runbot.models.repo._fetch_backoff')
+    @patch('odoo.addons.runbot.models.repo._fetch')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._need_fetch')
+    def test_update_backoff(self, mock_need_fetch, mock_fetch):
+        """ Test that a repo failing to fetch does not prevent other repos
+        to be fetched and is not fetched again before its backoff delay """
+        mock_need_fetch.return_value = True
+
+        def fetch_side_effect(cmd, timeout):
+            if 'bla_example.com_foo_hang' in cmd[1]:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+
+        mock_fetch.side_effect = fetch_side_effect
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar'})
+        hanging_repo = self.Repo.create({'name': 'bla@example.com:foo/hang'})
+        self.Repo._update(repo | hanging_repo, force=False)
+        self.assertEqual(mock_fetch.call_count, 2)
+
+        mock_fetch.reset_mock()
+        self.Repo._update(repo | hanging_repo, force=False)
+        self.assertEqual(mock_fetch.call_count, 1, 'The failing repo should not be fetched during its backoff delay')
+        self.assertIn('bla_example.com_foo_bar', mock_fetch.call_args[0][0][1])
+
+        mock_fetch.reset_mock()
+        self.Repo._update(hanging_repo, force=True)
+        self.assertEqual(mock_fetch.call_count, 1, 'A forced update should ignore the backoff delay')
+
+    @patch.dict('odoo.addons.runbot.models.repo._refs_snapshots')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._get_refs_stamp')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._git')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_find_new_commits_incremental(self, mock_root, mock_git, mock_stamp):
+        """ Test that only refs that changed since the last pass are processed """
+        tmp_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_root)
+        mock_root.return_value = tmp_root
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar'})
+        Build = self.env['runbot.build']
+
+        def git_output(refs):
+            date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S +0000')
+            return '\n'.join('\x00'.join([name, sha, date, 'Marc', '<marc@example.com>', 'A subject', 'Marc', '<marc@example.com>']) for name, sha in refs)
+
+        def create_pending_builds():
+            # like the cron, the snapshots are saved once the builds are committed
+            self.Repo._save_refs_snapshots(self.Repo._create_pending_builds(repo))
+
+        mock_stamp.return_value = 'stamp1'
+        mock_git.return_value = git_output([('refs/heads/master', 'd0d0caca0000ffffffffffffffffffffffffffff'),
+                                            ('refs/heads/11.0', 'deadbeef0000ffffffffffffffffffffffffffff')])
+        repo._find_new_commits(repo)
+        self.assertEqual(Build.search_count([('repo_id', '=', repo.id)]), 2)
+        self.assertIsNone(repo._get_refs_snapshot()['stamp'], 'The snapshot should not be saved before the builds are committed')
+        create_pending_builds()
+
+        # same stamp: git is not even called
+        mock_git.reset_mock()
+        create_pending_builds()
+        self.assertFalse(mock_git.called)
+
+        # new stamp: only the moved ref is processed
+        mock_stamp.return_value = 'stamp2'
+        mock_git.return_value = git_output([('refs/heads/master', 'cafecafe0000ffffffffffffffffffffffffffff'),
+                                            ('refs/heads/11.0', 'deadbeef0000ffffffffffffffffffffffffffff')])
+        with patch('odoo.addons.runbot.models.branch.runbot_branch.create') as mock_branch_create:
+            create_pending_builds()
+            self.assertFalse(mock_branch_create.called)
+        self.assertEqual(Build.search_count([('repo_id', '=', repo.id)]), 3)
+        self.assertEqual(Build.search([('repo_id', '=', repo.id)], limit=1).name, 'cafecafe0000ffffffffffffffffffffffffffff')
+
+        # the snapshot is reloaded from disk
+        with patch.dict('odoo.addons.runbot.models.repo._refs_snapshots', clear=True):
+            self.assertEqual(repo._get_refs_snapshot()['stamp'], 'stamp2')
+
+        # a failing repo keeps its snapshot, its refs are processed again next time
+        other_repo = self.Repo.create({'name': 'bla@example.com:foo/other'})
+        mock_stamp.return_value = 'stamp3'
+        mock_git.return_value = git_output([('refs/heads/master', 'facefeed0000ffffffffffffffffffffffffffff')])
+
+        with patch('odoo.addons.runbot.models.repo.runbot_repo._create_builds', autospec=True) as mock_create_builds:
+            def create_builds_side_effect(record, refs):
+                if record == repo:
+                    self.env.cr.execute("SELECT 1/0")
+            mock_create_builds.side_effect = create_builds_side_effect
+            snapshots = self.Repo._create_pending_builds(repo | other_repo)
+        self.assertEqual(list(snapshots), [other_repo.id])
+        # the transaction is still usable
+        self.assertEqual(Build.search_count([('repo_id', '=', repo.id)]), 3)
+
+    def test_create_builds_batch(self):
+        """ Test the batch creation of branches and builds from refs """
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar'})
+        Branch = self.env['runbot.branch']
+        Build = self.env['runbot.build']
+        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S +0000')
+        old_date = (datetime.datetime.now() - datetime.timedelta(days=60)).strftime('%Y-%m-%d %H:%M:%S +0000')
+        author = ('Marc', '<marc@example.com>', 'A subject', 'Marc', '<marc@example.com>')
+
+        dev_branch = Branch.create({'repo_id': repo.id, 'name': 'refs/heads/master-fix-moc'})
+        old_build = Build.create({'branch_id': dev_branch.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+
+        refs = [
+            ('refs/heads/master-fix-moc', 'deadbeef0000ffffffffffffffffffffffffffff', date) + author,
+            ('refs/heads/master-coverage', 'deadbeef0000ffffffffffffffffffffffffffff', date) + author,
+            ('refs/heads/10.0', 'cafecafe0000ffffffffffffffffffffffffffff', old_date) + author,
+        ]
+        new_builds = repo._create_builds(refs)
+
+        self.assertEqual(len(new_builds), 2)
+        self.assertFalse(Branch.search([('repo_id', '=', repo.id), ('name', '=', 'refs/heads/10.0')]), 'Old refs should not create branches')
+        coverage_branch = Branch.search([('repo_id', '=', repo.id), ('name', '=', 'refs/heads/master-coverage')])
+        self.assertEqual(coverage_branch.branch_name, 'master-coverage')
+        self.assertTrue(coverage_branch.coverage)
+
+        new_dev_build = new_builds.filtered(lambda b: b.branch_id == dev_branch)
+        self.assertEqual(old_build.result, 'skipped', 'Pending builds should be skipped by a new ref')
+        self.assertEqual(new_dev_build.sequence, old_build.sequence, 'New build should take the sequence of the skipped one')
+        self.assertEqual(new_dev_build.state, 'pending')
+        self.assertEqual(new_dev_build.repo_id, repo)
+        self.assertEqual(new_dev_build.job_type, 'all')
+        self.assertEqual(new_dev_build.dest, '%05d-master-fix-moc-deadbe' % new_dev_build.id)
+        self.assertFalse(new_dev_build.duplicate_check, 'Builds of a repo without duplicate chain need no duplicate detection')
+        self.assertFalse(new_dev_build.fingerprint)
+
+        # nothing new
+        self.assertFalse(repo._create_builds(refs))
+
+        # a branch inserted by a concurrent transaction is not returned by _create_batch
+        def create_batch_side_effect(branch_model, repo_id, names):
+            for name in names:
+                Branch.create({'repo_id': repo_id, 'name': name})
+            return Branch
+        with patch('odoo.addons.runbot.models.branch.runbot_branch._create_batch', autospec=True) as mock_create_batch:
+            mock_create_batch.side_effect = create_batch_side_effect
+            race_builds = repo._create_builds([('refs/heads/master-race', 'deadbeef0000ffffffffffffffffffffffffffff', date) + author])
+        self.assertEqual(race_builds.branch_id.name, 'refs/heads/master-race')
+
+    def test_deferred_duplicates(self):
+        """ Test that the builds created in batch are only queued once their duplicate detection ran """
+        Branch = self.env['runbot.branch']
+        Build = self.env['runbot.build']
+        Queue = self.env['runbot.build.queue']
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar'})
+        dev_repo = self.Repo.create({'name': 'bla@example.com:foo-dev/bar', 'duplicate_id': repo.id})
+        branch = Branch.create({'repo_id': repo.id, 'name': 'refs/heads/master'})
+        build = Build.create({'branch_id': branch.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+
+        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S +0000')
+        author = ('Marc', '<marc@example.com>', 'A subject', 'Marc', '<marc@example.com>')
+        dev_builds = dev_repo._create_builds([
+            ('refs/heads/master', 'd0d0caca0000ffffffffffffffffffffffffffff', date) + author,
+            ('refs/heads/master-other', 'deadbeef0000ffffffffffffffffffffffffffff', date) + author,
+        ])
+        self.assertEqual(dev_builds.mapped('state'), ['pending', 'pending'], 'The duplicate detection should not run during the ingestion')
+        self.assertTrue(all(dev_builds.mapped('duplicate_check')))
+        self.assertFalse(Queue.search([('build_id', 'in', dev_builds.ids)]), 'Builds not checked for duplicates should not be scheduled')
+
+        self.assertEqual(Build._check_pending_duplicates(), dev_builds)
+        duplicate = dev_builds.filtered(lambda b: b.name == build.name)
+        self.assertEqual(duplicate.state, 'duplicate')
+        self.assertEqual(duplicate.duplicate_id, build)
+        self.assertTrue(all(dev_builds.mapped('fingerprint')))
+        self.assertFalse(any(dev_builds.mapped('duplicate_check')))
+        self.assertEqual(Queue.search([('build_id', 'in', dev_builds.ids)]).mapped('build_id'), dev_builds - duplicate)
+
+    @patch.dict('odoo.addons.runbot.models.repo._refs_snapshots')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._clone')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._git')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_hook_refs(self, mock_root, mock_git, mock_clone):
+        """ Test that refs received by the hook are fetched and built directly """
+        tmp_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_root)
+        mock_root.return_value = tmp_root
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar', 'mode': 'hook'})
+        HookRef = self.env['runbot.hook.ref']
+        date = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+        user = {'name': 'Marc', 'email': 'marc@example.com'}
+        HookRef._create_from_payload(repo, 'push', {
+            'ref': 'refs/heads/master',
+            'after': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'head_commit': {'id': 'd0d0caca0000ffffffffffffffffffffffffffff', 'timestamp': date, 'message': 'A subject\n\nA body', 'author': user, 'committer': user},
+        })
+        HookRef._create_from_payload(repo, 'push', {'ref': 'refs/heads/gone', 'after': '0' * 40, 'deleted': True})
+        HookRef._create_from_payload(repo, 'pull_request', {'action': 'closed', 'number': 42, 'pull_request': {'head': {'sha': 'deadbeef0000ffffffffffffffffffffffffffff'}}})
+        HookRef._create_from_payload(repo, 'pull_request', {'action': 'synchronize', 'number': 42, 'pull_request': {'head': {'sha': 'deadbeef0000ffffffffffffffffffffffffffff'}}})
+        HookRef._create_from_payload(repo, 'push', {'ref': 'refs/heads/uptodate', 'after': 'beefbeef0000ffffffffffffffffffffffffffff'})
+        HookRef._create_from_payload(repo, 'push', {'ref': 'refs/heads/removed', 'after': 'abcdabcd0000ffffffffffffffffffffffffffff'})
+        self.assertEqual(HookRef.search([('repo_id', '=', repo.id)]).mapped('name'), ['refs/heads/master', 'refs/pull/42', 'refs/heads/uptodate', 'refs/heads/removed'])
+
+        disabled_repo = self.Repo.create({'name': 'bla@example.com:foo/disabled', 'mode': 'poll'})
+        HookRef._create_from_payload(disabled_repo, 'push', {'ref': 'refs/heads/master', 'after': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+        disabled_repo.mode = 'disabled'
+        self.assertFalse(HookRef._create_from_payload(disabled_repo, 'push', {'ref': 'refs/heads/other', 'after': 'd0d0caca0000ffffffffffffffffffffffffffff'}))
+        self.assertEqual(HookRef.search([('repo_id', '=', disabled_repo.id)]).mapped('name'), ['refs/heads/master'])
+
+        def git_side_effect(cmd):
+            if cmd[:3] == ['for-each-ref', '--format', '%(refname)%00%(objectname)']:
+                self.assertEqual(sorted(cmd[3:]), ['refs/heads/master', 'refs/heads/removed', 'refs/heads/uptodate', 'refs/pull/42'])
+                return 'refs/heads/master\x00d0d0caca0000eeeeeeeeeeeeeeeeeeeeeeeeeeee\nrefs/heads/uptodate\x00beefbeef0000ffffffffffffffffffffffffffff\n'
+            if cmd[0] == 'for-each-ref':
+                self.assertEqual(sorted(cmd[3:]), ['refs/heads/master', 'refs/pull/42'])
+                # the payload is not trusted, the fetched refs are
+                return '\n'.join('\x00'.join(ref) for ref in [
+                    ['refs/heads/master', 'cafecafe0000ffffffffffffffffffffffffffff', date, 'Marc', '<marc@example.com>', 'The fetched subject', 'Marc', '<marc@example.com>'],
+                    ['refs/heads/master/other', 'cafecafe0000ffffffffffffffffffffffffffff', date, 'Marc', '<marc@example.com>', 'Not a hook ref', 'Marc', '<marc@example.com>'],
+                    ['refs/pull/42', 'deadbeef0000ffffffffffffffffffffffffffff', date, 'Marc', '<marc@example.com>', 'A PR', 'Marc', '<marc@example.com>'],
+                ])
+            if cmd[0] == 'fetch' and '+refs/heads/removed:refs/heads/removed' in cmd:
+                raise subprocess.CalledProcessError(128, cmd)
+            return ''
+
+        mock_git.side_effect = git_side_effect
+        self.Repo._process_hook_refs(repo)
+
+        # the batch fails on the removed ref, the others are fetched one by one
+        mock_git.assert_any_call(['fetch', 'origin', '+refs/heads/master:refs/heads/master', '+refs/pull/42/head:refs/pull/42', '+refs/heads/removed:refs/heads/removed'])
+        mock_git.assert_any_call(['fetch', 'origin', '+refs/heads/master:refs/heads/master'])
+        mock_git.assert_any_call(['fetch', 'origin', '+refs/pull/42/head:refs/pull/42'])
+        self.assertNotIn(call(['fetch', 'origin', '+refs/heads/uptodate:refs/heads/uptodate']), mock_git.call_args_list, 'A ref already at the announced commit should not be fetched')
+        self.assertFalse(HookRef.search([('repo_id', '=', repo.id)]), 'Processed hook refs should be removed from the queue')
+        self.assertFalse(HookRef.search([('repo_id', '=', disabled_repo.id)]), 'Hook refs of disabled repos should be purged')
+        builds = self.env['runbot.build'].search([('repo_id', '=', repo.id)])
+        self.assertEqual(sorted(builds.mapped('subject')), ['A PR', 'The fetched subject'])
+        self.assertEqual(sorted(builds.mapped('name')), ['cafecafe0000ffffffffffffffffffffffffffff', 'deadbeef0000ffffffffffffffffffffffffffff'])
+        self.assertIsNone(repo._get_refs_snapshot()['stamp'], 'The refs snapshot should only be saved by the full pass')
+
+    @patch('odoo.addons.runbot.models.repo.os.kill')
+    @patch('odoo.addons.runbot.models.repo.fqdn')
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_reload_nginx(self, mock_root, mock_fqdn, mock_kill):
+        """ Test that nginx is only reloaded when the routing changes """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mock_root.return_value = tmp_dir
+        mock_fqdn.return_value = 'runbotxx'
+        repo = self.Repo.create({'name': 'bla@example.com:foo/bar', 'nginx': True})
+        branch = self.env['runbot.branch'].create({'repo_id': repo.id, 'name': 'refs/heads/master'})
+        build = self.env['runbot.build'].create({
+            'branch_id': branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'state': 'running',
+            'host': 'runbotxx',
+            'port': 2000,
+        })
+        os.makedirs(os.path.join(tmp_dir, 'nginx'))
+        with open(os.path.join(tmp_dir, 'nginx', 'nginx.pid'), 'w') as f:
+            f.write('4242')
+
+        self.Repo._reload_nginx()
+        mock_kill.assert_called_with(4242, signal.SIGHUP)
+        with open(os.path.join(tmp_dir, 'nginx', 'builds.conf')) as f:
+            self.assertIn('"%s" 2000;' % build.dest, f.read())
+
+        # nothing changed, nginx is not reloaded
+        self.Repo._reload_nginx()
+        mock_kill.assert_called_with(4242, 0)
+
+        build.state = 'done'
+        self.Repo._reload_nginx()
+        mock_kill.assert_called_with(4242, signal.SIGHUP)
+        with open(os.path.join(tmp_dir, 'nginx', 'builds.conf')) as f:
+            self.assertNotIn(build.dest, f.read())
+
+    @patch('odoo.addons.runbot.models.build.runbot_build._branch_exists')
+    def test_revdep_builds(self, mock_branch_exists):
+        """ Test that a burst of commits in a dependency triggers a single rebuild """
+        mock_branch_exists.return_value = True
+        Branch = self.env['runbot.branch']
+        Build = self.env['runbot.build']
+        community_repo = self.Repo.create({'name': 'bla@example.com:foo/community'})
+        enterprise_repo = self.Repo.create({'name': 'bla@example.com:foo/enterprise', 'dependency_ids': [(4, community_repo.id)]})
+        Branch.create({'repo_id': community_repo.id, 'name': 'refs/heads/master', 'sticky': True})
+        enterprise_branch = Branch.create({'repo_id': enterprise_repo.id, 'name': 'refs/heads/master', 'sticky': True})
+        enterprise_build = Build.create({'branch_id': enterprise_branch.id, 'name': 'e0e0e0e00000ffffffffffffffffffffffffffff'})
+        enterprise_build.write({'state': 'done', 'result': 'ok'})
+
+        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S +0000')
+        author = ('Marc', '<marc@example.com>', 'A subject', 'Marc', '<marc@example.com>')
+        new_builds = community_repo._create_builds([('refs/heads/master', 'd0d0caca0000ffffffffffffffffffffffffffff', date) + author])
+        rebuild = Build.search([('branch_id', '=', enterprise_branch.id), ('state', '=', 'pending')])
+        self.assertEqual(len(rebuild), 1)
+        self.assertEqual(rebuild.name, enterprise_build.name)
+        self.assertEqual(new_builds.revdep_build_ids, rebuild)
+
+        # the pending rebuild absorbs the next commit
+        new_builds = community_repo._create_builds([('refs/heads/master', 'deadbeef0000ffffffffffffffffffffffffffff', date) + author])
+        self.assertEqual(Build.search([('branch_id', '=', enterprise_branch.id), ('state', '=', 'pending')]), rebuild)
+        self.assertEqual(new_builds.revdep_build_ids, rebuild)
+
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_partial_clone_maintenance(self, mock_root):
+        """ Test the export of a partial clone and the git maintenance """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mock_root.return_value = tmp_dir
+        src = os.path.join(tmp_dir, 'src')
+        git = lambda *args: subprocess.check_output(('git', '-C', src) + args)
+        subprocess.check_call(['git', 'init', '-q', src])
+        with open(os.path.join(src, 'README'), 'w') as f:
+            f.write('hello')
+        git('add', 'README')
+        git('-c', 'user.name=Marc', '-c', 'user.email=marc@example.com', 'commit', '-q', '-m', 'init')
+        git('config', 'uploadpack.allowfilter', 'true')
+        git('config', 'uploadpack.allowanysha1inwant', 'true')
+
+        repo = self.Repo.create({'name': 'file://%s' % src, 'partial_clone': True})
+        repo._clone()
+        missing = repo._git(['rev-list', '--objects', '--missing=print', 'HEAD^{tree}'])
+        self.assertIn('?', missing, 'Blobs should not be cloned')
+
+        dest = os.path.join(tmp_dir, 'build')
+        os.makedirs(dest)
+        repo._git_archive('HEAD', dest)
+        with open(os.path.join(dest, 'README')) as f:
+            self.assertEqual(f.read(), 'hello')
+
+        timings = repo._git_maintenance()
+        self.assertEqual(set(timings), {'probe_before', 'commit-graph', 'multi-pack-index', 'expire', 'repack', 'probe_after'})
+        self.assertTrue(os.path.exists(os.path.join(repo.path, 'objects', 'pack', 'multi-pack-index')))
+
+    @patch('odoo.addons.runbot.models.repo.runbot_repo._root')
+    def test_alternates(self, mock_root):
+        """ Test that the repos of a duplicate chain share the objects of the oldest one """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        mock_root.return_value = tmp_dir
+        src = os.path.join(tmp_dir, 'src')
+        subprocess.check_call(['git', 'init', '-q', src])
+        with open(os.path.join(src, 'README'), 'w') as f:
+            f.write('hello')
+        subprocess.check_call(['git', '-C', src, 'add', 'README'])
+        subprocess.check_call(['git', '-C', src, '-c', 'user.name=Marc', '-c', 'user.email=marc@example.com', 'commit', '-q', '-m', 'init'])
+        src_dev = os.path.join(tmp_dir, 'src-dev')
+        subprocess.check_call(['git', 'clone', '-q', src, src_dev])
+
+        repo = self.Repo.create({'name': 'file://%s' % src})
+        dev_repo = self.Repo.create({'name': 'file://%s' % src_dev, 'duplicate_id': repo.id})
+        other_dev_repo = self.Repo.create({'name': 'file://%s/.git' % src_dev, 'duplicate_id': dev_repo.id})
+        self.assertEqual(other_dev_repo._get_duplicate_chain(), repo | dev_repo | other_dev_repo)
+
+        # the dev repo is cloned first, it gets the alternates once the root is cloned
+        dev_repo._clone()
+        self.assertEqual(dev_repo._get_objects_root(), dev_repo)
+        repo._clone()
+        self.assertEqual(dev_repo._get_objects_root(), repo)
+        dev_repo._clone()
+        with open(os.path.join(dev_repo.path, 'objects', 'info', 'alternates')) as f:
+            self.assertEqual(f.read(), os.path.join(repo.path, 'objects') + '\n')
+        self.assertEqual(repo._git(['config', 'gc.pruneExpire']).strip(), 'never')
+        self.assertFalse(os.listdir(os.path.join(dev_repo.path, 'objects', 'pack')), 'Objects of the root should not be duplicated')
+
+        other_dev_repo._clone()
+        with open(os.path.join(other_dev_repo.path, 'objects', 'info', 'alternates')) as f:
+            self.assertEqual(f.read(), os.path.join(repo.path, 'objects') + '\n')
+        self.assertTrue(dev_repo._hash_exists('HEAD'))
+        self.assertEqual(other_dev_repo._git_rev_parse('HEAD'), repo._git_rev_parse('HEAD'))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
+import time
 from unittest.mock import patch
 from odoo.tests import common
 import odoo
@@ -48,3 +50,120 @@ class TestSchedule(common.TransactionCase):
         build_ids._schedule()
         self.assertEqual(build.state, 'done')
         self.assertEqual(build.result, 'ko')
+
+    @patch('odoo.addons.runbot.models.build.docker_get_gateway_ip')
+    @patch('odoo.addons.runbot.models.build.grep')
+    @patch('odoo.addons.runbot.models.build.runbot_build._cmd')
+    @patch('odoo.addons.runbot.models.build.docker_run')
+    @patch('odoo.addons.runbot.models.build.docker_state')
+    @patch('odoo.addons.runbot.models.build.os.makedirs')
+    @patch('odoo.addons.runbot.models.build.docker_is_running')
+    def test_schedule_concurrent_jobs(self, mock_running, mock_makedirs, mock_docker_state, mock_docker_run, mock_cmd, mock_grep, mock_gateway):
+        """ Test that independent container jobs run side by side and that the timeout applies to each job """
+        mock_docker_run.return_value = 1234
+        mock_cmd.return_value = ([], [])
+        mock_grep.return_value = False
+        mock_gateway.return_value = None
+        build = self.Build.create({
+            'state': 'testing',
+            'branch_id': self.branch.id,
+            'name': 'd0d0caca0000ffffffffffffffffffffffffffff',
+            'port': '1234',
+            'host': 'runbotxx',
+            'job_start': datetime.datetime.now(),
+            'job_type': 'all',
+            'coverage': True,
+            'job': 'job_21_coverage_html',
+            'running_jobs': json.dumps({'job_21_coverage_html': time.time()}),
+        })
+        running_containers = {build._get_docker_name('job_21_coverage_html')}
+        mock_running.side_effect = lambda name: name in running_containers
+
+        # the build starts running while the coverage html is generated
+        build._schedule()
+        self.assertEqual(build.job, 'job_21_coverage_html')
+        self.assertEqual(build.state, 'testing')
+        self.assertEqual(set(build._get_running_jobs()), {'job_21_coverage_html', 'job_30_run'})
+        self.assertEqual(mock_docker_run.call_count, 1)
+        self.assertEqual(mock_docker_run.call_args[0][3], build._get_docker_name('job_30_run'))
+        running_containers.add(build._get_docker_name('job_30_run'))
+
+        # a job started long ago overpasses the timeout even if the build is younger
+        self.env['ir.config_parameter'].set_param('runbot.runbot_timeout', 60)
+        running = build._get_running_jobs()
+        build.running_jobs = json.dumps(dict(running, job_21_coverage_html=time.time() - 120))
+        with patch('odoo.addons.runbot.models.build.runbot_build._kill') as mock_kill:
+            build._schedule()
+        mock_kill.assert_called_once_with(result='killed')
+        build.running_jobs = json.dumps(running)
+
+        # once the coverage html is generated, the build gets to the job already running
+        running_containers.discard(build._get_docker_name('job_21_coverage_html'))
+        build._schedule()
+        self.assertEqual(build.job, 'job_30_run')
+        self.assertEqual(build.state, 'running')
+        self.assertEqual(set(build._get_running_jobs()), {'job_30_run'})
+        self.assertEqual(mock_docker_run.call_count, 1)
+
+    def _replay_queue(self, repos, slots):
+        """Schedule the pending builds of repos, slots builds at a time, and
+        return the number of scheduling rounds each build waited by repo"""
+        Queue = self.env['runbot.build.queue']
+        latencies = {repo: [] for repo in repos}
+        rounds = 0
+        while True:
+            build_ids = Queue._get_next_builds(repos.ids, slots)
+            if not build_ids:
+                return latencies
+            rounds += 1
+            for build in self.Build.browse(build_ids):
+                latencies[build.repo_id].append(rounds)
+            self.Build.browse(build_ids).write({'host': 'runbotxx'})
+
+    def test_queue_policy(self):
+        """ Test that a busy repo does not starve the others with the fair queue policy """
+        quiet_repo = self.Repo.create({'name': 'bla@example.com:foo/quiet'})
+        quiet_branch = self.Branch.create({'repo_id': quiet_repo.id, 'name': 'refs/heads/master'})
+        repos = self.repo | quiet_repo
+        icp = self.env['ir.config_parameter']
+        shas = ('%040x' % i for i in range(1, 1000))
+
+        def replay_workload(nb_busy, nb_quiet, slots):
+            # a burst of pushes on the busy repo followed by pushes on the quiet one
+            self.Build.search([('repo_id', 'in', repos.ids)]).write({'state': 'done'})
+            for _ in range(nb_busy):
+                self.Build.create({'branch_id': self.branch.id, 'name': next(shas)})
+            for _ in range(nb_quiet):
+                self.Build.create({'branch_id': quiet_branch.id, 'name': next(shas)})
+            return self._replay_queue(repos, slots)
+
+        icp.set_param('runbot.runbot_queue_policy', 'legacy')
+        latencies = replay_workload(10, 2, 1)
+        self.assertEqual(latencies[quiet_repo], [11, 12])
+
+        icp.set_param('runbot.runbot_queue_policy', 'fair')
+        latencies = replay_workload(10, 2, 1)
+        self.assertEqual(latencies[quiet_repo], [2, 4])
+        self.assertEqual(max(latencies[self.repo]), 12)
+
+        # a heavier repo gets more slots
+        quiet_repo.queue_weight = 3
+        latencies = replay_workload(10, 6, 4)
+        self.assertEqual(latencies[quiet_repo], [1, 1, 1, 2, 2, 2])
+        self.assertEqual(latencies[self.repo][:3], [1, 2, 3])
+
+    def test_queue_sticky_and_wait_time(self):
+        """ Test that sticky branches come first and that the waiting time starts when a build is queued """
+        Queue = self.env['runbot.build.queue']
+        self.env['ir.config_parameter'].set_param('runbot.runbot_queue_policy', 'fair')
+        dev_branch = self.Branch.create({'repo_id': self.repo.id, 'name': 'refs/heads/master-dev', 'priority': True})
+        self.branch.sticky = True
+        dev_build = self.Build.create({'branch_id': dev_branch.id, 'name': 'deadbeef0000ffffffffffffffffffffffffffff'})
+        sticky_build = self.Build.create({'branch_id': self.branch.id, 'name': 'd0d0caca0000ffffffffffffffffffffffffffff'})
+        self.assertEqual(Queue._get_next_builds(self.repo.ids, 2), [sticky_build.id, dev_build.id])
+
+        # an old build forced again does not get the waiting time of its creation
+        self.env.cr.execute("UPDATE runbot_build SET create_date = create_date - interval '10 days' WHERE id = %s", [dev_build.id])
+        dev_build._skip()
+        dev_build._force()
+        self.assertLess(Queue.search([('build_id', '=', dev_build.id)]).wait_time, 1)
@@ -14,7 +14,7 @@ _logger = logging.getLogger(__name__)
 class runbot_build(models.Model):
     _inherit = "runbot.build"
 
-    @runbot_job('testing')
+    @runbot_job('testing', depends=['job_00_init'])
     def _job_05_check_cla(self, build, log_path):
         cla_glob = glob.glob(build._path("doc/cla/*/*.md"))
         if cla_glob: